@@ -0,0 +1,250 @@
+"""
+水印处理流程的基准测试
+
+生成不同分辨率的JPEG/PNG和不同帧数的GIF, 分别测试解码、缩放、文字水印、图片水印、编码各个阶段,
+以及在本地模拟的S3(moto)上运行完整的lambda_handler, 结果以JSON输出, 可以在不同提交之间直接diff
+
+    python benchmarks/bench_pipeline.py --output bench.json
+    python benchmarks/bench_pipeline.py --quick
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+from base64 import urlsafe_b64encode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# 标准输出只输出结果JSON, 导入和处理过程中的其它输出都写到标准错误
+REPORT_STREAM, sys.stdout = sys.stdout, sys.stderr
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+from PIL import Image, ImageDraw, ImageFont, features  # noqa: E402
+
+from watermark import app, settings  # noqa: E402
+from watermark.blend import blend, get_numpy  # noqa: E402
+
+BUCKET = 'watermark-benchmark'
+TEXT = urlsafe_b64encode('水印 benchmark'.encode('utf-8')).decode().rstrip('=')
+RESOLUTIONS = {
+    'small': (640, 480),
+    'medium': (1920, 1080),
+    'large': (4000, 3000),
+}
+GIF_FRAMES = {
+    'gif10': 10,
+    'gif60': 60,
+}
+
+
+def make_image(size, seed=0):
+    """
+    生成带渐变和图形的测试图片, 避免纯色图片让编码器过于轻松
+    """
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    step = max(size) // 16
+    for i in range(0, max(size), step):
+        draw.ellipse((i, (i * 7 + seed * 13) % size[1], i + step, (i * 7 + seed * 13) % size[1] + step),
+                     fill=((i * 3 + seed * 40) % 256, (i * 5) % 256, (i * 11) % 256))
+    return img
+
+
+def encode(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+def make_inputs(quick):
+    """
+    @return: {名称: (文件内容, 扩展名)}
+    """
+    inputs = {}
+    for name, size in RESOLUTIONS.items():
+        if quick and name == 'large':
+            continue
+        img = make_image(size)
+        inputs['jpeg-%s' % name] = (encode(img, 'JPEG', quality=90), 'jpg')
+        inputs['png-%s' % name] = (encode(img, 'PNG'), 'png')
+    for name, count in GIF_FRAMES.items():
+        if quick and count > 10:
+            continue
+        frames = [make_image((320, 240), seed) for seed in range(count)]
+        inputs[name] = (encode(frames[0], 'GIF', save_all=True, append_images=frames[1:], duration=40, loop=0), 'gif')
+    return inputs
+
+
+def get_font(font_name, font_size):
+    """
+    没有wqy-zenhei字体时使用Pillow自带的字体
+    """
+    try:
+        return get_font.original(font_name, font_size)
+    except Exception:
+        return ImageFont.load_default(font_size)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def measure(func, iterations, warmup=1):
+    """
+    重复执行并统计耗时
+    @return: 吞吐量、p50/p99延迟和本次测试期间的峰值RSS
+    """
+    for _ in range(warmup):
+        func()
+    reset_peak_rss()
+    latencies = []
+    for _ in range(iterations):
+        t1 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t1)
+    peak_rss = peak_rss_mb()
+    return {
+        'iterations': iterations,
+        'throughput_per_s': round(iterations / sum(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+    }
+
+
+def reset_peak_rss():
+    """
+    重置进程的峰值RSS, 每个测试单独统计峰值; 只有Linux支持, 写入/proc/self/clear_refs重置VmHWM
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """
+    @return: 上次重置以来的峰值RSS(MB), 无法重置时为None, 整个进程的峰值不能在测试之间比较
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def bench_stages(name, data, iterations, logo):
+    """
+    单独测试各个阶段
+    """
+    font = app.get_font('wqy-zenhei', 40)
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        fmt = img.format
+        decoded = img.copy()
+    resize = app.compile_plan('image/resize,w_1080').operations[0]
+    logo_position = (decoded.size[0] - logo.size[0] - 10, decoded.size[1] - logo.size[1] - 10)
+    stages = {
+        'decode': lambda: Image.open(io.BytesIO(data)).load(),
+        'resize': lambda: app.image_resize_handler(decoded, resize),
+        'text_watermark': lambda: app.text_watermark(decoded.copy(), '水印 benchmark', font, (255, 255, 255, 180),
+                                                     shadow_radius=5, rotate_angle=30),
+        'image_watermark': lambda: app.composite_watermark(decoded.copy(), logo, logo_position,
+                                                           key=('benchmark', 'logo'), shadow_radius=5),
+        'fill_watermark': lambda: app.fill_watermark(decoded.copy(), logo, ('benchmark', 'logo'),
+                                                     padx=60, pady=60, rotate_angle=30, opacity=40),
+        'encode': lambda: encode(decoded, fmt, quality=90),
+    }
+    # 两种混合后端的对比, 包含拷贝原图的耗时
+    for backend in ('pillow', 'numpy') if get_numpy() is not None else ('pillow',):
+        for mode in ('normal', 'multiply'):
+            stages['blend_%s_%s' % (mode, backend)] = \
+                lambda backend=backend, mode=mode: blend(decoded.copy(), logo, logo_position, 60, mode, backend)
+    return {'%s/%s' % (name, stage): measure(func, iterations) for stage, func in stages.items()}
+
+
+def bench_handler(name, data, ext, iterations, client):
+    """
+    在模拟的S3上测试完整的请求处理
+    """
+    key = 'origin/%s.%s' % (name, ext)
+    client.put_object(Bucket=BUCKET, Key=key, Body=data)
+    logo = urlsafe_b64encode(('%s/logo.png' % BUCKET).encode()).decode().rstrip('=')
+    process = 'image/resize,w_1080/watermark,text_%s,size_40,t_80,shadow_radius_5,rotate_30' \
+              '/watermark,image_%s,g_nw,x_10,y_10' % (TEXT, logo)
+    event = {
+        'body': json.dumps({'origin-bucket': BUCKET, 'origin-key': key,
+                            'target-key': 'result/%s.%s' % (name, ext)}),
+        'queryStringParameters': {'x-s3-process': process},
+        'headers': {},
+        'httpMethod': 'POST',
+    }
+
+    def run():
+        ret = app.lambda_handler(event, None)
+        assert ret['statusCode'] == 200, ret
+
+    return {'%s/handler' % name: measure(run, iterations)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=10, help='每个测试的重复次数')
+    parser.add_argument('--quick', action='store_true', help='跳过大图和长动图')
+    parser.add_argument('--output', help='结果JSON文件, 默认输出到标准输出')
+    args = parser.parse_args()
+
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        os.environ.setdefault(name, value)
+    get_font.original = app.get_font
+    app.get_font = get_font
+    # 处理结果缓存会让重复请求直接命中, 基准测试只测量实际处理
+    app.derivative_store = None
+    # 每个请求的指标日志不计入耗时, 也不能混入标准输出中的结果JSON
+    settings.METRICS_ENABLED = False
+
+    logo = Image.new('RGBA', (200, 80), (0, 0, 0, 0))
+    ImageDraw.Draw(logo).rounded_rectangle((0, 0, 199, 79), radius=12, fill=(255, 255, 255, 160))
+    results = {}
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        client.put_object(Bucket=BUCKET, Key='logo.png', Body=encode(logo, 'PNG'))
+        app.s3 = client
+        for name, (data, ext) in sorted(make_inputs(args.quick).items()):
+            if ext != 'gif':
+                results.update(bench_stages(name, data, args.iterations, logo))
+            results.update(bench_handler(name, data, ext, args.iterations, client))
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'libjpeg_turbo': bool(features.check_feature('libjpeg_turbo')),
+            'resize_mode': settings.RESIZE_MODE,
+            'io_mode': settings.IO_MODE,
+            'blend_backend': settings.BLEND_BACKEND,
+            'numpy': get_numpy().__version__ if get_numpy() is not None else None,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output, file=REPORT_STREAM)
+
+
+if __name__ == '__main__':
+    main()
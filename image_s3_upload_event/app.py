@@ -1,28 +1,10 @@
-import json
-import boto3
-import requests
-
-s3 = boto3.client('s3')
-api_url = 'https://demo.mihoyo.com'
-
-
-def lambda_handler(event, context):
-    body = json.loads(event['body'])
-    img_bucket = body['origin-bucket']
-    img_key = body['origin-key']
-
-    # 图片已经处理过，则不操作
-    response = s3.get_object_tagging(
-        Bucket=img_bucket,
-        Key=img_key)
-    is_updated = False
-    for tag in response['TagSet']:
-        if tag['tag'] == 'updated' and tag['value'] == '1':
-            is_updated = True
-            break
-    if not is_updated:
-        # TODO: 判断是否是image类型
-        requests.get(api_url, {
-            'bucket': 1,
-            'key': '2'
-        })
+"""
+S3上传事件的旧入口
+
+上传事件改为由watermark/s3_event.py在进程内直接调用水印处理, 不再通过HTTP请求转发,
+这里保留lambda_handler, 沿用该入口的部署只需要把watermark目录一起打包
+"""
+try:
+    from watermark.s3_event import lambda_handler  # noqa: F401
+except ImportError:  # 与watermark目录中的模块一起作为顶层模块加载
+    from s3_event import lambda_handler  # noqa: F401
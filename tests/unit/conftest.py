@@ -0,0 +1,88 @@
+import io
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+from PIL import Image
+
+from watermark import app
+from watermark.cache import LRUCache
+from watermark.derivatives import MemoryDerivativeStore
+
+TEST_BUCKET = 'watermark-unit-test'
+
+
+@pytest.fixture()
+def s3_client(monkeypatch):
+    """
+    使用moto模拟的S3, 并替换app中的客户端
+    """
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=TEST_BUCKET)
+        monkeypatch.setattr(app, 's3', client)
+        app.asset_cache.clear()
+        app.tag_cache.clear()
+        monkeypatch.setattr(app, 'derivative_store', MemoryDerivativeStore(app.settings.DERIVATIVE_CACHE_BYTES))
+        yield client
+
+
+def make_image_bytes(size=(640, 480), fmt='JPEG', color=(30, 120, 200), mode='RGB'):
+    """
+    生成测试用图片
+    """
+    buffer = io.BytesIO()
+    Image.new(mode, size, color).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def make_event(process, origin_key='origin.jpg', target_key='result.jpg', bucket=TEST_BUCKET):
+    """
+    生成API Gateway请求事件
+    """
+    return {
+        "body": json.dumps({
+            "origin-bucket": bucket,
+            "origin-key": origin_key,
+            "target-bucket": bucket,
+            "target-key": target_key,
+        }),
+        "queryStringParameters": {"x-s3-process": process},
+        "headers": {},
+        "httpMethod": "POST",
+        "path": "/watermark",
+    }
+
+
+@pytest.fixture()
+def default_font(monkeypatch):
+    """
+    测试环境没有wqy-zenhei字体, 使用Pillow自带的字体代替
+    """
+    from PIL import ImageFont
+
+    fonts = {}
+
+    def get_font(font_name, font_size):
+        if font_size not in fonts:
+            fonts[font_size] = ImageFont.load_default(font_size)
+        return fonts[font_size]
+
+    monkeypatch.setattr(app, 'get_font', get_font)
+    monkeypatch.setattr(app, 'tile_cache', LRUCache(app.settings.TILE_CACHE_BYTES))
+    return get_font
+
+
+def make_gif_bytes(size=(120, 90), durations=(40, 80, 120), loop=2, disposal=2):
+    """
+    生成测试用动图, 每帧颜色和时长都不同
+    """
+    frames = [Image.new('RGB', size, (60 * i % 256, 100, 200 - 40 * i)) for i in range(len(durations))]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:],
+                   duration=list(durations), loop=loop, disposal=disposal)
+    return buffer.getvalue()
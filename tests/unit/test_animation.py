@@ -0,0 +1,40 @@
+import io
+
+from PIL import Image, ImageSequence
+
+from watermark import app, settings
+from watermark.animation import process_frames, read_frames
+from .conftest import TEST_BUCKET, make_event, make_gif_bytes
+
+TEXT_PROCESS = "image/watermark,size_20,text_5rC05Y2w,color_222222,t_70,g_se,x_5,y_5,rotate_30,shadow_radius_2"
+
+
+def test_read_frames_keeps_metadata():
+    with Image.open(io.BytesIO(make_gif_bytes())) as img:
+        frames, save_options = read_frames(img)
+    assert len(frames) == 3
+    assert save_options['duration'] == [40, 80, 120]
+    assert save_options['disposal'] == [2, 2, 2]
+    assert save_options['loop'] == 2
+
+
+def test_process_frames_keeps_order():
+    frames = [Image.new('L', (4, 4), i) for i in range(20)]
+    result = process_frames(frames, lambda frame: frame.point(lambda v: v + 1), 4)
+    assert [frame.getpixel((0, 0)) for frame in result] == list(range(1, 21))
+
+
+def test_gif_lambda_handler(s3_client, default_font, monkeypatch):
+    monkeypatch.setattr(settings, 'ANIMATION_WORKERS', 3)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.gif', Body=make_gif_bytes())
+    ret = app.lambda_handler(make_event(TEXT_PROCESS, origin_key='origin.gif', target_key='result.gif'), "")
+    assert ret["statusCode"] == 200
+
+    result = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.gif')
+    assert result['ContentType'] == 'image/gif'
+    with Image.open(io.BytesIO(result['Body'].read())) as img:
+        assert img.n_frames == 3
+        assert img.info['loop'] == 2
+        assert [frame.info['duration'] for frame in ImageSequence.Iterator(img)] == [40, 80, 120]
+    # 三帧共用同一个渲染好的水印
+    assert len(app.tile_cache) == 1
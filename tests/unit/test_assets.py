@@ -0,0 +1,59 @@
+import json
+from base64 import urlsafe_b64encode
+
+from watermark import app
+from watermark.assets import WatermarkAssetCache
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+def put_logo(s3_client, color=(255, 0, 0, 128)):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo/wm.png',
+                         Body=make_image_bytes((64, 32), 'PNG', color, mode='RGBA'))
+
+
+def test_asset_cache_hit(s3_client):
+    put_logo(s3_client)
+    cache = WatermarkAssetCache(lambda: s3_client, 1024 * 1024, 60)
+    first, etag = cache.get(TEST_BUCKET, 'logo/wm.png')
+    second, _ = cache.get(TEST_BUCKET, 'logo/wm.png')
+    assert first is second
+    assert first.mode == 'RGBA'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_asset_cache_revalidates_etag(s3_client):
+    put_logo(s3_client)
+    cache = WatermarkAssetCache(lambda: s3_client, 1024 * 1024, 0)
+    first, etag = cache.get(TEST_BUCKET, 'logo/wm.png')
+    assert cache.get(TEST_BUCKET, 'logo/wm.png')[0] is first
+    assert cache.revalidations == 1
+
+    put_logo(s3_client, color=(0, 255, 0, 128))
+    replaced, new_etag = cache.get(TEST_BUCKET, 'logo/wm.png')
+    assert new_etag != etag
+    assert replaced.getpixel((0, 0)) == (0, 255, 0, 128)
+    assert cache.stats()['misses'] == 2
+
+
+def test_asset_cache_byte_budget(s3_client):
+    put_logo(s3_client)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo/other.png',
+                         Body=make_image_bytes((64, 32), 'PNG', (0, 0, 0, 0), mode='RGBA'))
+    cache = WatermarkAssetCache(lambda: s3_client, 64 * 32 * 4, 60)
+    cache.get(TEST_BUCKET, 'logo/wm.png')
+    cache.get(TEST_BUCKET, 'logo/other.png')
+    cache.get(TEST_BUCKET, 'logo/wm.png')
+    assert cache.stats()['misses'] == 3
+    assert cache.stats()['items'] == 1
+
+
+def test_image_watermark_handler(s3_client):
+    put_logo(s3_client)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    image = urlsafe_b64encode(('%s/logo/wm.png' % TEST_BUCKET).encode()).decode().rstrip('=')
+    for _ in range(2):
+        ret = app.lambda_handler(make_event('image/watermark,image_%s,g_se,x_10,y_10,shadow_radius_3' % image), "")
+        assert ret["statusCode"] == 200
+        assert json.loads(ret["body"])["message"] == "OK"
+    assert app.asset_cache.stats()['misses'] == 1
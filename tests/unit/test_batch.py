@@ -0,0 +1,71 @@
+import json
+
+from watermark import app, settings
+from watermark.batch import process_batch
+from .conftest import TEST_BUCKET, make_image_bytes
+
+
+def make_batch_event(items, process=None):
+    event = {
+        "body": json.dumps({"items": items}),
+        "queryStringParameters": {"x-s3-process": process} if process else None,
+        "headers": {},
+        "httpMethod": "POST",
+        "path": "/watermark",
+    }
+    return event
+
+
+def test_process_batch_keeps_order():
+    items = [{'origin-key': str(i)} for i in range(10)]
+    results = process_batch(items, lambda item: {'message': item['origin-key']}, 4)
+    assert [result['message'] for result in results] == [str(i) for i in range(10)]
+    assert all(result['statusCode'] == 200 for result in results)
+
+
+def test_batch_lambda_handler(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'BATCH_CONCURRENCY', 3)
+    for i in range(4):
+        s3_client.put_object(Bucket=TEST_BUCKET, Key='origin-%d.jpg' % i, Body=make_image_bytes())
+    items = [{"origin-bucket": TEST_BUCKET, "origin-key": 'origin-%d.jpg' % i, "target-key": 'result-%d.jpg' % i}
+             for i in range(4)]
+    items.append({"origin-bucket": TEST_BUCKET, "origin-key": 'missing.jpg'})
+    items.append({"origin-bucket": TEST_BUCKET, "origin-key": 'origin-0.jpg', "x-s3-process": 'image/resize,w_x'})
+
+    ret = app.lambda_handler(make_batch_event(items, 'image/resize,w_100'), "")
+    assert ret["statusCode"] == 207
+    results = json.loads(ret["body"])["items"]
+    assert [result['statusCode'] for result in results] == [200, 200, 200, 200, 500, 500]
+    assert results[5]['message'] == 'invalid parameters'
+    assert set(results[0]['timings']) == {'download', 'process', 'upload', 'total'}
+    for i in range(4):
+        s3_client.head_object(Bucket=TEST_BUCKET, Key='result-%d.jpg' % i)
+
+
+def test_batch_with_invalid_items(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    items = ['origin.jpg', None, {"origin-bucket": TEST_BUCKET, "origin-key": 'origin.jpg', "target-key": 'result.jpg'}]
+    ret = app.lambda_handler(make_batch_event(items, 'image/resize,w_100'), "")
+    assert ret["statusCode"] == 207
+    results = json.loads(ret["body"])["items"]
+    # 不是对象的项单独报告参数错误, 其它项照常处理
+    assert [(result['statusCode'], result.get('message')) for result in results] == \
+        [(500, 'invalid parameters'), (500, 'invalid parameters'), (200, 'OK')]
+    s3_client.head_object(Bucket=TEST_BUCKET, Key='result.jpg')
+
+
+def test_batch_too_large(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'BATCH_MAX_ITEMS', 1)
+    items = [{"origin-bucket": TEST_BUCKET, "origin-key": 'a.jpg'}, {"origin-bucket": TEST_BUCKET, "origin-key": 'b.jpg'}]
+    ret = app.lambda_handler(make_batch_event(items, 'image/resize,w_100'), "")
+    assert ret["statusCode"] == 500
+
+
+def test_process_in_body(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    event = make_batch_event([])
+    event["body"] = json.dumps({"origin-bucket": TEST_BUCKET, "origin-key": "origin.jpg",
+                                "target-key": "result.jpg", "x-s3-process": "image/resize,w_100"})
+    ret = app.lambda_handler(event, "")
+    assert ret["statusCode"] == 200
+    s3_client.head_object(Bucket=TEST_BUCKET, Key='result.jpg')
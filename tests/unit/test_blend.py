@@ -0,0 +1,105 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageChops
+
+from watermark import app
+from watermark.blend import blend, numpy_blend
+from watermark.plan import PlanError, compile_plan
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+LOGO = 'd2F0ZXJtYXJrLXVuaXQtdGVzdC9sb2dvLnBuZw'  # watermark-unit-test/logo.png
+
+
+def make_overlay(color=(200, 40, 40, 255), size=(40, 30)):
+    return Image.new('RGBA', size, color)
+
+
+@pytest.mark.parametrize('backend', ['pillow', 'numpy'])
+def test_opacity(backend):
+    img = Image.new('RGB', (100, 80), (0, 0, 200))
+    blend(img, make_overlay(), (10, 10), opacity=50, backend=backend)
+    r, g, b = img.getpixel((20, 20))
+    assert abs(r - 100) <= 1 and abs(g - 20) <= 1 and abs(b - 120) <= 1
+    # 重叠区域以外不受影响
+    assert img.getpixel((5, 5)) == (0, 0, 200)
+
+
+@pytest.mark.parametrize('backend', ['pillow', 'numpy'])
+@pytest.mark.parametrize('mode, expected', [
+    ('multiply', (100, 25, 50)),
+    ('screen', (228, 153, 214)),
+])
+def test_blend_modes(backend, mode, expected):
+    img = Image.new('RGB', (60, 60), (128, 50, 64))
+    blend(img, make_overlay((200, 128, 200, 255)), (0, 0), mode=mode, backend=backend)
+    assert all(abs(a - b) <= 1 for a, b in zip(img.getpixel((5, 5)), expected))
+
+
+def test_numpy_normal_matches_pillow_paste():
+    img = Image.linear_gradient('L').resize((120, 90)).convert('RGB')
+    overlay = Image.linear_gradient('L').resize((50, 40)).convert('RGBA')
+    overlay.putalpha(Image.linear_gradient('L').resize((50, 40)))
+    expected = img.copy()
+    expected.paste(overlay, (100, -10), overlay)
+    result = numpy_blend(img.copy(), overlay, (100, -10))
+    assert ImageChops.difference(expected, result).getbbox() is None
+
+
+def test_numpy_keeps_opaque_background_opaque():
+    img = Image.new('RGBA', (50, 50), (10, 20, 30, 255))
+    blend(img, make_overlay((255, 255, 255, 128)), (0, 0), backend='numpy')
+    assert img.getpixel((5, 5))[3] == 255
+    # 完全透明的原图上只剩水印本身
+    img = Image.new('RGBA', (50, 50), (0, 0, 0, 0))
+    blend(img, make_overlay((255, 0, 0, 128)), (0, 0), backend='numpy')
+    assert img.getpixel((5, 5)) == (255, 0, 0, 128)
+    assert np.asarray(img)[40:, 45:].max() == 0
+
+
+def test_blend_option():
+    op = compile_plan('image/watermark,text_dGVzdA,blend_multiply,t_40').operations[0]
+    assert (op.blend, op.opacity) == ('multiply', 100)
+    op = compile_plan('image/watermark,image_%s' % LOGO).operations[0]
+    assert op.opacity == 100
+    assert compile_plan('image/watermark,image_%s,t_40' % LOGO).operations[0].opacity == 40
+    with pytest.raises(PlanError):
+        compile_plan('image/watermark,text_dGVzdA,blend_overlay')
+
+
+def test_image_watermark_opacity(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png', Body=make_image_bytes(size=(200, 100), fmt='PNG',
+                                                                                     color=(0, 0, 0)))
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo.png', Body=make_image_bytes(size=(20, 20), fmt='PNG',
+                                                                                   color=(255, 255, 255)))
+    ret = app.lambda_handler(make_event('image/watermark,image_%s,g_nw,x_0,y_0,t_50' % LOGO,
+                                        origin_key='origin.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 200
+    body = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.png')['Body'].read()
+    with Image.open(io.BytesIO(body)) as img:
+        assert abs(img.getpixel((5, 5))[0] - 128) <= 1
+        assert img.getpixel((50, 50)) == (0, 0, 0)
+
+
+@pytest.mark.parametrize('img_mode', ['I;16', 'I', 'F'])
+def test_wide_mode_falls_back_to_normal(img_mode):
+    img = Image.new(img_mode, (100, 80), 0)
+    expected = img.copy()
+    overlay = make_overlay((200, 200, 200, 255))
+    expected.paste(overlay, (10, 10), overlay)
+    result = blend(img, overlay, (10, 10), mode='multiply', backend='pillow')
+    assert result.tobytes() == expected.tobytes()
+
+
+def test_multiply_on_16bit_png(s3_client):
+    buffer = io.BytesIO()
+    Image.new('I;16', (200, 100), 30000).save(buffer, format='PNG')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png', Body=buffer.getvalue())
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo.png', Body=make_image_bytes(size=(20, 20), fmt='PNG'))
+    ret = app.lambda_handler(make_event('image/resize,w_100/watermark,image_%s,g_nw,x_0,y_0,blend_multiply' % LOGO,
+                                        origin_key='origin.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 200
+    body = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.png')['Body'].read()
+    with Image.open(io.BytesIO(body)) as img:
+        assert img.size == (100, 50)
@@ -0,0 +1,108 @@
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+from watermark import bulk, server
+from .conftest import TEST_BUCKET, make_gif_bytes, make_image_bytes
+
+PROCESS = 'image/resize,w_100'
+
+
+def write_images(root, names):
+    for name in names:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(make_gif_bytes() if name.endswith('.gif') else make_image_bytes(size=(400, 300)))
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_local_directory_with_process_pool(tmp_path):
+    source, target = tmp_path / 'source', tmp_path / 'target'
+    write_images(str(source), ['a.jpg', 'sub/b.jpg', 'c.gif', 'notes.txt'])
+    manifest = str(tmp_path / 'manifest.jsonl')
+    pool = server.create_pool(2)
+    try:
+        report = bulk.reprocess(str(source), str(target), PROCESS, pool, manifest)
+    finally:
+        pool.shutdown()
+    assert (report['processed'], report['ok'], report['failed'], report['resumed']) == (3, 3, 0, 0)
+    assert report['images_per_s'] > 0 and report['mb_per_s'] > 0
+    with Image.open(str(target / 'sub' / 'b.jpg')) as img:
+        assert img.size == (100, 75)
+    with Image.open(str(target / 'c.gif')) as gif:
+        assert (gif.format, gif.n_frames, gif.size) == ('GIF', 3, (100, 75))
+    assert not (target / 'notes.txt').exists()
+
+    lines = read_manifest(manifest)
+    assert lines[0] == {'source': str(source), 'target': str(target), 'process': PROCESS}
+    assert sorted(entry['name'] for entry in lines[1:]) == ['a.jpg', 'c.gif', 'sub/b.jpg']
+
+
+def test_resume_from_manifest(tmp_path):
+    source, target = tmp_path / 'source', tmp_path / 'target'
+    write_images(str(source), ['a.jpg', 'b.jpg', 'c.jpg'])
+    (source / 'broken.jpg').write_bytes(b'not an image')
+    manifest = str(tmp_path / 'manifest.jsonl')
+    # 模拟在处理完a.jpg之后中断, 最后一行只写了一半
+    with open(manifest, 'w') as f:
+        f.write(json.dumps({'source': str(source), 'target': str(target), 'process': PROCESS}) + '\n')
+        f.write(json.dumps({'name': 'a.jpg', 'bytes': 1, 'status': 'ok'}) + '\n')
+        f.write('{"name": "b.j')
+
+    report = bulk.reprocess(str(source), str(target), PROCESS, ThreadPoolExecutor(2), manifest)
+    assert (report['processed'], report['ok'], report['failed'], report['resumed']) == (3, 2, 1, 1)
+    assert not (target / 'a.jpg').exists()
+    assert (target / 'b.jpg').exists()
+
+    # 失败的对象在下次运行时重试
+    report = bulk.reprocess(str(source), str(target), PROCESS, ThreadPoolExecutor(2), manifest)
+    assert (report['processed'], report['failed'], report['resumed']) == (1, 1, 3)
+
+
+def test_partial_header_starts_fresh(tmp_path):
+    source, target = tmp_path / 'source', tmp_path / 'target'
+    write_images(str(source), ['a.jpg'])
+    manifest = str(tmp_path / 'manifest.jsonl')
+    # 写第一行时被中断
+    with open(manifest, 'w') as f:
+        f.write('{"source": "')
+    report = bulk.reprocess(str(source), str(target), PROCESS, ThreadPoolExecutor(1), manifest)
+    assert (report['processed'], report['ok'], report['resumed']) == (1, 1, 0)
+    lines = read_manifest(manifest)
+    assert lines[0] == {'source': str(source), 'target': str(target), 'process': PROCESS}
+    assert [entry['name'] for entry in lines[1:]] == ['a.jpg']
+
+
+def test_manifest_mismatch(tmp_path):
+    manifest = str(tmp_path / 'manifest.jsonl')
+    (tmp_path / 'source').mkdir()
+    bulk.reprocess(str(tmp_path / 'source'), str(tmp_path / 'target'), PROCESS, ThreadPoolExecutor(1), manifest)
+    with pytest.raises(ValueError):
+        bulk.reprocess(str(tmp_path / 'source'), str(tmp_path / 'target'), 'image/resize,w_200',
+                       ThreadPoolExecutor(1), manifest)
+    with pytest.raises(ValueError):
+        bulk.reprocess('s3://bucket/prefix/', str(tmp_path / 'target'), PROCESS, ThreadPoolExecutor(1),
+                       str(tmp_path / 'other.jsonl'))
+
+
+def test_s3_prefix(s3_client, tmp_path):
+    for key in ('origin/a.jpg', 'origin/sub/b.png', 'origin/readme.txt', 'other/c.jpg'):
+        body = make_image_bytes(size=(400, 300), fmt='PNG' if key.endswith('.png') else 'JPEG')
+        s3_client.put_object(Bucket=TEST_BUCKET, Key=key, Body=body)
+    manifest = str(tmp_path / 'manifest.jsonl')
+    report = bulk.reprocess('s3://%s/origin/' % TEST_BUCKET, 's3://%s/result/' % TEST_BUCKET, PROCESS,
+                            ThreadPoolExecutor(2), manifest, client=s3_client, max_pending=1)
+    assert (report['processed'], report['ok']) == (2, 2)
+    obj = s3_client.get_object(Bucket=TEST_BUCKET, Key='result/sub/b.png')
+    assert Image.open(io.BytesIO(obj['Body'].read())).size == (100, 75)
+    assert obj['ContentType'] == 'image/png'
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=TEST_BUCKET, Prefix='result/other')
@@ -0,0 +1,65 @@
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+from watermark import app
+
+
+def full_frame_composite(img, watermark, wm_position, shadow_radius, shadow_x, shadow_y, backend='pillow'):
+    """
+    原来的整图图层合成方式, 作为对照
+    numpy后端对带透明通道的原图做source-over合成, 对照结果使用Image.alpha_composite
+    """
+    def composite(layer, background):
+        if backend == 'numpy' and background.mode == 'RGBA':
+            return Image.alpha_composite(background, layer)
+        return Image.composite(layer, background, layer)
+
+    wm_layer = Image.new('RGBA', img.size)
+    wm_layer.paste(watermark, wm_position)
+    if shadow_radius > 0:
+        layer_shadow = Image.new('RGBA', img.size)
+        layer_shadow.paste(watermark, (wm_position[0] + shadow_x, wm_position[1] + shadow_y))
+        layer_shadow = layer_shadow.filter(ImageFilter.GaussianBlur(radius=shadow_radius))
+        img = composite(layer_shadow, img)
+    return composite(wm_layer, img)
+
+
+def make_watermark():
+    watermark = Image.new('RGBA', (60, 24), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(watermark)
+    draw.rectangle((4, 4, 55, 19), fill=(250, 30, 30, 180))
+    draw.line((0, 0, 59, 23), fill=(10, 200, 10, 255), width=3)
+    return watermark
+
+
+def make_image(mode):
+    img = Image.linear_gradient('L').resize((200, 150)).convert(mode)
+    return img
+
+
+@pytest.fixture(params=['pillow', 'numpy'])
+def backend(request, monkeypatch):
+    monkeypatch.setattr(app.settings, 'BLEND_BACKEND', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L'])
+@pytest.mark.parametrize('position', [(70, 60), (0, 0), (-20, -5), (150, 130), (185, 140), (250, 10)])
+@pytest.mark.parametrize('shadow_radius', [0, 1, 5])
+def test_composite_matches_full_frame(mode, position, shadow_radius, backend):
+    img = make_image(mode)
+    watermark = make_watermark()
+    expected = full_frame_composite(img, watermark, position, shadow_radius, 10, 10, backend)
+    result = app.composite_watermark(img.copy(), watermark, position, key=None,
+                                     shadow_radius=shadow_radius, shadow_x=10, shadow_y=10)
+    assert ImageChops.difference(expected, result).getbbox() is None
+
+
+def test_cached_shadow_matches_full_frame(backend):
+    img = make_image('RGB')
+    watermark = make_watermark()
+    expected = full_frame_composite(img, watermark, (70, 60), 4, -6, 8)
+    for _ in range(2):
+        result = app.composite_watermark(img.copy(), watermark, (70, 60), key=('test', 'shadow'),
+                                         shadow_radius=4, shadow_x=-6, shadow_y=8)
+        assert ImageChops.difference(expected, result).getbbox() is None
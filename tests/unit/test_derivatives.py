@@ -0,0 +1,102 @@
+import io
+from base64 import urlsafe_b64encode
+
+from PIL import Image
+
+from watermark import app
+from watermark.derivatives import MemoryDerivativeStore, S3DerivativeStore, derivative_key
+from watermark.plan import compile_plan
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+def test_derivative_key_is_canonical():
+    a = compile_plan('image/resize,w_100,h_50/watermark,t_50,x_1')
+    b = compile_plan('image/resize,h_50,w_100/watermark,x_1,t_50,g_se')
+    c = compile_plan('image/resize,h_50,w_101/watermark,x_1,t_50')
+    assert derivative_key('"etag"', a, 'image/jpeg') == derivative_key('"etag"', b, 'image/jpeg')
+    assert derivative_key('"etag"', a, 'image/jpeg') != derivative_key('"etag"', c, 'image/jpeg')
+    assert derivative_key('"etag"', a, 'image/jpeg') != derivative_key('"other"', a, 'image/jpeg')
+    assert derivative_key('"etag"', a, 'image/jpeg') != derivative_key('"etag"', a, 'image/png')
+
+
+def test_memory_store_eviction():
+    store = MemoryDerivativeStore(10)
+    store.store(None, 'a', b'123456')
+    store.store(None, 'b', b'123456')
+    store.store(None, 'c', b'12345678901')
+    assert store.stats()['items'] == 1
+    assert store.stats()['evictions'] == 1
+    assert store.stats()['stores'] == 2
+
+
+def assert_result(s3_client, key):
+    result = s3_client.get_object(Bucket=TEST_BUCKET, Key=key)
+    assert result['ContentType'] == 'image/jpeg'
+    tags = s3_client.get_object_tagging(Bucket=TEST_BUCKET, Key=key)['TagSet']
+    assert {'Key': 'updated', 'Value': '1'} in tags
+    return result['Body'].read()
+
+
+def test_memory_cache_hit_skips_download(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='a.jpg'), "")["statusCode"] == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError('命中缓存时不应该下载原图')
+
+    monkeypatch.setattr(app, 'download_image', fail)
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='b.jpg'), "")["statusCode"] == 200
+    assert assert_result(s3_client, 'a.jpg') == assert_result(s3_client, 'b.jpg')
+    assert app.derivative_store.stats()['hits'] == 1
+
+
+def test_s3_cache_uses_server_side_copy(s3_client, monkeypatch):
+    store = S3DerivativeStore(TEST_BUCKET, 'derivatives', 1024 * 1024)
+    monkeypatch.setattr(app, 'derivative_store', store)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='a.jpg'), "")["statusCode"] == 200
+    stored = s3_client.list_objects_v2(Bucket=TEST_BUCKET, Prefix='derivatives/')['Contents']
+    assert len(stored) == 1
+
+    copies = []
+    copy_object = s3_client.copy_object
+    monkeypatch.setattr(s3_client, 'copy_object', lambda **kwargs: copies.append(kwargs) or copy_object(**kwargs))
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='b.jpg'), "")["statusCode"] == 200
+    assert copies[0]['CopySource'] == {'Bucket': TEST_BUCKET, 'Key': stored[0]['Key']}
+    assert assert_result(s3_client, 'a.jpg') == assert_result(s3_client, 'b.jpg')
+    assert store.stats() == {'hits': 1, 'misses': 1, 'stores': 1, 'hit_rate': 0.5}
+
+
+def test_replaced_asset_misses_cache(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='wm.png',
+                         Body=make_image_bytes((64, 32), 'PNG', (255, 0, 0, 255), mode='RGBA'))
+    image = urlsafe_b64encode(('%s/wm.png' % TEST_BUCKET).encode()).decode().rstrip('=')
+    process = 'image/watermark,image_%s,g_nw,x_0,y_0' % image
+    assert app.lambda_handler(make_event(process, target_key='a.jpg'), "")["statusCode"] == 200
+
+    # 同一个key下替换水印素材后重新处理
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='wm.png',
+                         Body=make_image_bytes((64, 32), 'PNG', (0, 255, 0, 255), mode='RGBA'))
+    app.asset_cache.clear()
+    assert app.lambda_handler(make_event(process, target_key='b.jpg'), "")["statusCode"] == 200
+    assert app.derivative_store.stats()['hits'] == 0
+    result = Image.open(io.BytesIO(assert_result(s3_client, 'b.jpg')))
+    red, green, _ = result.getpixel((10, 10))
+    assert green > 200 and red < 50
+
+
+def test_render_settings_change_misses_cache(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='a.jpg'), "")["statusCode"] == 200
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='b.jpg'), "")["statusCode"] == 200
+    assert app.derivative_store.stats()['hits'] == 1
+
+    # 缩放策略、混合实现或渲染版本变化后输出可能不同, 不使用之前的结果
+    for name, value in (('RESIZE_MODE', 'speed'), ('BLEND_BACKEND', 'pillow')):
+        monkeypatch.setattr(app.settings, name, value)
+        assert app.lambda_handler(make_event('image/resize,w_100', target_key='c.jpg'), "")["statusCode"] == 200
+        assert app.derivative_store.stats()['hits'] == 1
+    monkeypatch.setattr(app, 'RENDER_VERSION', app.RENDER_VERSION + 1)
+    assert app.lambda_handler(make_event('image/resize,w_100', target_key='d.jpg'), "")["statusCode"] == 200
+    assert app.derivative_store.stats()['hits'] == 1
@@ -0,0 +1,83 @@
+import io
+
+from PIL import Image
+
+from watermark import app
+from watermark.plan import compile_plan
+from .conftest import TEST_BUCKET, make_event, make_gif_bytes, make_image_bytes
+
+LOGO = 'd2F0ZXJtYXJrLXVuaXQtdGVzdC9sb2dvLnBuZw'  # watermark-unit-test/logo.png
+
+
+def make_tile():
+    return Image.new('RGBA', (20, 10), (255, 0, 0, 255))
+
+
+def test_fill_options():
+    op = compile_plan('image/watermark,text_dGVzdA,fill_1,padx_30,pady_40,rotate_45').operations[0]
+    assert (op.fill, op.padx, op.pady, op.rotate) == (1, 30, 40, 45)
+    assert compile_plan('image/watermark,text_dGVzdA').operations[0].fill == 0
+
+
+def test_pattern_grid():
+    pattern = app.build_fill_pattern(make_tile(), (200, 100), padx=10, pady=5)
+    assert pattern.size == (200, 100)
+    # 第一行从左上角开始, 每30像素一个水印
+    assert pattern.getpixel((0, 0))[3] == 255
+    assert pattern.getpixel((25, 0))[3] == 0
+    assert pattern.getpixel((30, 0))[3] == 255
+    # 第二行错开半格
+    assert pattern.getpixel((0, 15))[3] == 255
+    assert pattern.getpixel((10, 15))[3] == 0
+    assert pattern.getpixel((15, 15))[3] == 255
+    # 覆盖到右下角
+    covered = Image.new('RGBA', (200, 100))
+    covered.paste(pattern, (0, 0))
+    assert covered.getchannel('A').crop((150, 60, 200, 100)).getextrema()[1] == 255
+
+
+def test_pattern_is_cached_per_size(default_font, monkeypatch):
+    tile = make_tile()
+    first = app.render_fill_pattern(tile, ('test', 'tile'), (100, 80), 10, 10)
+    assert app.render_fill_pattern(tile, ('test', 'tile'), (100, 80), 10, 10) is first
+    assert app.render_fill_pattern(tile, ('test', 'tile'), (120, 80), 10, 10).size == (120, 80)
+
+
+def test_fill_blends_once(default_font, monkeypatch):
+    calls = []
+    blend = app.blend
+
+    def counting_blend(img, overlay, position, *args, **kwargs):
+        calls.append(overlay.size)
+        return blend(img, overlay, position, *args, **kwargs)
+
+    monkeypatch.setattr(app, 'blend', counting_blend)
+    img = Image.new('RGB', (300, 200), (0, 0, 0))
+    app.text_watermark(img, 'test', default_font('', 20), (255, 255, 255, 255), fill=1, padx=5, pady=5)
+    assert calls == [(300, 200)]
+    # 文字重复出现在图片各处
+    assert img.crop((0, 0, 100, 100)).getextrema()[0][1] == 255
+    assert img.crop((200, 100, 300, 200)).getextrema()[0][1] == 255
+
+
+def test_fill_image_watermark(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png',
+                         Body=make_image_bytes(size=(300, 200), fmt='PNG', color=(0, 0, 0)))
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo.png',
+                         Body=make_image_bytes(size=(20, 20), fmt='PNG', color=(255, 255, 255)))
+    ret = app.lambda_handler(make_event('image/watermark,image_%s,fill_1,padx_20,pady_20,t_50' % LOGO,
+                                        origin_key='origin.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 200
+    body = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.png')['Body'].read()
+    with Image.open(io.BytesIO(body)) as img:
+        assert abs(img.getpixel((5, 5))[0] - 127) <= 1
+        assert img.getpixel((30, 5)) == (0, 0, 0)
+        assert abs(img.getpixel((285, 165))[0] - 127) <= 1
+
+
+def test_animation_frames_share_pattern(s3_client, default_font):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.gif', Body=make_gif_bytes())
+    ret = app.lambda_handler(make_event('image/watermark,text_dGVzdA,t_100,fill_1', origin_key='origin.gif',
+                                        target_key='result.gif'), "")
+    assert ret["statusCode"] == 200
+    assert len([key for key in app.tile_cache._items if key[0] == 'fill']) == 1
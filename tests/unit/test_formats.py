@@ -0,0 +1,106 @@
+import io
+
+import pytest
+from PIL import Image
+
+from watermark import app
+from watermark.formats import accepts, is_available, negotiate
+from watermark.plan import FormatOp, PlanError, compile_plan
+from .conftest import TEST_BUCKET, make_event, make_gif_bytes, make_image_bytes
+
+JPEG = ('JPEG', 'image/jpeg')
+
+
+def test_format_option():
+    assert compile_plan('image/format,webp').operations == (FormatOp(f='webp'),)
+    assert compile_plan('image/format,f_WEBP').format == 'webp'
+    assert compile_plan('image/format,auto/quality,q_80').format == 'auto'
+    assert compile_plan('image/quality,q_80').format is None
+    with pytest.raises(PlanError):
+        compile_plan('image/format,bmp')
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('image/avif,image/webp,*/*', 'image/avif'),
+    ('image/webp,*/*;q=0.8', 'image/webp'),
+    ('image/avif;q=0,image/webp', 'image/webp'),
+    ('*/*', 'image/jpeg'),
+    (None, 'image/jpeg'),
+])
+def test_negotiate_auto(accept, expected):
+    if expected == 'image/avif' and not is_available('avif'):
+        expected = 'image/webp'
+    assert negotiate('auto', accept, JPEG)[1] == expected
+
+
+def test_negotiate_explicit_format_ignores_accept():
+    assert negotiate('png', 'image/webp', JPEG) == ('PNG', 'image/png')
+    assert negotiate(None, 'image/webp', JPEG) == JPEG
+    assert not accepts('image/webp;q=0', 'image/webp')
+    assert not accepts('image/webp; q=0.0, */*', 'image/webp')
+    assert not accepts('image/webp;q=0.000', 'image/webp')
+    assert accepts('image/webp;q=0.5', 'image/webp')
+    assert accepts('image/avif;q=0.01,image/webp', 'image/avif')
+
+
+def test_webp_output(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    ret = app.lambda_handler(make_event('image/resize,w_320/format,webp/quality,q_75', target_key='result.webp'), "")
+    assert ret["statusCode"] == 200
+    response = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.webp')
+    assert response['ContentType'] == 'image/webp'
+    with Image.open(io.BytesIO(response['Body'].read())) as img:
+        assert img.format == 'WEBP'
+        assert img.size == (320, 240)
+
+
+def test_accept_header_negotiation(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    event = make_event('image/format,auto')
+    event['headers'] = {'Accept': 'image/webp,*/*'}
+    assert app.lambda_handler(event, "")["statusCode"] == 200
+    assert s3_client.head_object(Bucket=TEST_BUCKET, Key='result.jpg')['ContentType'] == 'image/webp'
+
+    # 不同的Accept头不能命中同一个缓存结果
+    event['headers'] = {'accept': '*/*'}
+    assert app.lambda_handler(event, "")["statusCode"] == 200
+    response = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.jpg')
+    assert response['ContentType'] == 'image/jpeg'
+    with Image.open(io.BytesIO(response['Body'].read())) as img:
+        assert img.format == 'JPEG'
+
+
+def test_progressive_jpeg_from_transparent_png(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png',
+                         Body=make_image_bytes(fmt='PNG', mode='RGBA', color=(30, 120, 200, 128)))
+    ret = app.lambda_handler(make_event('image/format,jpg', origin_key='origin.png', target_key='result.jpg'), "")
+    assert ret["statusCode"] == 200
+    response = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.jpg')
+    assert response['ContentType'] == 'image/jpeg'
+    with Image.open(io.BytesIO(response['Body'].read())) as img:
+        assert img.format == 'JPEG'
+        assert img.mode == 'RGB'
+        assert img.info.get('progressive') or img.info.get('progression')
+
+
+def test_quality_changes_output_size(s3_client):
+    noisy = Image.effect_noise((320, 240), 64).convert('RGB')
+    buffer = io.BytesIO()
+    noisy.save(buffer, format='JPEG', quality=100)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=buffer.getvalue())
+    sizes = []
+    for q in (90, 40):
+        target = 'result-%d.jpg' % q
+        app.lambda_handler(make_event('image/quality,q_%d' % q, target_key=target), "")
+        sizes.append(s3_client.head_object(Bucket=TEST_BUCKET, Key=target)['ContentLength'])
+    assert sizes[1] < sizes[0]
+
+
+def test_animated_gif_to_webp(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.gif', Body=make_gif_bytes())
+    ret = app.lambda_handler(make_event('image/format,webp', origin_key='origin.gif', target_key='result.webp'), "")
+    assert ret["statusCode"] == 200
+    body = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.webp')['Body'].read()
+    with Image.open(io.BytesIO(body)) as img:
+        assert img.format == 'WEBP'
+        assert img.n_frames == 3
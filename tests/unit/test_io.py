@@ -0,0 +1,50 @@
+import io
+import json
+
+from PIL import Image
+
+from watermark import app, settings
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+def test_memory_mode_skips_tmp(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+
+    def fail(*args, **kwargs):
+        raise AssertionError('memory模式不应该使用磁盘中转')
+
+    monkeypatch.setattr(s3_client, 'download_file', fail)
+    monkeypatch.setattr(s3_client, 'upload_file', fail)
+
+    ret = app.lambda_handler(make_event('image/resize,w_320,h_240'), "")
+    assert ret["statusCode"] == 200
+    assert json.loads(ret["body"])["message"] == "OK"
+
+    result = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.jpg')
+    assert result['ContentType'] == 'image/jpeg'
+    with Image.open(io.BytesIO(result['Body'].read())) as img:
+        assert img.format == 'JPEG'
+        assert img.size == (320, 240)
+    tags = s3_client.get_object_tagging(Bucket=TEST_BUCKET, Key='result.jpg')['TagSet']
+    assert {'Key': 'updated', 'Value': '1'} in tags
+    assert {'Key': 'watermark', 'Value': '1'} in tags
+
+
+def test_large_object_falls_back_to_file(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    monkeypatch.setattr(settings, 'MEMORY_MAX_BYTES', 16)
+
+    ret = app.lambda_handler(make_event('image/resize,w_320,h_240'), "")
+    assert ret["statusCode"] == 200
+    with Image.open(io.BytesIO(s3_client.get_object(Bucket=TEST_BUCKET, Key='result.jpg')['Body'].read())) as img:
+        assert img.size == (320, 240)
+
+
+def test_file_mode(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    monkeypatch.setattr(settings, 'IO_MODE', 'file')
+
+    ret = app.lambda_handler(make_event('image/resize,w_320,h_240'), "")
+    assert ret["statusCode"] == 200
+    result = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.jpg')
+    assert result['ContentType'] == 'image/jpeg'
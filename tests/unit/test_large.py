@@ -0,0 +1,80 @@
+import io
+import json
+
+from PIL import Image, ImageChops
+
+from watermark import app
+from watermark.blend import numpy_blend
+from watermark.cache import LRUCache
+from watermark.metrics import collector
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+def make_noise(size=(400, 900)):
+    return Image.effect_noise(size, 60).convert('RGB')
+
+
+def test_pixel_cap(s3_client, monkeypatch):
+    monkeypatch.setattr(app.settings, 'MAX_PIXELS', 100 * 100)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png', Body=make_image_bytes(size=(200, 100), fmt='PNG'))
+    ret = app.lambda_handler(make_event('image/quality,q_90', origin_key='origin.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 413
+    assert json.loads(ret["body"])["message"] == 'image too large'
+
+    # 放大后超过上限同样拒绝
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='small.png', Body=make_image_bytes(size=(50, 50), fmt='PNG'))
+    ret = app.lambda_handler(make_event('image/resize,w_500', origin_key='small.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 413
+
+
+def test_estimate_memory_from_header():
+    with Image.open(io.BytesIO(make_image_bytes(size=(2000, 1000), fmt='PNG'))) as img:
+        peak, max_pixels = app.estimate_memory(img, app.compile_plan('image/resize,w_200'))
+        assert peak == 2000 * 1000 * 3 + 200 * 100 * 3
+        assert max_pixels == 2000 * 1000
+        # 只读取了图片头
+        assert img.tile
+
+
+def test_strip_resize_matches_resize():
+    img = make_noise()
+    expected = img.resize((133, 299), resample=Image.BILINEAR, reducing_gap=3.0)
+    result = app.strip_resize(img, (133, 299), reducing_gap=3.0, strip_height=64)
+    assert result.size == expected.size
+    assert max(high for low, high in ImageChops.difference(expected, result).getextrema()) <= 1
+
+
+def test_large_image_mode(s3_client, monkeypatch):
+    monkeypatch.setattr(app.settings, 'LARGE_IMAGE_BYTES', 1024)
+    monkeypatch.setattr(app.settings, 'STRIP_HEIGHT', 32)
+    buffer = io.BytesIO()
+    make_noise().save(buffer, format='PNG')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png', Body=buffer.getvalue())
+    collector.clear()
+    ret = app.lambda_handler(make_event('image/resize,w_200', origin_key='origin.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 200
+    assert collector.last().values['LargeImage'] == 1
+    body = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.png')['Body'].read()
+    with Image.open(io.BytesIO(body)) as img:
+        assert img.size == (200, 450)
+
+
+def test_numpy_blend_strips_match(monkeypatch):
+    img = Image.linear_gradient('L').resize((120, 200)).convert('RGBA')
+    overlay = Image.linear_gradient('L').resize((80, 150)).convert('RGBA')
+    overlay.putalpha(128)
+    expected = numpy_blend(img.copy(), overlay, (10, 20), mode='multiply')
+    monkeypatch.setattr(app.settings, 'STRIP_HEIGHT', 7)
+    result = numpy_blend(img.copy(), overlay, (10, 20), mode='multiply')
+    assert ImageChops.difference(expected, result).getbbox() is None
+
+
+def test_fill_band_matches_full_pattern(monkeypatch):
+    tile = Image.new('RGBA', (30, 12), (255, 255, 255, 200))
+    img = make_noise((300, 500))
+    expected = app.blend(img.copy(), app.build_fill_pattern(tile, img.size, 15, 9, 20, (7, 11)), (0, 0))
+    # 整图图层超过缓存容量时按周期逐段混合
+    monkeypatch.setattr(app, 'tile_cache', LRUCache(1024 * 100))
+    result = app.fill_watermark(img.copy(), tile, ('test', 'band'), 15, 9, 20, (7, 11))
+    assert ImageChops.difference(expected, result).getbbox() is None
+    assert all(key[2][1] is None for key in app.tile_cache._items)
@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+from watermark import app
+from watermark.metrics import Metrics, collector
+from .conftest import TEST_BUCKET, make_event, make_gif_bytes, make_image_bytes
+
+
+def test_emf_record_format():
+    metrics = Metrics(key='origin.jpg')
+    metrics.add('ResizeTime', 1.5, 'Milliseconds')
+    metrics.add('ResizeTime', 2.5, 'Milliseconds')
+    metrics.put('FrameCount', 3)
+    record = metrics.to_emf()
+    assert record['ResizeTime'] == 4.0
+    assert record['FrameCount'] == 3
+    assert record['key'] == 'origin.jpg'
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'Watermark'
+    assert directive['Dimensions'] == [['FunctionName']]
+    assert {'Name': 'ResizeTime', 'Unit': 'Milliseconds'} in directive['Metrics']
+    # 属性不作为指标
+    assert 'key' not in [m['Name'] for m in directive['Metrics']]
+
+
+def test_handler_emits_stage_metrics(s3_client, default_font, capsys):
+    collector.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(size=(600, 400)))
+    ret = app.lambda_handler(make_event('image/resize,w_300/watermark,text_dGVzdA', target_key='result.jpg'), "")
+    assert ret["statusCode"] == 200
+
+    values = collector.last().values
+    for name in ('DownloadTime', 'DecodeTime', 'ResizeTime', 'TextWatermarkTime', 'EncodeTime', 'UploadTime',
+                 'PeakMemory'):
+        assert values[name] >= 0, name
+    assert values['DownloadBytes'] == len(make_image_bytes(size=(600, 400)))
+    assert values['UploadBytes'] == s3_client.head_object(Bucket=TEST_BUCKET, Key='result.jpg')['ContentLength']
+    assert values['PixelCount'] == 600 * 400
+    assert values['FrameCount'] == 1
+    assert values['DerivativeCacheHit'] == 0
+    assert 'ImageWatermarkTime' not in values
+
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    record = json.loads(lines[-1])
+    assert record['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'Watermark'
+    assert record['cache']['tile']['misses'] == 1
+
+
+def test_animation_frames_accumulate(s3_client, default_font):
+    collector.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.gif', Body=make_gif_bytes())
+    ret = app.lambda_handler(make_event('image/watermark,text_dGVzdA', origin_key='origin.gif',
+                                        target_key='result.gif'), "")
+    assert ret["statusCode"] == 200
+    assert collector.last().values['FrameCount'] == 3
+
+
+def test_failed_request_is_recorded(s3_client):
+    collector.clear()
+    with pytest.raises(ClientError):
+        app.lambda_handler(make_event('image/resize,w_100', origin_key='missing.jpg'), "")
+    assert 'error' in collector.last().properties
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'), reason='只有Linux可以重置峰值RSS')
+def test_peak_memory_is_per_invocation(s3_client):
+    collector.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='big.png', Body=make_image_bytes(size=(4000, 3000), fmt='PNG'))
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='small.jpg', Body=make_image_bytes(size=(60, 40)))
+    assert app.lambda_handler(make_event('image/resize,w_100', origin_key='big.png', target_key='a.png'), "")[
+        "statusCode"] == 200
+    big = collector.last().values['PeakMemory']
+    assert app.lambda_handler(make_event('image/resize,w_10', origin_key='small.jpg', target_key='b.jpg'), "")[
+        "statusCode"] == 200
+    # 容器复用时后面的小图不再报告之前大图的峰值
+    assert collector.last().values['PeakMemory'] < big - 20
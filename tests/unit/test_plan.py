@@ -0,0 +1,63 @@
+import pytest
+
+from watermark import app
+from watermark.plan import PlanError, QualityOp, ResizeOp, WatermarkOp, compile_plan
+from .conftest import make_event
+
+TEXT_PROCESS = "image/resize,w_1080,h_900/watermark,type_d3F5LXplbmhlaQ,size_30," \
+               "text_44Gy44KJ44GM44GqIC0gSGlyYWdhbmEsIO2eiOudvOqwgOuCmCDlpKnnqbrkuYvln44=," \
+               "color_222222,shadow_50,t_70,g_se,x_10,y_10,rotate_30/quality,q_80"
+
+
+def test_compile_plan():
+    plan = compile_plan(TEXT_PROCESS)
+    resize, watermark, quality = plan.operations
+    assert resize == ResizeOp(w=1080, h=900)
+    assert isinstance(watermark, WatermarkOp)
+    assert watermark.type == 'wqy-zenhei'
+    assert watermark.text == 'ひらがな - Hiragana, 히라가나 天空之城'
+    assert watermark.color == (0x22, 0x22, 0x22, int(0.7 * 255))
+    assert (watermark.size, watermark.rotate, watermark.g) == (30, 30, 'se')
+    assert quality == QualityOp(q=80)
+    assert plan.quality == 80
+
+
+def test_compile_plan_is_cached():
+    assert compile_plan(TEXT_PROCESS) is compile_plan(TEXT_PROCESS)
+
+
+def test_image_watermark_option():
+    plan = compile_plan('image/watermark,image_bGlueWVzaC1taWhveW8tb3JpZ2luLWltYWdlL2RvLW5vdC1jb3B5LWcwOGM2MzViNDRfNjQwLnBuZw')
+    assert plan.operations[0].image == ('linyesh-mihoyo-origin-image', 'do-not-copy-g08c635b44_640.png')
+
+
+@pytest.mark.parametrize('process', [
+    '',
+    'video/resize,w_10',
+    'image/rotate,a_90',
+    'image/resize',
+    'image/resize,w_abc',
+    'image/resize,w_-1',
+    'image/watermark,t_101',
+    'image/watermark,g_middle',
+    'image/watermark,color_XYZ',
+    'image/quality,q_0',
+    'image/quality,q',
+])
+def test_invalid_plan(process):
+    with pytest.raises(PlanError):
+        compile_plan(process)
+
+
+def test_invalid_plan_rejected_before_download(s3_client, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('非法参数不应该下载原图')
+
+    monkeypatch.setattr(app, 'download_image', fail)
+    ret = app.lambda_handler(make_event('image/resize,w_abc'), "")
+    assert ret["statusCode"] == 500
+
+
+def test_compound_option_keys():
+    op = compile_plan('image/watermark,text_5rC05Y2w,shadow_radius_3,shadow_x_4,shadow_y_-2').operations[0]
+    assert (op.shadow_radius, op.shadow_x, op.shadow_y) == (3, 4, -2)
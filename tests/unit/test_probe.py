@@ -0,0 +1,140 @@
+import io
+import json
+
+from PIL import Image
+
+from watermark import app
+from watermark.probe import identify, probe_object
+from .conftest import TEST_BUCKET, make_event, make_gif_bytes, make_image_bytes
+
+
+def get_result(s3_client, key='result'):
+    obj = s3_client.get_object(Bucket=TEST_BUCKET, Key=key)
+    return Image.open(io.BytesIO(obj['Body'].read())), obj['ContentType']
+
+
+def count_downloads(monkeypatch):
+    downloads = []
+    download_image = app.download_image
+
+    def counting_download(*args):
+        downloads.append(args)
+        return download_image(*args)
+
+    monkeypatch.setattr(app, 'download_image', counting_download)
+    return downloads
+
+
+def test_identify():
+    info = identify(io.BytesIO(make_image_bytes(size=(64, 32), fmt='PNG')))
+    assert (info.format, info.content_type, info.size, info.mode, info.n_frames) == \
+        ('PNG', 'image/png', (64, 32), 'RGB', 1)
+    assert identify(io.BytesIO(make_gif_bytes())).n_frames == 3
+    # 内容不完整时动图不统计帧数
+    assert identify(io.BytesIO(make_gif_bytes()[:200]), complete=False).n_frames is None
+    assert identify(io.BytesIO(b'not an image')) is None
+
+
+def test_probe_object(s3_client):
+    data = make_image_bytes(size=(1200, 800), fmt='PNG')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin', Body=data)
+    probe = probe_object(s3_client, TEST_BUCKET, 'origin', 1024)
+    assert probe.size == len(data)
+    assert len(probe.data) == 1024
+    assert probe.info.size == (1200, 800)
+    assert probe.etag == s3_client.head_object(Bucket=TEST_BUCKET, Key='origin')['ETag']
+
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='empty', Body=b'')
+    assert probe_object(s3_client, TEST_BUCKET, 'empty', 1024).size == 0
+
+
+def test_key_without_extension(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin', Body=make_image_bytes())
+    ret = app.lambda_handler(make_event('image/resize,w_100', origin_key='origin', target_key='result'), "")
+    assert ret["statusCode"] == 200
+    img, content_type = get_result(s3_client)
+    assert (img.format, img.size, content_type) == ('JPEG', (100, 75), 'image/jpeg')
+
+
+def test_format_from_content_not_extension(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(fmt='PNG'))
+    ret = app.lambda_handler(make_event('image/resize,w_100', origin_key='origin.jpg', target_key='result'), "")
+    assert ret["statusCode"] == 200
+    img, content_type = get_result(s3_client)
+    assert (img.format, content_type) == ('PNG', 'image/png')
+
+
+def test_reject_before_download(s3_client, monkeypatch):
+    downloads = count_downloads(monkeypatch)
+    monkeypatch.setattr(app.settings, 'PROBE_BYTES', 1024)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=b'<html>' + b' ' * 4096)
+    ret = app.lambda_handler(make_event('image/resize,w_100'), "")
+    assert ret["statusCode"] == 500
+    assert json.loads(ret["body"])["message"] == 'invalid file format'
+
+    # 超过像素上限的图片只读取图片头
+    monkeypatch.setattr(app.settings, 'MAX_PIXELS', 100 * 100)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png', Body=make_image_bytes(size=(1000, 1000), fmt='PNG'))
+    ret = app.lambda_handler(make_event('image/resize,w_100', origin_key='origin.png'), "")
+    assert ret["statusCode"] == 413
+    assert downloads == []
+
+
+def test_small_object_single_get(s3_client, monkeypatch):
+    downloads = count_downloads(monkeypatch)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(size=(100, 100)))
+    ret = app.lambda_handler(make_event('image/resize,w_50'), "")
+    assert ret["statusCode"] == 200
+    assert downloads == []
+
+    # 超过探测长度的原图在探测之后再下载
+    monkeypatch.setattr(app.settings, 'PROBE_BYTES', 256)
+    ret = app.lambda_handler(make_event('image/resize,w_60'), "")
+    assert ret["statusCode"] == 200
+    assert len(downloads) == 1
+    assert get_result(s3_client, 'result.jpg')[0].size == (60, 60)
+
+
+def test_jpeg_header_beyond_probe(s3_client, monkeypatch):
+    # APP段很大的JPEG在探测长度内无法识别, 下载完整的原图后再识别
+    img = Image.new('RGB', (80, 60), (30, 120, 200))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', exif=b'Exif\x00\x00' + b'\x00' * 8192)
+    monkeypatch.setattr(app.settings, 'PROBE_BYTES', 1024)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin', Body=buffer.getvalue())
+    assert probe_object(s3_client, TEST_BUCKET, 'origin', 1024).info is None
+    ret = app.lambda_handler(make_event('image/resize,w_40', origin_key='origin', target_key='result'), "")
+    assert ret["statusCode"] == 200
+    assert get_result(s3_client)[0].size == (40, 30)
+
+
+def test_tiff_ifd_beyond_probe(s3_client, monkeypatch):
+    # libtiff把LZW压缩的TIFF的IFD写在文件末尾, 只凭签名判断是图片, 下载完整的原图后再识别
+    img = Image.frombytes('RGB', (200, 150), bytes(range(256)) * (200 * 150 * 3 // 256) + bytes(200 * 150 * 3 % 256))
+    buffer = io.BytesIO()
+    img.save(buffer, format='TIFF', compression='tiff_lzw')
+    monkeypatch.setattr(app.settings, 'PROBE_BYTES', 1024)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.tif', Body=buffer.getvalue())
+    assert len(buffer.getvalue()) > 1024
+    assert probe_object(s3_client, TEST_BUCKET, 'origin.tif', 1024).info is None
+    ret = app.lambda_handler(make_event('image/resize,w_100', origin_key='origin.tif', target_key='result'), "")
+    assert ret["statusCode"] == 200
+    result, content_type = get_result(s3_client)
+    assert (result.format, content_type, result.size) == ('TIFF', 'image/tiff', (100, 75))
+
+
+def test_mpo_is_jpeg(s3_client):
+    # 带MPF段的相机照片被Pillow识别为MPO, 输出仍然是JPEG
+    first, second = Image.new('RGB', (640, 480), (30, 120, 200)), Image.new('RGB', (640, 480), (200, 30, 30))
+    buffer = io.BytesIO()
+    first.save(buffer, format='MPO', save_all=True, append_images=[second])
+    assert Image.open(io.BytesIO(buffer.getvalue())).format == 'MPO'
+    info = identify(io.BytesIO(buffer.getvalue()))
+    assert (info.format, info.content_type) == ('JPEG', 'image/jpeg')
+
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='photo.jpg', Body=buffer.getvalue())
+    ret = app.lambda_handler(make_event('image/resize,w_100', origin_key='photo.jpg', target_key='result'), "")
+    assert ret["statusCode"] == 200
+    result, content_type = get_result(s3_client)
+    assert (result.format, content_type, result.size) == ('JPEG', 'image/jpeg', (100, 75))
+    assert result.info.get('progressive')
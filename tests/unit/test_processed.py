@@ -0,0 +1,46 @@
+from watermark import app
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+def test_processed_object_is_not_downloaded(s3_client, monkeypatch):
+    app.tag_cache.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(), Tagging='updated=1')
+
+    def fail(*args, **kwargs):
+        raise AssertionError('已经处理过的图片不应该下载')
+
+    monkeypatch.setattr(app, 'download_image', fail)
+    ret = app.lambda_handler(make_event('image/resize,w_100'), "")
+    assert ret["statusCode"] == 200
+
+
+def test_tag_result_is_cached_by_etag(s3_client, monkeypatch):
+    app.tag_cache.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    calls = []
+    get_object_tagging = s3_client.get_object_tagging
+
+    def counting_get_object_tagging(**kwargs):
+        calls.append(kwargs)
+        return get_object_tagging(**kwargs)
+
+    monkeypatch.setattr(s3_client, 'get_object_tagging', counting_get_object_tagging)
+    for _ in range(2):
+        assert app.lambda_handler(make_event('image/resize,w_100', target_key='result.jpg'), "")["statusCode"] == 200
+    assert len(calls) == 1
+
+    # 原图内容变化后ETag不同, 重新检查标签
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(color=(1, 2, 3)))
+    app.lambda_handler(make_event('image/resize,w_100', target_key='result.jpg'), "")
+    assert len(calls) == 2
+
+
+def test_processed_object_is_not_probed(s3_client, monkeypatch):
+    app.tag_cache.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(), Tagging='updated=1')
+    gets = []
+    get_object = s3_client.get_object
+    monkeypatch.setattr(s3_client, 'get_object', lambda **kwargs: gets.append(kwargs) or get_object(**kwargs))
+    # 不超过探测长度的原图也不读取任何内容
+    assert app.lambda_handler(make_event('image/resize,w_100'), "")["statusCode"] == 200
+    assert gets == []
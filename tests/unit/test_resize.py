@@ -0,0 +1,70 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+from PIL import Image, ImageChops, ImageStat
+
+from watermark import app, settings
+from watermark.plan import compile_plan
+
+
+def make_jpeg(size=(3000, 2000)):
+    buffer = io.BytesIO()
+    Image.linear_gradient('L').resize(size).convert('RGB').save(buffer, format='JPEG')
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.mark.parametrize('mode', ['exact', 'quality', 'speed'])
+def test_decode_image_keeps_target_size(mode, monkeypatch):
+    monkeypatch.setattr(settings, 'RESIZE_MODE', mode)
+    plan = compile_plan('image/resize,w_300,h_300')
+    with Image.open(make_jpeg()) as img:
+        result, start = app.decode_image(img, plan)
+        result = app.apply_operations(result, plan, start)
+        # 保持比例时按较大的一边缩放
+        assert result.size == (450, 300)
+        assert start == (0 if mode == 'exact' else 1)
+
+
+def test_draft_decodes_at_reduced_size(monkeypatch):
+    monkeypatch.setattr(settings, 'RESIZE_MODE', 'speed')
+    with Image.open(make_jpeg()) as img:
+        app.decode_image(img, compile_plan('image/resize,w_300'))
+        # DCT缩放后解码的尺寸只有原图的1/8
+        assert img.size == (375, 250)
+
+
+def test_quality_mode_is_close_to_exact(monkeypatch):
+    plan = compile_plan('image/resize,w_300')
+    monkeypatch.setattr(settings, 'RESIZE_MODE', 'exact')
+    with Image.open(make_jpeg()) as img:
+        exact = app.apply_operations(img, plan)
+    monkeypatch.setattr(settings, 'RESIZE_MODE', 'quality')
+    with Image.open(make_jpeg()) as img:
+        fast, start = app.decode_image(img, plan)
+    assert max(ImageStat.Stat(ImageChops.difference(exact, fast)).mean) < 2
+
+
+def test_draft_skipped_when_resize_is_not_first(monkeypatch):
+    monkeypatch.setattr(settings, 'RESIZE_MODE', 'speed')
+    with Image.open(make_jpeg()) as img:
+        result, start = app.decode_image(img, compile_plan('image/quality,q_80/resize,w_300'))
+        assert start == 0
+        assert img.size == (3000, 2000)
+
+
+def test_default_mode_is_exact():
+    assert settings.RESIZE_MODE == 'exact' or 'WATERMARK_RESIZE_MODE' in os.environ
+
+
+def test_unknown_mode_fails_at_import():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+    env = dict(os.environ, WATERMARK_RESIZE_MODE='fastest', WATERMARK_STARTUP_MODE='lazy',
+               AWS_DEFAULT_REGION='us-east-1')
+    result = subprocess.run([sys.executable, '-c', 'from watermark import app'], cwd=root, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "unknown WATERMARK_RESIZE_MODE 'fastest'" in result.stderr
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from PIL import Image
+
+from watermark import app, s3_event
+from .conftest import TEST_BUCKET, make_image_bytes
+
+
+@pytest.fixture()
+def event_process(monkeypatch):
+    monkeypatch.setattr(app.settings, 'EVENT_PROCESS', 'image/resize,w_100')
+
+
+def put(client, key, body=None, **kwargs):
+    body = body if body is not None else make_image_bytes()
+    response = client.put_object(Bucket=TEST_BUCKET, Key=key, Body=body, **kwargs)
+    return {
+        'eventSource': 'aws:s3',
+        'eventName': 'ObjectCreated:Put',
+        's3': {
+            'bucket': {'name': TEST_BUCKET},
+            'object': {'key': key.replace(' ', '+'), 'size': len(body), 'eTag': response['ETag'].strip('"')},
+        },
+    }
+
+
+def sqs_message(message_id, *s3_records):
+    return {'eventSource': 'aws:sqs', 'messageId': message_id, 'body': json.dumps({'Records': list(s3_records)})}
+
+
+def get_size(client, key):
+    with Image.open(client.get_object(Bucket=TEST_BUCKET, Key=key)['Body']) as img:
+        return img.size
+
+
+def test_s3_event_processes_in_place(s3_client, event_process):
+    event = {'Records': [put(s3_client, 'upload/a photo.jpg')]}
+    assert s3_event.lambda_handler(event, None) == {'batchItemFailures': []}
+    assert get_size(s3_client, 'upload/a photo.jpg') == (100, 75)
+    tags = s3_client.get_object_tagging(Bucket=TEST_BUCKET, Key='upload/a photo.jpg')['TagSet']
+    assert {'Key': 'updated', 'Value': '1'} in tags
+
+
+def test_records_filtered_before_download(s3_client, event_process, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('过滤掉的对象不应该下载')
+
+    monkeypatch.setattr(app, 'download_image', fail)
+    monkeypatch.setattr(app.settings, 'EVENT_MAX_BYTES', 10 * 1024)
+    large = put(s3_client, 'large.png', make_image_bytes(size=(400, 400), fmt='PNG', mode='RGBA'))
+    large['s3']['object']['size'] = 20 * 1024
+    removed = dict(put(s3_client, 'removed.jpg'), eventName='ObjectRemoved:Delete')
+    event = {'Records': [
+        put(s3_client, 'notes.txt', b'hello'),
+        put(s3_client, 'done.jpg', Tagging='updated=1'),
+        large,
+        removed,
+    ]}
+    assert s3_event.lambda_handler(event, None) == {'batchItemFailures': []}
+
+
+def test_sqs_partial_batch_failure(s3_client, event_process):
+    ok = put(s3_client, 'ok.jpg')
+    broken = put(s3_client, 'broken.jpg', b'not an image')
+    event = {'Records': [
+        sqs_message('m1', ok),
+        sqs_message('m2', broken),
+        # 配置通知时的测试消息
+        {'eventSource': 'aws:sqs', 'messageId': 'm3', 'body': json.dumps({'Event': 's3:TestEvent'})},
+    ]}
+    assert s3_event.lambda_handler(event, None) == {'batchItemFailures': [{'itemIdentifier': 'm2'}]}
+    assert get_size(s3_client, 'ok.jpg') == (100, 75)
+
+
+def test_sqs_malformed_message(s3_client, event_process):
+    event = {'Records': [
+        sqs_message('m1', put(s3_client, 'ok.jpg')),
+        {'eventSource': 'aws:sqs', 'messageId': 'm2', 'body': '{"Records": ['},
+        {'eventSource': 'aws:sqs', 'messageId': 'm3', 'body': json.dumps(['not', 'an', 'object'])},
+        sqs_message('m4', {'eventName': 'ObjectCreated:Put', 's3': {}}),
+    ]}
+    # 格式错误的消息单独报告失败, 已经成功的消息不再重试
+    assert s3_event.lambda_handler(event, None) == {'batchItemFailures': [{'itemIdentifier': 'm2'},
+                                                                          {'itemIdentifier': 'm3'},
+                                                                          {'itemIdentifier': 'm4'}]}
+    assert get_size(s3_client, 'ok.jpg') == (100, 75)
+
+
+def test_direct_event_failure_raises(s3_client, event_process):
+    with pytest.raises(RuntimeError):
+        s3_event.lambda_handler({'Records': [put(s3_client, 'broken.jpg', b'not an image')]}, None)
+
+
+def test_process_must_be_configured(s3_client, monkeypatch):
+    monkeypatch.setattr(app.settings, 'EVENT_PROCESS', None)
+    with pytest.raises(ValueError):
+        s3_event.lambda_handler({'Records': []}, None)
@@ -0,0 +1,69 @@
+import asyncio
+import gc
+import threading
+from base64 import urlsafe_b64encode
+
+from watermark import app, settings
+from watermark.s3io import AsyncS3, create_client
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+def test_client_config(monkeypatch):
+    monkeypatch.setattr(settings, 'S3_MAX_POOL_CONNECTIONS', 48)
+    client = create_client()
+    assert client.meta.config.max_pool_connections == 48
+    assert client.meta.config.tcp_keepalive is True
+    assert client.meta.config.retries['total_max_attempts'] == settings.S3_MAX_ATTEMPTS
+
+
+def test_async_s3(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='a.txt', Body=b'a', Tagging='updated=1')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='b.txt', Body=b'b')
+    aio = AsyncS3(lambda: s3_client, 4)
+
+    async def fetch():
+        return await asyncio.gather(aio.call('head_object', Bucket=TEST_BUCKET, Key='a.txt'),
+                                    aio.run(app.is_processed, TEST_BUCKET, 'a.txt', None),
+                                    aio.run(app.is_processed, TEST_BUCKET, 'b.txt', None))
+
+    head, a_processed, b_processed = asyncio.run(fetch())
+    assert (head['ContentLength'], a_processed, b_processed) == (1, True, False)
+
+
+def test_asset_fetched_concurrently(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='wm.png', Body=make_image_bytes((16, 16), 'PNG'))
+    # 标签检查和图片水印读取必须同时进行才能通过栅栏
+    barrier = threading.Barrier(2, timeout=5)
+    prefetched = []
+    is_processed = app.is_processed
+    get_asset = app.asset_cache.get
+
+    def slow_is_processed(*args):
+        barrier.wait()
+        return is_processed(*args)
+
+    def slow_get_asset(*args):
+        # 只有预取时需要等待, 之后合成水印时直接读缓存
+        if not prefetched:
+            prefetched.append(True)
+            barrier.wait()
+        return get_asset(*args)
+
+    monkeypatch.setattr(app, 'is_processed', slow_is_processed)
+    monkeypatch.setattr(app.asset_cache, 'get', slow_get_asset)
+    image = urlsafe_b64encode(('%s/wm.png' % TEST_BUCKET).encode()).decode()
+    ret = app.lambda_handler(make_event('image/watermark,image_%s' % image), "")
+    assert ret["statusCode"] == 200
+
+
+def test_skipped_request_retrieves_prefetch(s3_client, caplog):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(), Tagging='updated=1')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='wm.png', Body=make_image_bytes((16, 16), 'PNG'))
+    # 已处理过的原图提前返回, 预取的水印被取消或失败时不能留下未读取的异常
+    for key in ('wm.png', 'missing.png'):
+        image = urlsafe_b64encode(('%s/%s' % (TEST_BUCKET, key)).encode()).decode()
+        ret = app.lambda_handler(make_event('image/watermark,image_%s' % image), "")
+        assert ret["statusCode"] == 200
+    gc.collect()
+    assert not [record for record in caplog.records if 'never retrieved' in record.getMessage()]
@@ -0,0 +1,151 @@
+import http.client
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from watermark import server
+from .conftest import TEST_BUCKET, make_image_bytes
+
+
+def crash(event):
+    os._exit(1)
+
+
+@pytest.fixture()
+def start_server():
+    servers = []
+
+    def start(executor, workers, queue_size=0, **kwargs):
+        httpd = server.WatermarkServer(('127.0.0.1', 0), executor, workers, queue_size, **kwargs)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return httpd
+
+    yield start
+    for httpd in servers:
+        if not httpd.draining:
+            httpd.drain()
+
+
+def post(httpd, body, query='x-s3-process=image/resize,w_100'):
+    conn = http.client.HTTPConnection(*httpd.server_address, timeout=10)
+    conn.request('POST', '/watermark?%s' % query, json.dumps(body), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read()), response.getheader('Retry-After')
+    conn.close()
+    return result
+
+
+def blocking_handler():
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(event):
+        started.set()
+        release.wait(10)
+        return {'statusCode': 200, 'body': json.dumps({'message': 'OK'})}
+
+    return handler, started, release
+
+
+def test_process_request(s3_client, start_server):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(size=(400, 300)))
+    httpd = start_server(ThreadPoolExecutor(2), 2)
+    status, body, _ = post(httpd, {'origin-bucket': TEST_BUCKET, 'origin-key': 'origin.jpg',
+                                   'target-key': 'result.jpg'})
+    assert (status, body) == (200, {'message': 'OK'})
+    assert s3_client.head_object(Bucket=TEST_BUCKET, Key='result.jpg')['ContentType'] == 'image/jpeg'
+
+    # 处理失败时返回app的状态码和信息
+    status, body, _ = post(httpd, {'origin-bucket': TEST_BUCKET, 'origin-key': 'origin.jpg'}, 'x-s3-process=bad')
+    assert status == 500
+
+    conn = http.client.HTTPConnection(*httpd.server_address, timeout=10)
+    conn.request('GET', '/health')
+    response = conn.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read()) == {'in_flight': 0, 'rejected': 0, 'draining': False}
+
+
+def test_queue_limit(start_server):
+    handler, started, release = blocking_handler()
+    httpd = start_server(ThreadPoolExecutor(1), 1, queue_size=0, handler=handler)
+    results = []
+    first = threading.Thread(target=lambda: results.append(post(httpd, {})))
+    first.start()
+    assert started.wait(10)
+
+    # 没有空闲的进程和排队位置时直接拒绝
+    status, body, retry_after = post(httpd, {})
+    assert (status, body, retry_after) == (503, {'message': 'server busy'}, '1')
+    release.set()
+    first.join(10)
+    assert results[0][0] == 200
+    assert httpd.stats()['rejected'] == 1
+    assert post(httpd, {})[0] == 200
+
+
+def test_request_too_large(start_server, monkeypatch):
+    monkeypatch.setattr(server.settings, 'SERVER_MAX_BODY_BYTES', 16)
+    httpd = start_server(ThreadPoolExecutor(1), 1)
+    assert post(httpd, {'origin-key': 'x' * 32})[:2] == (413, {'message': 'request too large'})
+
+
+@pytest.mark.parametrize('length', ['abc', '-1'])
+def test_invalid_content_length(start_server, length):
+    httpd = start_server(ThreadPoolExecutor(1), 1)
+    conn = http.client.HTTPConnection(*httpd.server_address, timeout=10)
+    conn.putrequest('POST', '/watermark')
+    conn.putheader('Content-Length', length)
+    conn.endheaders()
+    response = conn.getresponse()
+    assert (response.status, json.loads(response.read())) == (400, {'message': 'invalid content length'})
+    conn.close()
+
+
+def test_graceful_shutdown(start_server):
+    handler, started, release = blocking_handler()
+    executor = ThreadPoolExecutor(1)
+    httpd = start_server(executor, 1, queue_size=1, handler=handler)
+    results = []
+    in_flight = threading.Thread(target=lambda: results.append(post(httpd, {})))
+    in_flight.start()
+    assert started.wait(10)
+
+    drain = threading.Thread(target=httpd.drain)
+    drain.start()
+    drain.join(0.5)
+    # 正在处理的请求完成之前不退出
+    assert drain.is_alive()
+    release.set()
+    in_flight.join(10)
+    drain.join(10)
+    assert not drain.is_alive()
+    assert results[0][0] == 200
+    with pytest.raises(RuntimeError):
+        executor.submit(handler, {})
+    with pytest.raises(OSError):
+        post(httpd, {})
+
+
+def test_process_pool():
+    pool = server.create_pool(2)
+    try:
+        # 工作进程在创建时已经全部启动
+        assert len(pool._processes) == 2
+        pids = {pool.submit(os.getpid).result() for _ in range(8)}
+        assert os.getpid() not in pids
+        assert pids <= set(pool._processes)
+    finally:
+        pool.shutdown()
+
+
+def test_replace_crashed_pool(start_server):
+    httpd = start_server(server.create_pool(1), 1, handler=crash, create_executor=lambda: server.create_pool(1))
+    broken = httpd.executor
+    assert post(httpd, {})[:2] == (500, {'message': 'worker crashed'})
+    assert httpd.executor is not broken
+    assert httpd.executor.submit(os.getpid).result() > 0
@@ -0,0 +1,115 @@
+import io
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from watermark import app, settings
+from watermark.assets import WatermarkAssetCache
+from watermark.derivatives import DiskDerivativeStore
+from watermark.spool import Spool, SpoolFull
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+
+@pytest.fixture()
+def spool(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path / 'spool'), 1024 * 1024)
+    monkeypatch.setattr(app, 'spool', spool)
+    return spool
+
+
+def test_lru_budget(tmp_path):
+    spool = Spool(str(tmp_path / 'spool'), 100)
+    assert spool.put(b'a' * 40, 'a')
+    assert spool.put(b'b' * 40, 'b')
+    assert spool.get('a') == (b'a' * 40, None)
+    # 放不下时淘汰最久未使用的b
+    assert spool.put(b'c' * 40, 'c', info='etag')
+    assert spool.get('b') is None
+    assert spool.get('c') == (b'c' * 40, 'etag')
+    assert spool.stats()['evictions'] == 1
+    assert len(os.listdir(spool.root)) == 2
+    # 超过上限一半的文件不缓存
+    assert not spool.put(b'd' * 60, 'd')
+
+
+def test_session_reserves_and_cleans_up(tmp_path):
+    spool = Spool(str(tmp_path / 'spool'), 100)
+    spool.put(b'a' * 40, 'a')
+    with spool.session() as session:
+        session.reserve(80)
+        # 中转文件优先, 缓存被淘汰
+        assert spool.get('a') is None
+        path = session.path('bucket', '../../etc/passwd')
+        assert os.path.dirname(path) == spool.root
+        with open(path, 'wb') as f:
+            f.write(b'x' * 80)
+        with pytest.raises(SpoolFull):
+            session.reserve(40)
+    assert os.listdir(spool.root) == []
+    assert spool.stats()['reserved'] == 0
+
+
+@pytest.mark.parametrize('key', ['nested/dir/origin.jpg', 'a/../../origin.jpg'])
+def test_file_mode_nested_keys(s3_client, spool, monkeypatch, key):
+    monkeypatch.setattr(settings, 'IO_MODE', 'file')
+    # 原图比探测长度大, 需要下载到中转文件
+    monkeypatch.setattr(settings, 'PROBE_BYTES', 1024)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key=key, Body=make_image_bytes())
+    ret = app.lambda_handler(make_event('image/resize,w_100', origin_key=key, target_key='out/result.jpg'), "")
+    assert ret["statusCode"] == 200, json.loads(ret["body"])
+    result = s3_client.get_object(Bucket=TEST_BUCKET, Key='out/result.jpg')
+    assert Image.open(io.BytesIO(result['Body'].read())).size == (100, 75)
+    # 请求结束后不留下中转文件
+    assert os.listdir(spool.root) == []
+    assert spool.stats()['reserved'] == 0
+
+
+def test_spool_full(s3_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'spool', Spool(str(tmp_path / 'spool'), 1024))
+    monkeypatch.setattr(settings, 'IO_MODE', 'file')
+    # 原图比探测长度大, 需要下载到中转文件
+    monkeypatch.setattr(settings, 'PROBE_BYTES', 1024)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    ret = app.lambda_handler(make_event('image/resize,w_100'), "")
+    assert ret["statusCode"] == 507
+    assert json.loads(ret["body"])["message"] == 'insufficient storage'
+
+
+def test_disk_derivative_store(s3_client, spool, monkeypatch):
+    monkeypatch.setattr(app, 'derivative_store', DiskDerivativeStore(spool))
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    for target_key in ('first.jpg', 'second.jpg'):
+        ret = app.lambda_handler(make_event('image/resize,w_100', target_key=target_key), "")
+        assert ret["statusCode"] == 200
+    assert app.derivative_store.stats()['hits'] == 1
+    assert spool.stats()['items'] == 1
+    second = s3_client.get_object(Bucket=TEST_BUCKET, Key='second.jpg')
+    assert second['ContentType'] == 'image/jpeg'
+    assert {'Key': 'updated', 'Value': '1'} in \
+        s3_client.get_object_tagging(Bucket=TEST_BUCKET, Key='second.jpg')['TagSet']
+
+
+def test_asset_disk_tier(s3_client, spool, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo.png',
+                         Body=make_image_bytes((64, 32), 'PNG', (255, 0, 0, 128), mode='RGBA'))
+    cache = WatermarkAssetCache(lambda: s3_client, 1024 * 1024, 60, spool)
+    _, etag = cache.get(TEST_BUCKET, 'logo.png')
+
+    # 内存中被淘汰后从磁盘读取, 只发HEAD确认ETag
+    cache.clear()
+    gets = []
+    get_object = s3_client.get_object
+    monkeypatch.setattr(s3_client, 'get_object', lambda **kwargs: gets.append(kwargs) or get_object(**kwargs))
+    image, disk_etag = cache.get(TEST_BUCKET, 'logo.png')
+    assert (image.size, disk_etag, gets) == ((64, 32), etag, [])
+    assert cache.stats()['disk_hits'] == 1
+
+    # 素材被替换后重新下载
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo.png',
+                         Body=make_image_bytes((64, 32), 'PNG', (0, 255, 0, 128), mode='RGBA'))
+    cache.clear()
+    image, _ = cache.get(TEST_BUCKET, 'logo.png')
+    assert image.getpixel((0, 0)) == (0, 255, 0, 128)
+    assert len(gets) == 1
@@ -0,0 +1,83 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from PIL import Image
+
+from watermark import app
+from watermark.metrics import Metrics, collector
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+COLD_INIT = '''
+import json, sys, time
+t1 = time.perf_counter()
+from watermark import app
+report = dict(app.startup.values, ImportWallTime=round((time.perf_counter() - t1) * 1000, 3),
+              numpy='numpy' in sys.modules)
+print(json.dumps(report))
+'''
+
+
+def cold_init(mode):
+    """
+    在新的进程中导入app, 模拟容器的冷启动
+    @return: 启动报告
+    """
+    env = dict(os.environ, WATERMARK_STARTUP_MODE=mode, AWS_DEFAULT_REGION='us-east-1')
+    output = subprocess.run([sys.executable, '-c', COLD_INIT], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    print('cold init (%s): %s' % (mode, report))
+    return report
+
+
+@pytest.mark.parametrize('mode', ['lazy', 'prewarm'])
+def test_cold_init_report(mode):
+    report = cold_init(mode)
+    assert report['ColdStart'] == 1
+    assert report['ImportCpuTime'] > 0
+    assert report['InitMemory'] > 0
+    if mode == 'lazy':
+        # 只有numpy混合才用到numpy, 导入时不加载
+        assert not report['numpy']
+        assert 'PrewarmTime' not in report
+    else:
+        assert report['numpy']
+        assert report['PrewarmTime'] > 0
+
+
+def test_prewarm_fonts_and_assets(s3_client, monkeypatch):
+    buffer = io.BytesIO()
+    Image.new('RGBA', (40, 20), (255, 255, 255, 128)).save(buffer, format='PNG')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='logo.png', Body=buffer.getvalue())
+
+    fonts = []
+    monkeypatch.setattr(app, 'get_font', lambda font_name, font_size: fonts.append((font_name, font_size)))
+    monkeypatch.setattr(app.settings, 'PREWARM_FONTS', ('wqy-zenhei:40', 'wqy-zenhei'))
+    monkeypatch.setattr(app.settings, 'PREWARM_ASSETS', ('%s/logo.png' % TEST_BUCKET, '%s/missing.png' % TEST_BUCKET))
+    app.prewarm()
+    assert fonts == [('wqy-zenhei', 40), ('wqy-zenhei', 40)]
+    # 缺少的素材不影响初始化, 已预加载的素材在请求时直接命中
+    misses = app.asset_cache.misses
+    assert app.asset_cache.get(TEST_BUCKET, 'logo.png')[0].size == (40, 20)
+    assert app.asset_cache.misses == misses
+
+
+def test_cold_start_metrics_on_first_request(s3_client, monkeypatch):
+    startup = Metrics()
+    startup.put('ColdStart', 1)
+    startup.put('ImportCpuTime', 123.0, 'Milliseconds')
+    monkeypatch.setattr(app, 'startup', startup)
+    collector.clear()
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(size=(200, 100)))
+    for width in (100, 50):
+        ret = app.lambda_handler(make_event('image/resize,w_%d' % width), "")
+        assert ret["statusCode"] == 200
+    first, second = [metrics.values for metrics in list(collector.records)[-2:]]
+    assert (first['ColdStart'], first['ImportCpuTime']) == (1, 123.0)
+    assert second['ColdStart'] == 0
+    assert 'ImportCpuTime' not in second
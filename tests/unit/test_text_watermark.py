@@ -0,0 +1,36 @@
+import json
+
+from PIL import Image, ImageChops
+
+from watermark import app
+from .conftest import TEST_BUCKET, make_event, make_image_bytes
+
+TEXT_PROCESS = "image/watermark,size_30,text_5rC05Y2w,color_222222,t_70,g_se,x_10,y_10,rotate_30,shadow_radius_4"
+
+
+def test_text_tile_is_cached(default_font):
+    font = default_font('wqy-zenhei', 30)
+    tile, key = app.render_text_tile('hello', font, (255, 0, 0, 200), 30)
+    again, again_key = app.render_text_tile('hello', font, (255, 0, 0, 200), 30)
+    assert again is tile
+    assert again_key == key
+    shadow, margin = app.render_shadow_tile(tile, key, 5)
+    assert app.render_shadow_tile(tile, key, 5)[0] is shadow
+    assert shadow.size == (tile.size[0] + 2 * margin, tile.size[1] + 2 * margin)
+    assert app.tile_cache.stats()['hits'] == 2
+
+
+def test_cached_text_watermark_is_stable(default_font):
+    font = default_font('wqy-zenhei', 30)
+    img = Image.new('RGB', (400, 300), (30, 120, 200))
+    first = app.text_watermark(img.copy(), 'hello', font, (255, 0, 0, 200), rotate_angle=30, shadow_radius=4)
+    second = app.text_watermark(img.copy(), 'hello', font, (255, 0, 0, 200), rotate_angle=30, shadow_radius=4)
+    assert ImageChops.difference(first, second).getbbox() is None
+    assert ImageChops.difference(first, img).getbbox() is not None
+
+
+def test_text_watermark_handler(s3_client, default_font):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    ret = app.lambda_handler(make_event(TEXT_PROCESS), "")
+    assert ret["statusCode"] == 200
+    assert json.loads(ret["body"])["message"] == "OK"
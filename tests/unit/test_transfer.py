@@ -0,0 +1,103 @@
+import io
+import json
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from watermark import app, s3io, settings
+from watermark.s3io import download_ranges, get_part_plan, get_transfer_config
+from .conftest import TEST_BUCKET, make_event
+
+MB = 1024 * 1024
+
+
+@pytest.fixture()
+def small_parts(monkeypatch):
+    """
+    让测试用的小对象也分成多个分片
+    """
+    monkeypatch.setattr(s3io, 'MIN_PART_BYTES', 1)
+    monkeypatch.setattr(settings, 'TRANSFER_PART_BYTES', 1)
+    monkeypatch.setattr(settings, 'TRANSFER_THRESHOLD', 1024)
+
+
+def count_ranged_gets(s3_client, monkeypatch):
+    ranges = []
+    get_object = s3_client.get_object
+
+    def counting_get(**kwargs):
+        if 'Range' in kwargs:
+            ranges.append(kwargs['Range'])
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(s3_client, 'get_object', counting_get)
+    return ranges
+
+
+def test_part_plan():
+    assert get_part_plan(1 * MB) == (8 * MB, 1)
+    assert get_part_plan(40 * MB) == (8 * MB, 5)
+    # 大对象增大分片, 分片数接近并发数
+    assert get_part_plan(400 * MB) == (50 * MB, 8)
+    part_size, _ = get_part_plan(1024 * 1024 * MB)
+    assert 1024 * 1024 * MB / part_size <= s3io.MAX_PARTS
+    config = get_transfer_config(400 * MB)
+    assert (config.multipart_chunksize, config.max_concurrency) == (50 * MB, 8)
+
+
+def test_download_ranges(s3_client, small_parts, monkeypatch, tmp_path):
+    data = os.urandom(100 * 1024 + 7)
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='big.bin', Body=data)
+    etag = s3_client.head_object(Bucket=TEST_BUCKET, Key='big.bin')['ETag']
+    ranges = count_ranged_gets(s3_client, monkeypatch)
+
+    buffer = download_ranges(s3_client, TEST_BUCKET, 'big.bin', len(data), etag)
+    assert buffer.read() == data
+    assert len(ranges) == settings.TRANSFER_MAX_CONCURRENCY
+
+    path = str(tmp_path / 'big.bin')
+    assert download_ranges(s3_client, TEST_BUCKET, 'big.bin', len(data), etag, path) == path
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_download_ranges_object_replaced(s3_client, small_parts, tmp_path):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='big.bin', Body=os.urandom(4096))
+    path = str(tmp_path / 'big.bin')
+    # 对象已经被替换时不会拼出混合的内容, 也不留下不完整的文件
+    with pytest.raises(ClientError):
+        download_ranges(s3_client, TEST_BUCKET, 'big.bin', 4096, '"stale"', path)
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('io_mode', ['memory', 'file'])
+def test_large_original_ranged(s3_client, small_parts, monkeypatch, io_mode):
+    monkeypatch.setattr(settings, 'IO_MODE', io_mode)
+    monkeypatch.setattr(settings, 'PROBE_BYTES', 1024)
+    buffer = io.BytesIO()
+    Image.effect_noise((300, 200), 60).convert('RGB').save(buffer, format='PNG')
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.png', Body=buffer.getvalue())
+    ranges = count_ranged_gets(s3_client, monkeypatch)
+
+    ret = app.lambda_handler(make_event('image/resize,w_150', origin_key='origin.png', target_key='result.png'), "")
+    assert ret["statusCode"] == 200, json.loads(ret["body"])
+    # 探测一次, 之后按分片并发下载
+    assert len(ranges) == 1 + settings.TRANSFER_MAX_CONCURRENCY
+    result = s3_client.get_object(Bucket=TEST_BUCKET, Key='result.png')
+    assert Image.open(io.BytesIO(result['Body'].read())).size == (150, 100)
+
+
+def test_multipart_upload_keeps_tags(s3_client, monkeypatch):
+    monkeypatch.setattr(settings, 'TRANSFER_THRESHOLD', 5 * MB)
+    monkeypatch.setattr(settings, 'TRANSFER_PART_BYTES', 5 * MB)
+    img = Image.effect_noise((1800, 1800), 100).convert('RGB')
+    app.upload_image([img], 'PNG', {}, TEST_BUCKET, 'result.png', 'image/png', None)
+    head = s3_client.head_object(Bucket=TEST_BUCKET, Key='result.png')
+    # 分片上传的ETag带有分片数
+    assert head['ETag'].strip('"').endswith('-2')
+    assert head['ContentType'] == 'image/png'
+    tags = s3_client.get_object_tagging(Bucket=TEST_BUCKET, Key='result.png')['TagSet']
+    assert {'Key': 'updated', 'Value': '1'} in tags
+    assert {'Key': 'watermark', 'Value': '1'} in tags
@@ -0,0 +1,129 @@
+import io
+import json
+
+from PIL import Image
+
+from watermark import app
+from .conftest import TEST_BUCKET, make_gif_bytes, make_image_bytes
+
+WATERMARK = 'watermark,text_dGVzdA,t_100,size_20,g_se'
+
+
+def make_variants_event(variants, origin_key='origin.jpg'):
+    return {
+        "body": json.dumps({
+            "origin-bucket": TEST_BUCKET,
+            "origin-key": origin_key,
+            "variants": variants,
+        }),
+        "queryStringParameters": None,
+        "headers": {},
+        "httpMethod": "POST",
+        "path": "/watermark",
+    }
+
+
+def get_image(client, key):
+    response = client.get_object(Bucket=TEST_BUCKET, Key=key)
+    img = Image.open(io.BytesIO(response['Body'].read()))
+    img.load()
+    return img, response['ContentType']
+
+
+def test_variants_from_single_download(s3_client, default_font, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(size=(1600, 1200)))
+    downloads = []
+    download_image = app.download_image
+
+    def counting_download(*args):
+        downloads.append(args)
+        return download_image(*args)
+
+    monkeypatch.setattr(app, 'download_image', counting_download)
+    # 原图小于探测长度时不会再下载, 这里让探测只读到图片头
+    monkeypatch.setattr(app.settings, 'PROBE_BYTES', 4096)
+    ret = app.lambda_handler(make_variants_event([
+        {"target-key": "360.jpg", "x-s3-process": "image/resize,w_360/%s" % WATERMARK},
+        {"target-key": "1080.webp", "x-s3-process": "image/resize,w_1080/%s/format,webp/quality,q_80" % WATERMARK},
+        {"target-key": "thumb.jpg", "x-s3-process": "image/resize,w_120"},
+        {"target-key": "720.jpg", "x-s3-process": "image/resize,w_720/%s" % WATERMARK},
+    ]), "")
+    assert ret["statusCode"] == 200
+    assert len(downloads) == 1
+    assert [v['target-key'] for v in json.loads(ret["body"])["variants"]] == ['360.jpg', '1080.webp', 'thumb.jpg',
+                                                                              '720.jpg']
+
+    expected = {'360.jpg': ((360, 270), 'image/jpeg'), '1080.webp': ((1080, 810), 'image/webp'),
+                'thumb.jpg': ((120, 90), 'image/jpeg'), '720.jpg': ((720, 540), 'image/jpeg')}
+    for key, (size, content_type) in expected.items():
+        img, actual_type = get_image(s3_client, key)
+        assert (img.size, actual_type) == (size, content_type), key
+
+    # 级联缩放的基础图片不带水印, 缩略图右下角没有文字
+    thumb, _ = get_image(s3_client, 'thumb.jpg')
+    corner = thumb.convert('L').crop((80, 70, 120, 90))
+    assert corner.getextrema()[1] < 200
+    small, _ = get_image(s3_client, '360.jpg')
+    assert small.convert('L').crop((280, 240, 360, 270)).getextrema()[1] > 200
+
+
+def test_variant_without_resize(s3_client, default_font):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes(size=(400, 300)))
+    ret = app.lambda_handler(make_variants_event([
+        {"target-key": "full.png", "x-s3-process": "image/%s/format,png" % WATERMARK},
+        {"target-key": "small.jpg", "x-s3-process": "image/resize,w_100"},
+    ]), "")
+    assert ret["statusCode"] == 200
+    full, content_type = get_image(s3_client, 'full.png')
+    assert (full.size, content_type) == ((400, 300), 'image/png')
+    assert get_image(s3_client, 'small.jpg')[0].size == (100, 75)
+
+
+def test_cached_variants_are_not_reprocessed(s3_client, monkeypatch):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    variants = [{"target-key": "a.jpg", "x-s3-process": "image/resize,w_100"},
+                {"target-key": "b.jpg", "x-s3-process": "image/resize,w_200"}]
+    assert app.lambda_handler(make_variants_event(variants), "")["statusCode"] == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError('所有输出都有缓存时不应该下载原图')
+
+    monkeypatch.setattr(app, 'download_image', fail)
+    assert app.lambda_handler(make_variants_event(variants), "")["statusCode"] == 200
+
+
+def test_animated_variants(s3_client, default_font):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.gif', Body=make_gif_bytes(size=(120, 90)))
+    ret = app.lambda_handler(make_variants_event([
+        {"target-key": "a.gif", "x-s3-process": "image/%s" % WATERMARK},
+        {"target-key": "b.gif", "x-s3-process": "image/resize,w_60"},
+    ], origin_key='origin.gif'), "")
+    assert ret["statusCode"] == 200
+    a, _ = get_image(s3_client, 'a.gif')
+    b, _ = get_image(s3_client, 'b.gif')
+    assert (a.n_frames, a.size) == (3, (120, 90))
+    assert (b.n_frames, b.size) == (3, (60, 45))
+
+
+
+def test_mixed_animated_and_static_variants(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.gif', Body=make_gif_bytes(size=(120, 90)))
+    ret = app.lambda_handler(make_variants_event([
+        {"target-key": "a.gif", "x-s3-process": "image/resize,w_60"},
+        {"target-key": "b.jpg", "x-s3-process": "image/format,jpg"},
+    ], origin_key='origin.gif'), "")
+    assert ret["statusCode"] == 200
+    a, _ = get_image(s3_client, 'a.gif')
+    b, content_type = get_image(s3_client, 'b.jpg')
+    assert (a.n_frames, a.size) == (3, (60, 45))
+    # 不支持动图的格式使用第一帧
+    assert (b.format, content_type, b.size) == ('JPEG', 'image/jpeg', (120, 90))
+    assert all(abs(x - y) <= 8 for x, y in zip(b.getpixel((60, 45)), (0, 100, 200)))
+
+
+def test_invalid_variants(s3_client):
+    s3_client.put_object(Bucket=TEST_BUCKET, Key='origin.jpg', Body=make_image_bytes())
+    for variants in ([], [{"x-s3-process": "image/resize,w_100"}],
+                     [{"target-key": "a.jpg", "x-s3-process": "image/resize"}],
+                     [{"target-key": "%d.jpg" % i} for i in range(app.settings.MAX_VARIANTS + 1)]):
+        assert app.lambda_handler(make_variants_event(variants), "")["statusCode"] == 500
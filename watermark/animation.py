@@ -0,0 +1,54 @@
+"""
+动图处理
+
+读取动图的每一帧及其播放参数, 在线程池中并行处理各帧(Pillow的C实现在处理时会释放GIL),
+保存时还原每帧的时长、disposal和循环次数
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import ImageSequence
+
+# 可以保存为动图的格式
+ANIMATED_FORMATS = ('GIF', 'PNG', 'WEBP', 'AVIF')
+# 支持逐帧disposal参数的格式
+DISPOSAL_FORMATS = ('GIF', 'PNG')
+
+
+def read_frames(img):
+    """
+    读取动图的所有帧
+    @param img: 已打开的动图
+    @return: (帧列表, 保存动图时需要的参数)
+    """
+    frames = []
+    durations = []
+    disposals = []
+    for frame in ImageSequence.Iterator(img):
+        durations.append(frame.info.get('duration', 0))
+        disposals.append(getattr(frame, 'disposal_method', frame.info.get('disposal', 0)))
+        # 调色板模式下直接合成水印会被抖动到调色板颜色, 先转换为真彩色, 保存时再量化
+        if frame.mode == 'P':
+            frames.append(frame.convert('RGBA' if 'transparency' in frame.info else 'RGB'))
+        else:
+            frames.append(frame.copy())
+
+    save_options = {'save_all': True, 'duration': durations}
+    if img.format in DISPOSAL_FORMATS:
+        save_options['disposal'] = disposals
+    if 'loop' in img.info:
+        save_options['loop'] = img.info['loop']
+    return frames, save_options
+
+
+def process_frames(frames, func, workers):
+    """
+    并行处理所有帧, 结果保持原来的顺序
+    @param frames: 帧列表
+    @param func: 处理单帧的函数
+    @param workers: 线程数
+    @return: 处理后的帧列表
+    """
+    if workers <= 1 or len(frames) <= 1:
+        return [func(frame) for frame in frames]
+    with ThreadPoolExecutor(max_workers=min(workers, len(frames))) as executor:
+        return list(executor.map(func, frames))
@@ -1,32 +1,80 @@
+import asyncio
+import io
 import json
 import math
 import os
+import threading
 import time
-from base64 import b64decode
 from enum import Enum
-from mimetypes import guess_type
+from functools import lru_cache
+from importlib import metadata
 from urllib import parse
 
-import boto3
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageColor, ImageSequence
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+try:
+    from . import settings
+    from .animation import ANIMATED_FORMATS, DISPOSAL_FORMATS, process_frames, read_frames
+    from .assets import WatermarkAssetCache
+    from .batch import process_batch
+    from .blend import blend, get_numpy
+    from .derivatives import create_store, derivative_key
+    from .formats import get_save_options, get_source_format, negotiate, prepare_frame
+    from .cache import LRUCache
+    from .metrics import Metrics, cpu_time_ms, peak_memory_mb, reset_peak_memory
+    from .plan import Plan, PlanError, ResizeOp, WatermarkOp, compile_plan, parse_resize, parse_watermark
+    from .probe import has_image_signature, identify, probe_object
+    from .s3io import AsyncS3, create_client, download_ranges, get_transfer_config
+    from .spool import Spool, SpoolFull
+except ImportError:  # Lambda中app作为顶层模块加载
+    import settings
+    from animation import ANIMATED_FORMATS, DISPOSAL_FORMATS, process_frames, read_frames
+    from assets import WatermarkAssetCache
+    from batch import process_batch
+    from blend import blend, get_numpy
+    from derivatives import create_store, derivative_key
+    from formats import get_save_options, get_source_format, negotiate, prepare_frame
+    from cache import LRUCache
+    from metrics import Metrics, cpu_time_ms, peak_memory_mb, reset_peak_memory
+    from plan import Plan, PlanError, ResizeOp, WatermarkOp, compile_plan, parse_resize, parse_watermark
+    from probe import has_image_signature, identify, probe_object
+    from s3io import AsyncS3, create_client, download_ranges, get_transfer_config
+    from spool import Spool, SpoolFull
 
 # Tips: 使用pillow-simd替代pillow可以获得更好的性能
 # https://python-pillow.org/pillow-perf/
 # CC="cc -mavx2" pip install -U --force-reinstall pillow-simd
 
 
-s3 = boto3.client('s3')
-img_path = '/tmp/origin/'
-save_path = '/tmp/result/'
-
-
-def initial():
-    if not os.path.exists(img_path):
-        os.mkdir(img_path)
-
-    if not os.path.exists(save_path):
-        os.mkdir(save_path)
-
+s3 = create_client()
+aio = AsyncS3(lambda: s3, settings.S3_IO_THREADS)
+# /tmp中的中转文件和磁盘缓存, 多个工作进程各自使用一个目录
+spool = Spool(os.path.join(settings.SPOOL_DIR, str(os.getpid())), settings.SPOOL_MAX_BYTES)
+# 缩放策略: (JPEG draft保留的目标尺寸倍数, resize的reducing_gap), None表示不启用
+RESIZE_STRATEGIES = {
+    'exact': (None, None),  # 完整解码后直接插值, 与原来的结果一致
+    'quality': (2, 3.0),  # 保留两倍以上的分辨率再插值, 画质与exact几乎没有差别
+    'speed': (1, 2.0),  # 尽量在解码阶段缩小
+}
+if settings.RESIZE_MODE not in RESIZE_STRATEGIES:
+    # 配置错误时初始化失败, 而不是在第一个请求时才报错
+    raise ValueError('unknown WATERMARK_RESIZE_MODE %r, expected one of %s'
+                     % (settings.RESIZE_MODE, ', '.join(RESIZE_STRATEGIES)))
+# 渲染好的水印图片缓存
+tile_cache = LRUCache(settings.TILE_CACHE_BYTES)
+# 原图是否已经处理过, 按(bucket, key, ETag)缓存
+tag_cache = LRUCache(settings.TAG_CACHE_SIZE, sizeof=lambda processed: 1)
+# 处理结果缓存
+# 修改编码参数或处理逻辑使同样的参数得到不同的结果时递增, 旧的缓存结果不再命中
+RENDER_VERSION = 1
+derivative_store = create_store(settings.DERIVATIVE_CACHE, settings.DERIVATIVE_CACHE_BYTES,
+                                settings.DERIVATIVE_S3_BUCKET, settings.DERIVATIVE_S3_PREFIX, spool)
+# 从S3读取的图片水印素材缓存
+asset_cache = WatermarkAssetCache(lambda: s3, settings.ASSET_CACHE_BYTES, settings.ASSET_REVALIDATE_SECONDS,
+                                  spool if settings.ASSET_DISK_CACHE else None)
+render_lock = threading.Lock()
+# 超过2倍时Pillow在打开图片时直接拒绝
+Image.MAX_IMAGE_PIXELS = settings.MAX_PIXELS
 
 class Position(Enum):
     NORTH_WEST = 1
@@ -78,17 +126,17 @@ def get_relative_position(img_size, wm_size=(0, 0), position=Position.SOUTH_EAST
     if position == Position.NORTH:
         x = img_size[0] / 2.0 - relative_x - wm_size[0] / 2.0
 
-    return x, y
+    return int(x), int(y)
 
 
-# TODO：图片水印透明度
-def image_watermark(img, wm_file, wm_bucket, wm_object_key,
+def image_watermark(img, wm_bucket, wm_object_key,
                     position=Position.SOUTH_EAST, relative_x=0, relative_y=0,
-                    shadow_radius=0, shadow_x=10, shadow_y=10):
+                    shadow_radius=0, shadow_x=10, shadow_y=10,
+                    opacity=100, mode='normal',
+                    fill=0, padx=100, pady=100, rotate_angle=0):
     """
     图片水印
-    @param img: 原图文件路径
-    @param wm_file: 水印图文件路径
+    @param img: 原图
     @param wm_bucket: 水印图所在的S3 bucket的名字
     @param wm_object_key: 水印图所在的S3 bucket中的key
     @param position: 位置
@@ -97,45 +145,161 @@ def image_watermark(img, wm_file, wm_bucket, wm_object_key,
     @param shadow_radius: 阴影模糊半径, 模糊半径>0的时候启用阴影
     @param shadow_x: 阴影x偏移量
     @param shadow_y: 阴影y偏移量
-    @return: 带水印的图片
+    @param opacity: 不透明度 0-100
+    @param mode: 混合模式
+    @param fill: 为1时平铺到整张图片, 位置参数和阴影不生效
+    @param padx: 平铺的水平间距
+    @param pady: 平铺的垂直间距
+    @param rotate_angle: 平铺时水印的旋转角度
+    @return: 带水印的图片, 直接在img上修改
     """
     try:
-        if not os.path.exists(wm_file):
-            s3.download_file(wm_bucket, wm_object_key, wm_file)
+        watermark, etag = asset_cache.get(wm_bucket, wm_object_key)
+        if fill:
+            return fill_watermark(img, watermark, ('image', wm_bucket, wm_object_key, etag),
+                                  padx, pady, rotate_angle, (relative_x, relative_y), opacity, mode)
 
         img_size = img.size
-        with Image.open(wm_file) as watermark:  # 打开水印
-            wm_size = watermark.size
-            # 如果图片大小小于水印大小
-            if img_size[0] < wm_size[0]:
-                watermark.resize(tuple(map(lambda x: int(x * 0.5), watermark.size)))
-            # 新建水印图层
-            wm_layer = Image.new('RGBA', img_size)
-
-            # 将水印图片添加到图层
-            wm_position = get_relative_position(img_size, wm_size, position, relative_x, relative_y)
-            wm_layer.paste(watermark, wm_position)
-
-            if shadow_radius > 0:
-                layer_shadow = Image.new('RGBA', img_size)
-                wm_shadow_position = (wm_position[0] + shadow_x, wm_position[1] + shadow_y)
-                layer_shadow.paste(watermark, wm_shadow_position)
-                layer_shadow = layer_shadow.filter(ImageFilter.GaussianBlur(radius=shadow_radius))
-                img = Image.composite(layer_shadow, img, layer_shadow)
-            result_img = Image.composite(wm_layer, img, wm_layer)
-        # 删除临时文件
-        # os.remove(my_wm_file)
-        return result_img
+        wm_size = watermark.size
+        # 如果图片大小小于水印大小
+        if img_size[0] < wm_size[0]:
+            watermark.resize(tuple(map(lambda x: int(x * 0.5), watermark.size)))
+
+        wm_position = get_relative_position(img_size, wm_size, position, relative_x, relative_y)
+        return composite_watermark(img, watermark, wm_position,
+                                   key=('image', wm_bucket, wm_object_key, etag),
+                                   shadow_radius=shadow_radius,
+                                   shadow_x=shadow_x,
+                                   shadow_y=shadow_y,
+                                   opacity=opacity,
+                                   mode=mode)
     except Exception as e:
         raise e
 
 
+def get_text_size(font, text):
+    """
+    获取文字渲染后的大小
+    @param font: 字体
+    @param text: 文本
+    @return: (宽, 高)
+    """
+    if hasattr(font, 'getbbox'):
+        left, top, right, bottom = font.getbbox(text)
+        return right, bottom
+    return font.getsize(text)
+
+
+def render_text_tile(text, font, text_color, rotate_angle=0):
+    """
+    渲染文字水印, 结果按(文本, 字体, 字号, 颜色, 角度)缓存
+    @param text: 文本信息
+    @param font: 字体
+    @param text_color: 文本颜色（R,G,B,A）
+    @param rotate_angle: 转动角度
+    @return: (水印图片, 缓存key)
+    """
+    key = ('text', text, font.path, font.size, text_color, rotate_angle)
+    watermark = tile_cache.get(key)
+    if watermark is None:
+        # FreeType的字体对象不是线程安全的, 同时也避免动图的多个帧重复渲染同一个水印
+        with render_lock:
+            if key in tile_cache:
+                return tile_cache.get(key), key
+            watermark = Image.new('RGBA', get_text_size(font, text), (255, 255, 255, 0))
+            wm_draw = ImageDraw.Draw(watermark)
+            wm_draw.text((0, 0), text, font=font, fill=text_color)
+            if rotate_angle > 0:
+                watermark = watermark.rotate(rotate_angle, expand=1)
+            tile_cache.put(key, watermark)
+    return watermark, key
+
+
+def get_shadow_margin(shadow_radius):
+    """
+    高斯模糊会向外扩散的像素数, 按Pillow三次盒式模糊估算并留有余量
+    @param shadow_radius: 模糊半径
+    @return: 边距
+    """
+    return 3 * (int(math.ceil(shadow_radius)) + 2)
+
+
+def render_shadow_tile(watermark, key, shadow_radius):
+    """
+    渲染水印的模糊阴影, 四周预留模糊扩散的边距, 结果按水印和模糊半径缓存
+    @param watermark: 水印图片
+    @param key: 水印的缓存key
+    @param shadow_radius: 阴影模糊半径
+    @return: (阴影图片, 边距)
+    """
+    margin = get_shadow_margin(shadow_radius)
+    shadow_key = ('shadow', key, shadow_radius)
+    if key is None:
+        return blur_shadow(watermark, margin, shadow_radius), margin
+    shadow = tile_cache.get(shadow_key)
+    if shadow is None:
+        with render_lock:
+            if shadow_key in tile_cache:
+                return tile_cache.get(shadow_key), margin
+            shadow = tile_cache.put(shadow_key, blur_shadow(watermark, margin, shadow_radius))
+    return shadow, margin
+
+
+def blur_shadow(watermark, margin, shadow_radius):
+    """
+    在四周留出边距后对水印做高斯模糊
+    @param watermark: 水印图片
+    @param margin: 边距
+    @param shadow_radius: 阴影模糊半径
+    @return: 阴影图片
+    """
+    shadow = Image.new('RGBA', (watermark.size[0] + 2 * margin, watermark.size[1] + 2 * margin))
+    shadow.paste(watermark, (margin, margin))
+    return shadow.filter(ImageFilter.GaussianBlur(radius=shadow_radius))
+
+
+def composite_watermark(img, watermark, wm_position, key=None, shadow_radius=0, shadow_x=10, shadow_y=10,
+                        opacity=100, mode='normal'):
+    """
+    把水印和阴影合成到图片上
+    只处理水印和阴影模糊范围覆盖的区域, 不再创建整图大小的图层, 结果与整图合成逐像素一致
+    @param img: 原图, 直接在上面修改
+    @param watermark: RGBA水印图片
+    @param wm_position: 水印左上角的位置
+    @param key: 水印的缓存key, 为None时不缓存阴影
+    @param shadow_radius: 阴影模糊半径, 模糊半径>0的时候启用阴影
+    @param shadow_x: 阴影x偏移量
+    @param shadow_y: 阴影y偏移量
+    @param opacity: 水印和阴影的整体不透明度 0-100
+    @param mode: 水印的混合模式, 阴影总是按normal合成
+    @return: img
+    """
+    if shadow_radius > 0:
+        shadow_position = (wm_position[0] + shadow_x, wm_position[1] + shadow_y)
+        margin = get_shadow_margin(shadow_radius)
+        box = (shadow_position[0] - margin, shadow_position[1] - margin,
+               shadow_position[0] + watermark.size[0] + margin, shadow_position[1] + watermark.size[1] + margin)
+        clipped = (max(box[0], 0), max(box[1], 0), min(box[2], img.size[0]), min(box[3], img.size[1]))
+        if clipped == box:
+            shadow, _ = render_shadow_tile(watermark, key, shadow_radius)
+            blend(img, shadow, box[:2], opacity)
+        elif clipped[0] < clipped[2] and clipped[1] < clipped[3]:
+            # 阴影超出图片边缘, 在裁剪后的区域内模糊, 边缘的取值方式与整图模糊一致
+            shadow = Image.new('RGBA', (clipped[2] - clipped[0], clipped[3] - clipped[1]))
+            shadow.paste(watermark, (shadow_position[0] - clipped[0], shadow_position[1] - clipped[1]))
+            shadow = shadow.filter(ImageFilter.GaussianBlur(radius=shadow_radius))
+            blend(img, shadow, clipped[:2], opacity)
+
+    return blend(img, watermark, wm_position, opacity, mode)
+
+
 def text_watermark(img, text,
                    font,
                    text_color,
                    position=Position.SOUTH_EAST, x=10, y=10,
                    shadow_radius=0, shadow_x=10, shadow_y=10,
-                   rotate_angle=0):
+                   rotate_angle=0, mode='normal',
+                   fill=0, padx=100, pady=100):
     """
     文字水印
     @param img: 图片路径
@@ -149,65 +313,240 @@ def text_watermark(img, text,
     @param shadow_x: 阴影x偏移量
     @param shadow_y: 阴影y偏移量
     @param rotate_angle: 转动角度
-    @return: 带水印的图片
+    @param mode: 混合模式
+    @param fill: 为1时平铺到整张图片, 位置参数和阴影不生效
+    @param padx: 平铺的水平间距
+    @param pady: 平铺的垂直间距
+    @return: 带水印的图片, 直接在img上修改
     """
     try:
-        wm_size = font.getsize(text)
-        watermark = Image.new('RGBA', wm_size, (255, 255, 255, 0))
-        wm_draw = ImageDraw.Draw(watermark)
-        wm_draw.text((0, 0), text, font=font, fill=text_color)
-        if rotate_angle > 0:
-            watermark = watermark.rotate(rotate_angle, expand=1)
-        # 新建水印图层
-        wm_layer = Image.new('RGBA', img.size)
+        watermark, key = render_text_tile(text, font, text_color, rotate_angle)
+        if fill:
+            # 文字在渲染时已经旋转
+            return fill_watermark(img, watermark, key, padx, pady, 0, (x, y), mode=mode)
         wm_position = get_relative_position(img.size,
                                             wm_size=watermark.size,
                                             position=position,
                                             relative_x=x,
                                             relative_y=y)
-        wm_layer.paste(watermark, wm_position)
-        if shadow_radius > 0:
-            layer_shadow = Image.new('RGBA', img.size)
-            wm_shadow_position = (wm_position[0] + shadow_x, wm_position[1] + shadow_y)
-            layer_shadow.paste(watermark, wm_shadow_position)
-            layer_shadow = layer_shadow.filter(ImageFilter.GaussianBlur(radius=shadow_radius))
-            img = Image.composite(layer_shadow, img, layer_shadow)
-
-        result_img = Image.composite(wm_layer, img, wm_layer)
-        return result_img
+        return composite_watermark(img, watermark, wm_position,
+                                   key=key,
+                                   shadow_radius=shadow_radius,
+                                   shadow_x=shadow_x,
+                                   shadow_y=shadow_y,
+                                   mode=mode)
     except Exception as e:
         raise e
 
 
-def image_resize_handler(img, options=None, keep_ratio=True):
+def build_fill_pattern(watermark, size, padx, pady, rotate_angle=0, offset=(0, 0)):
     """
-    缩放图片大小
-    @param img: 图片
-    @param options:
-    @param keep_ratio: 保持缩放比例
-    @return: 缩放后的图片
+    把水印按网格平铺成与图片同样大小的图层, 奇数行错开半格形成斜向排列
+    先拼出一行, 再按行粘贴, 粘贴次数与行数成正比
+    @param watermark: 单个水印
+    @param size: 图层大小, 高度为None时只生成垂直方向的一个周期
+    @param padx: 水平间距
+    @param pady: 垂直间距
+    @param rotate_angle: 水印的旋转角度
+    @param offset: 网格的起点
+    @return: RGBA图层
     """
-    default_options = {
-        'w': 0,
-        'h': 0
-    }
+    tile = watermark.rotate(rotate_angle, resample=Image.BICUBIC, expand=1) if rotate_angle > 0 else watermark
+    step_x = tile.size[0] + padx
+    step_y = tile.size[1] + pady
+    if size[1] is None:
+        # 只生成垂直方向的一个周期(两行)
+        size = (size[0], 2 * step_y)
+    row = Image.new('RGBA', (size[0] + 2 * step_x, tile.size[1]))
+    for left in range(0, row.size[0], step_x):
+        row.paste(tile, (left, 0))
+
+    pattern = Image.new('RGBA', size)
+    offset_x = offset[0] % step_x
+    offset_y = offset[1] % step_y
+    for top in range(offset_y - step_y, size[1], step_y):
+        odd = (top - offset_y) // step_y % 2
+        shift = (offset_x + (step_x // 2 if odd else 0)) % step_x - step_x
+        pattern.paste(row, (shift, top))
+    return pattern
+
+
+def render_fill_pattern(watermark, key, size, padx, pady, rotate_angle=0, offset=(0, 0)):
+    """
+    平铺图层, 按(水印, 图片大小, 间距, 角度, 起点)缓存, 同样尺寸的图片和动图的各帧只生成一次
+    @param watermark: 单个水印
+    @param key: 水印的缓存key, 为None时不缓存
+    @return: RGBA图层
+    """
+    if key is None:
+        return build_fill_pattern(watermark, size, padx, pady, rotate_angle, offset)
+    pattern_key = ('fill', key, size, padx, pady, rotate_angle, offset)
+    pattern = tile_cache.get(pattern_key)
+    if pattern is None:
+        with render_lock:
+            if pattern_key in tile_cache:
+                return tile_cache.get(pattern_key)
+            pattern = tile_cache.put(pattern_key,
+                                     build_fill_pattern(watermark, size, padx, pady, rotate_angle, offset))
+    return pattern
+
 
-    options = {**default_options, **options}
-    new_width = int(options['w'])
-    new_height = int(options['h'])
+def fill_watermark(img, watermark, key, padx=100, pady=100, rotate_angle=0, offset=(0, 0),
+                   opacity=100, mode='normal'):
+    """
+    平铺水印, 整张图片只做一次混合
+    整图图层超过缓存容量时只生成垂直方向一个周期的图层并逐段混合, 内存与图片高度无关
+    @param img: 原图, 直接在上面修改
+    @param watermark: 单个RGBA水印
+    @param key: 水印的缓存key
+    @param padx: 水平间距
+    @param pady: 垂直间距
+    @param rotate_angle: 水印的旋转角度
+    @param offset: 网格的起点
+    @param opacity: 不透明度 0-100
+    @param mode: 混合模式
+    @return: img
+    """
+    if img.size[0] * img.size[1] * 4 <= tile_cache.max_bytes:
+        pattern = render_fill_pattern(watermark, key, img.size, padx, pady, rotate_angle, offset)
+        return blend(img, pattern, (0, 0), opacity, mode)
+
+    band = render_fill_pattern(watermark, key, (img.size[0], None), padx, pady, rotate_angle, (offset[0], 0))
+    period = band.size[1]
+    for top in range(offset[1] % period - period, img.size[1], period):
+        blend(img, band, (0, top), opacity, mode)
+    return img
+
+
+def get_resize_size(img_size, options, keep_ratio=True):
+    """
+    计算缩放后的大小
+    @param img_size: 原图大小
+    @param options: ResizeOp
+    @param keep_ratio: 保持缩放比例
+    @return: (宽, 高)
+    """
+    new_width = options.w
+    new_height = options.h
     if keep_ratio:
-        image_size = img.size
-        ratio = image_size[0] / image_size[1]
+        ratio = img_size[0] / img_size[1]
         if new_width / ratio > new_height:
             new_height = math.floor(new_width / ratio)
         else:
             new_width = math.floor(new_height * ratio)
+    return new_width, new_height
+
+
+def image_resize_handler(img, options=None, keep_ratio=True):
+    """
+    缩放图片大小
+    @param img: 图片
+    @param options: 已编译的ResizeOp, 也兼容未解析的参数字典
+    @param keep_ratio: 保持缩放比例
+    @return: 缩放后的图片
+    """
+    if not isinstance(options, ResizeOp):
+        options = parse_resize(options or {})
+    _, reducing_gap = RESIZE_STRATEGIES[settings.RESIZE_MODE]
+    return img.resize(get_resize_size(img.size, options, keep_ratio),
+                      resample=Image.BILINEAR,
+                      reducing_gap=reducing_gap)
+
+
+def strip_resize(img, size, reducing_gap=None, strip_height=None):
+    """
+    按输出的条带逐段缩放, 每段只处理对应的原图区域, 中间结果的内存与条带高度成正比
+    结果与整图缩放的差别不超过1
+    @param img: 已解码的图片
+    @param size: 目标大小
+    @param reducing_gap: 同Image.resize
+    @param strip_height: 每段输出的行数
+    @return: 缩放后的图片
+    """
+    strip_height = strip_height or settings.STRIP_HEIGHT
+    result = Image.new(img.mode, size)
+    scale = img.size[1] / size[1]
+    for top in range(0, size[1], strip_height):
+        bottom = min(top + strip_height, size[1])
+        strip = img.resize((size[0], bottom - top), resample=Image.BILINEAR,
+                           box=(0, top * scale, img.size[0], bottom * scale), reducing_gap=reducing_gap)
+        result.paste(strip, (0, top))
+    return result
 
-    return img.resize((new_width, new_height), resample=Image.BILINEAR)
 
+def estimate_memory(img, plan):
+    """
+    根据图片头中的尺寸和模式估算处理过程中的峰值内存, 不解码图片
+    @param img: 已打开但尚未解码的图片, 或者探测到的ImageInfo
+    @param plan: 已编译的处理计划
+    @return: (峰值字节数, 处理过程中最大的像素数)
+    """
+    bands = Image.getmodebands(img.mode)
+    size = img.size
+    current = size[0] * size[1] * bands
+    peak = current
+    max_pixels = size[0] * size[1]
+    for op in plan.operations:
+        if isinstance(op, ResizeOp):
+            size = get_resize_size(size, op)
+            resized = size[0] * size[1] * bands
+            peak = max(peak, current + resized)
+            current = resized
+            max_pixels = max(max_pixels, size[0] * size[1])
+        elif isinstance(op, WatermarkOp) and op.fill:
+            # 平铺图层
+            peak = max(peak, current + min(size[0] * size[1] * 4, tile_cache.max_bytes))
+    return peak * (getattr(img, 'n_frames', 1) or 1), max_pixels
+
+
+def check_image_size(img, plan, metrics=None):
+    """
+    解码前检查图片大小
+    @param img: 已打开但尚未解码的图片, 或者探测到的ImageInfo
+    @param plan: 已编译的处理计划
+    @param metrics: 记录估算结果的Metrics
+    @return: 是否需要使用大图模式
+    """
+    metrics = metrics or Metrics()
+    peak, max_pixels = estimate_memory(img, plan)
+    metrics.put('EstimatedMemory', round(peak / 1024.0 / 1024.0, 1), 'Megabytes')
+    if max_pixels > settings.MAX_PIXELS:
+        raise ProcessError('image too large', 413)
+    large = peak > settings.LARGE_IMAGE_BYTES
+    metrics.put('LargeImage', int(large))
+    return large
 
-# 执行初始化
-initial()
+
+def decode_image(img, plan, metrics=None, large=False):
+    """
+    解码图片, 计划以缩放开始时在解码阶段就缩小图片
+    JPEG通过draft直接按DCT缩放解码, 再用reduce做整数倍缩小后进行最终的插值
+    大图模式下即使RESIZE_MODE为exact也使用draft, 并按条带缩放
+    @param img: 已打开但尚未解码的图片
+    @param plan: 已编译的处理计划
+    @param metrics: 记录解码和缩放耗时的Metrics
+    @param large: 是否使用大图模式
+    @return: (图片, 还需要执行的第一个操作的下标)
+    """
+    metrics = metrics or Metrics()
+    draft_scale, reducing_gap = RESIZE_STRATEGIES['quality' if large else settings.RESIZE_MODE]
+    if not plan.operations or not isinstance(plan.operations[0], ResizeOp) or draft_scale is None:
+        with metrics.timer('DecodeTime'):
+            img.load()
+        return img, 0
+
+    # 按原图大小计算目标尺寸, 保证结果与完整解码后缩放的尺寸一致
+    size = get_resize_size(img.size, plan.operations[0])
+    with metrics.timer('DecodeTime'):
+        if get_source_format(img.format)[0] == 'JPEG':
+            img.draft(None, (size[0] * draft_scale, size[1] * draft_scale))
+        img.load()
+    with metrics.timer('ResizeTime'):
+        if large:
+            img = strip_resize(img, size, reducing_gap)
+        else:
+            img = img.resize(size, resample=Image.BILINEAR, reducing_gap=reducing_gap)
+    return img, 1
 
 
 def get_font_path(font_name):
@@ -225,6 +564,20 @@ def get_font_path(font_name):
         return None
 
 
+@lru_cache(maxsize=settings.FONT_CACHE_SIZE)
+def get_font(font_name, font_size):
+    """
+    加载字体, 按(字体, 字号)缓存, 避免每次请求和每一帧都重新读取字体文件
+    @param font_name: 字体名
+    @param font_size: 字号
+    @return: 字体对象
+    """
+    font_path = get_font_path(font_name)
+    if font_path is None:
+        raise Exception("未找到字体文件")
+    return ImageFont.truetype(font_path, font_size)
+
+
 def get_position_mapping(position_text):
     """
     解析位置参数
@@ -257,200 +610,710 @@ def get_position_mapping(position_text):
 def watermark_handler(img, options=None):
     """
     水印处理
-    @param img_file: 图片
-    @param options: 参数组
+    @param img: 图片
+    @param options: 已编译的WatermarkOp, 也兼容未解析的参数字典
     @return:
     """
-    default_options = {'type': 'wqy-zenhei',  # 字体 TODO:暂时不支持字体选择
-                       'size': 40,  # 指定文字水印的文字大小。
-                       'text': '',  # 文本内容
-                       'color': 'FFFFFF',  # 字体颜色
-                       'shadow': 0,  # 指定文字水印的阴影透明度。
-                       'shadow_radius': 5,  # 模糊半径
-                       'shadow_x': 10,  # 阴影偏移量x
-                       'shadow_y': 10,  # 阴影偏移量y
-                       't': 0,  # 指定图片水印或水印文字的透明度。
-                       'g': 'se',  # 指定水印在图片中的位置。nw：左上 north：中上 ne：右上 west：左中 center：中部 east：右中 sw：左下 south：中下 se：右下
-                       'x': 0,  # x相对偏移量
-                       'y': 0,  # y相对偏移量
-                       'rotate': 0,  # 指定文字顺时针旋转角度。
-                       'image': None  # bucket/object_key, 例如 linyesh-mihoyo-origin-image/do-not-copy-g08c635b44_640.png
-                       }
-    options = {**default_options, **options}
-    print('合并：' + json.dumps(options))
+    if not isinstance(options, WatermarkOp):
+        options = parse_watermark(options or {})
     try:
-        position = get_position_mapping(options['g'])
-        if options['image'] is None:
+        position = get_position_mapping(options.g)
+        if options.image is None:
             print('开始处理文本水印')
-            font_path = get_font_path(options['type'])
-            font_size = int(options['size'])
-            font = ImageFont.truetype(font_path, font_size)
-            if font is None:
-                raise Exception("未找到字体文件")
-            alpha = int(float(options['t']) / 100.0 * 255)
-            text_color = ImageColor.getcolor('#' + options['color'], "RGB") + (alpha,)
+            font = get_font(options.type, options.size)
             result_img = text_watermark(img,
-                                        b64decode(options['text']).decode('utf-8'),
+                                        options.text,
                                         font=font,
-                                        text_color=text_color,
+                                        text_color=options.color,
                                         position=position,
-                                        x=int(options['x']),
-                                        y=int(options['y']),
-                                        shadow_radius=int(options['shadow_radius']),
-                                        shadow_x=int(options['shadow_x']),
-                                        shadow_y=int(options['shadow_y']),
-                                        rotate_angle=int(options['rotate']))
+                                        x=options.x,
+                                        y=options.y,
+                                        shadow_radius=options.shadow_radius,
+                                        shadow_x=options.shadow_x,
+                                        shadow_y=options.shadow_y,
+                                        rotate_angle=options.rotate,
+                                        mode=options.blend,
+                                        fill=options.fill,
+                                        padx=options.padx,
+                                        pady=options.pady)
         else:
             print('开始处理图片水印')
-            my_wm_file = os.path.join('/tmp/wm', time.time(), '.jpg')
-            img_sp = options['image'].split('/')
-            wm_bucket = img_sp[0]
-            wm_object_key = '/'.join(img_sp[1:])
+            wm_bucket, wm_object_key = options.image
             result_img = image_watermark(img,
-                                         wm_file=my_wm_file,
                                          wm_bucket=wm_bucket,
                                          wm_object_key=wm_object_key,
                                          position=position,
-                                         relative_x=options['x'],
-                                         relative_y=options['y'],
-                                         shadow_radius=options['shadow_radius'],
-                                         shadow_x=options['shadow_x'],
-                                         shadow_y=options['shadow_y'],
-                                         )
+                                         relative_x=options.x,
+                                         relative_y=options.y,
+                                         shadow_radius=options.shadow_radius,
+                                         shadow_x=options.shadow_x,
+                                         shadow_y=options.shadow_y,
+                                         opacity=options.opacity,
+                                         mode=options.blend,
+                                         fill=options.fill,
+                                         padx=options.padx,
+                                         pady=options.pady,
+                                         rotate_angle=options.rotate)
         return result_img
     except Exception as e:
         raise e
 
 
-def lambda_handler(event, context):
-    method = event['httpMethod']
-    parameters = []
-    body = json.loads(event['body'])
-    headers = event['headers']
-    img_bucket = body['origin-bucket']
-    img_key = body['origin-key']
-    if 'target-bucket' not in body:
-        target_bucket = img_bucket
+def download_image(img_bucket, img_key, session, size=None, etag=None):
+    """
+    从S3读取原图
+    memory模式下直接把get_object的内容读入内存, 对象超过MEMORY_MAX_BYTES或file模式时下载到本地文件,
+    超过TRANSFER_THRESHOLD的对象用并发的Range GET下载
+    @param img_bucket: 原图所在的S3 bucket
+    @param img_key: 原图的key
+    @param session: 本次请求的SpoolSession, 本地文件在请求结束时删除
+    @param size: 已知的对象大小, 超过MEMORY_MAX_BYTES时直接下载到本地文件
+    @param etag: 已知的ETag, 分片下载时保证各分片来自同一个对象
+    @return: 可以直接交给Image.open的文件对象或文件路径
+    """
+    in_memory = settings.IO_MODE != 'file' and (size is None or size <= settings.MEMORY_MAX_BYTES)
+    if size is not None and size >= settings.TRANSFER_THRESHOLD:
+        if in_memory:
+            return download_ranges(s3, img_bucket, img_key, size, etag)
+        session.reserve(size)
+        return download_ranges(s3, img_bucket, img_key, size, etag, session.path(img_bucket, img_key))
+
+    if in_memory:
+        response = s3.get_object(Bucket=img_bucket, Key=img_key)
+        if response['ContentLength'] <= settings.MEMORY_MAX_BYTES:
+            return io.BytesIO(response['Body'].read())
+        # 大文件退回到磁盘中转
+        response['Body'].close()
+        size = response['ContentLength']
+
+    if size is None:
+        size = s3.head_object(Bucket=img_bucket, Key=img_key)['ContentLength']
+    session.reserve(size)
+    img_file = session.path(img_bucket, img_key)
+    s3.download_file(img_bucket, img_key, img_file, Config=get_transfer_config(size))
+    return img_file
+
+
+def get_source_size(img_source):
+    """
+    @param img_source: download_image的返回值
+    @return: 原图的字节数
+    """
+    if isinstance(img_source, str):
+        return os.path.getsize(img_source)
+    if isinstance(img_source, io.BytesIO):
+        return img_source.getbuffer().nbytes
+    return len(img_source)  # 分片下载的mmap
+
+
+def upload_image(img_list, img_format, save_options, target_bucket, target_key, content_type, new_file_name,
+                 metrics=None):
+    """
+    编码并上传处理后的图片
+    @param img_list: 图片帧列表, 多于一帧时保存为动图
+    @param img_format: 输出格式, 例如JPEG
+    @param save_options: 编码参数, 例如quality或动图的duration
+    @param target_bucket: 目标bucket
+    @param target_key: 目标key
+    @param content_type: 上传时的ContentType
+    @param new_file_name: file模式下的本地文件路径
+    @param metrics: 记录编码和上传耗时的Metrics
+    @return: memory模式下编码后的内容, file模式下为None
+    """
+    metrics = metrics or Metrics()
+    if len(img_list) > 1:
+        save_options = {**save_options, 'append_images': img_list[1:]}
+
+    extra_args = get_upload_args(content_type)
+    if settings.IO_MODE == 'file':
+        with metrics.timer('EncodeTime'):
+            img_list[0].save(new_file_name, format=img_format, **save_options)
+        metrics.add('UploadBytes', os.path.getsize(new_file_name), 'Bytes')
+        with metrics.timer('UploadTime'):
+            s3.upload_file(new_file_name, target_bucket, target_key, ExtraArgs=extra_args,
+                           Config=get_transfer_config(os.path.getsize(new_file_name)))
+        return None
+
+    with metrics.timer('EncodeTime'):
+        buffer = io.BytesIO()
+        img_list[0].save(buffer, format=img_format, **save_options)
+        data = buffer.getvalue()
+    metrics.add('UploadBytes', len(data), 'Bytes')
+    with metrics.timer('UploadTime'):
+        s3.upload_fileobj(io.BytesIO(data), target_bucket, target_key, ExtraArgs=extra_args,
+                          Config=get_transfer_config(len(data)))
+    return data
+
+
+def get_upload_args(content_type):
+    """
+    上传结果时的参数, 打上已处理的标签
+    @param content_type: 上传时的ContentType
+    @return: ExtraArgs
+    """
+    tags = {"updated": "1", 'watermark': '1'}
+    return {
+        "Tagging": parse.urlencode(tags),
+        'ContentType': content_type
+    }
+
+
+def apply_operations(img, plan, start=0, metrics=None):
+    """
+    按顺序执行计划中的图片操作
+    @param img: 图片
+    @param plan: 已编译的处理计划
+    @param start: 从第几个操作开始执行
+    @param metrics: 记录各操作耗时的Metrics, 动图的各帧累加到同一个指标
+    @return: 处理后的图片
+    """
+    metrics = metrics or Metrics()
+    for op in plan.operations[start:]:
+        if isinstance(op, WatermarkOp):
+            with metrics.timer('ImageWatermarkTime' if op.image else 'TextWatermarkTime'):
+                img = watermark_handler(img, options=op)
+        elif isinstance(op, ResizeOp):
+            with metrics.timer('ResizeTime'):
+                img = image_resize_handler(img, options=op)
+    return img
+
+
+class ProcessError(Exception):
+    """
+    处理失败, 携带返回给调用方的状态码和信息
+    """
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def get_plan(process):
+    """
+    编译处理参数, 非法参数在下载原图之前就拒绝
+    @param process: x-s3-process参数
+    @return: 已编译的处理计划
+    """
+    try:
+        return compile_plan(process)
+    except (TypeError, PlanError) as e:
+        print('参数错误: %s' % e)
+        raise ProcessError('invalid parameters')
+
+
+def is_processed(img_bucket, img_key, etag):
+    """
+    检查原图是否已经处理过(带有updated=1标签), 结果按(bucket, key, ETag)缓存
+    @param img_bucket: 原图所在的bucket
+    @param img_key: 原图的key
+    @param etag: 原图的ETag, 内容变化后缓存自动失效
+    @return: 是否已经处理过
+    """
+    cache_key = (img_bucket, img_key, etag)
+    processed = tag_cache.get(cache_key)
+    if processed is None:
+        response = s3.get_object_tagging(Bucket=img_bucket, Key=img_key)
+        processed = any(tag['Key'] == 'updated' and tag['Value'] == '1' for tag in response['TagSet'])
+        tag_cache.put(cache_key, processed)
+    return processed
+
+
+class Output(object):
+    """
+    一个输出: 目标位置、处理计划, 以及下载前确定的输出格式和缓存状态
+    """
+
+    def __init__(self, target_bucket, target_key, plan):
+        self.target_bucket = target_bucket
+        self.target_key = target_key
+        self.plan = plan
+        self.img_format = None
+        self.content_type = None
+        self.cache_key = None
+        self.status = None
+
+    @property
+    def first_resize(self):
+        """
+        计划以缩放开始时的ResizeOp, 可以参与缩放级联
+        """
+        operations = self.plan.operations
+        return operations[0] if operations and isinstance(operations[0], ResizeOp) else None
+
+
+def prepare_outputs(info, outputs, accept, metrics):
+    """
+    根据图片头确定各输出的格式, 并在下载前检查图片大小
+    @param info: 图片头信息ImageInfo, 不是图片时为None
+    @param outputs: Output列表
+    @param accept: 请求的Accept头
+    @param metrics: Metrics
+    @return: 是否需要使用大图模式
+    """
+    if info is None:
+        raise ProcessError('invalid file format')
+    metrics.put('PixelCount', info.size[0] * info.size[1])
+    for output in outputs:
+        output.img_format, output.content_type = negotiate(output.plan.format, accept,
+                                                           (info.format, info.content_type))
+    metrics.properties['format'] = outputs[0].content_type
+    return any([check_image_size(info, output.plan, metrics) for output in outputs])
+
+
+@lru_cache(maxsize=None)
+def get_library_versions():
+    """
+    @return: 影响编码和混合结果的依赖版本, 读取安装信息, 不导入numpy
+    """
+    versions = []
+    for name in ('Pillow', 'numpy'):
+        try:
+            versions.append('%s=%s' % (name, metadata.version(name)))
+        except metadata.PackageNotFoundError:
+            versions.append('%s=none' % name)
+    return ','.join(versions)
+
+
+def get_render_version():
+    """
+    处理结果除了取决于原图、处理计划和水印素材, 还取决于运行参数、字体文件和依赖版本,
+    这些参与缓存key, 修改配置或部署后不会读到旧的处理结果
+    @return: 字符串
+    """
+    font_path = get_font_path('wqy-zenhei')
+    font = None
+    if font_path is not None:
+        stat = os.stat(font_path)
+        font = '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+    return json.dumps([RENDER_VERSION, settings.RESIZE_MODE, settings.BLEND_BACKEND, settings.LARGE_IMAGE_BYTES,
+                       font, get_library_versions()])
+
+
+def get_asset_versions(plan, asset_etags):
+    """
+    @param plan: 已编译的处理计划
+    @param asset_etags: 水印素材(bucket, key) -> ETag
+    @return: 计划中按顺序用到的图片水印及其ETag
+    """
+    return ['%s/%s:%s' % (op.image + (asset_etags[op.image],)) for op in plan.operations
+            if isinstance(op, WatermarkOp) and op.image]
+
+
+async def fetch_inputs(img_bucket, img_key, session, outputs, accept=None, metrics=None):
+    """
+    先检查原图是否已经处理过, 再用Range GET探测图片头并检查各输出是否有缓存的处理结果, 还有输出需要处理时再下载原图,
+    计划中用到的图片水印同时读取
+    @param img_bucket: 原图所在的bucket
+    @param img_key: 原图的key
+    @param session: 本次请求的SpoolSession
+    @param outputs: Output列表, 确定输出格式, 命中缓存的输出status设为cached
+    @param accept: 请求的Accept头
+    @param metrics: Metrics
+    @return: (原图, 是否使用大图模式, 状态), 状态为skipped或cached(全部命中缓存)时原图为None
+    """
+    metrics = metrics or Metrics()
+    images = sorted({op.image for output in outputs for op in output.plan.operations
+                     if isinstance(op, WatermarkOp) and op.image})
+    prefetch = asyncio.gather(*[aio.run(asset_cache.get, *image) for image in images])
+    try:
+        # 已经处理过的原图不传输任何内容, 探测之前先用HEAD的ETag检查标签
+        head = await aio.call('head_object', Bucket=img_bucket, Key=img_key)
+        if await aio.run(is_processed, img_bucket, img_key, head['ETag']):
+            return None, False, 'skipped'
+        probe = await aio.run(probe_object, s3, img_bucket, img_key, settings.PROBE_BYTES)
+        if probe.size == 0:
+            raise ProcessError('invalid file format')
+        metrics.put('ProbeBytes', len(probe.data), 'Bytes')
+
+        # 对象不超过探测长度时已经完整下载
+        img_source = io.BytesIO(probe.data) if len(probe.data) >= probe.size else None
+        info = probe.info
+        if info is None and img_source is None and has_image_signature(probe.data):
+            # JPEG的EXIF、ICC等APP段或TIFF末尾的IFD可能超出探测长度, 下载后再识别; 其它无法识别的内容直接拒绝
+            img_source = await aio.run(download_image, img_bucket, img_key, session, probe.size, probe.etag)
+            info = identify(img_source)
+            if not isinstance(img_source, str):
+                img_source.seek(0)
+        large = prepare_outputs(info, outputs, accept, metrics)
+
+        if derivative_store is not None:
+            # 水印素材在同一个key下被替换时处理结果也会变化, 素材的ETag参与缓存key
+            asset_etags = {image: etag for image, (_, etag) in zip(images, await prefetch)}
+
+            render_version = get_render_version()
+
+            async def fetch_cached(output):
+                output.cache_key = derivative_key(probe.etag, output.plan, output.content_type, render_version,
+                                                  *get_asset_versions(output.plan, asset_etags))
+                if await aio.run(derivative_store.fetch_to, s3, output.cache_key, output.target_bucket,
+                                 output.target_key, get_upload_args(output.content_type)):
+                    output.status = 'cached'
+
+            await asyncio.gather(*[fetch_cached(output) for output in outputs])
+            if all(output.status == 'cached' for output in outputs):
+                return None, large, 'cached'
+
+        if img_source is None:
+            img_source = await aio.run(download_image, img_bucket, img_key, session, probe.size, probe.etag)
+        await prefetch
+        return img_source, large, None
+    finally:
+        if not prefetch.done():
+            prefetch.cancel()
+        # 提前返回时没有等待水印素材, 取出结果, 避免asyncio报告未读取的异常
+        prefetch.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+
+async def upload_outputs(outputs, results, session, metrics):
+    """
+    并发编码和上传所有输出, 并写入处理结果缓存
+    @param outputs: Output列表
+    @param results: 与outputs对应的(帧列表, 编码参数)
+    @param session: 本次请求的SpoolSession, file模式下的结果文件在请求结束时删除
+    @param metrics: Metrics
+    """
+    async def upload(output, img_list, save_options):
+        new_file_name = session.path(output.target_bucket, output.target_key)
+        data = await aio.run(upload_image, img_list, output.img_format, save_options,
+                             output.target_bucket, output.target_key,
+                             content_type=output.content_type,
+                             new_file_name=new_file_name,
+                             metrics=metrics)
+        if output.cache_key is not None and data is not None:
+            await aio.run(derivative_store.store, s3, output.cache_key, data)
+
+    await asyncio.gather(*[upload(output, img_list, save_options)
+                           for output, (img_list, save_options) in zip(outputs, results)])
+
+
+def render_static(img, outputs, metrics, large=False):
+    """
+    解码一次并生成所有输出
+    以缩放开始的输出从大到小级联缩放, 每一级都从上一级未加水印的图片缩小, 其余输出从原图开始处理
+    @param img: 已打开但尚未解码的图片
+    @param outputs: Output列表
+    @param metrics: Metrics
+    @param large: 是否使用大图模式
+    @return: 与outputs顺序一致的处理结果
+    """
+    if len(outputs) == 1:
+        plan = outputs[0].plan
+        result, start = decode_image(img, plan, metrics, large)
+        if large and result is not img:
+            # 缩放后尽早释放原图
+            img.close()
+        return [apply_operations(result, plan, start, metrics)]
+
+    sizes = {id(output): get_resize_size(img.size, output.first_resize)
+             for output in outputs if output.first_resize is not None}
+    cascade = sorted([output for output in outputs if id(output) in sizes],
+                     key=lambda output: sizes[id(output)][0] * sizes[id(output)][1], reverse=True)
+    others = [output for output in outputs if id(output) not in sizes]
+
+    if others or not cascade:
+        with metrics.timer('DecodeTime'):
+            img.load()
+        base = img
     else:
-        target_bucket = body['target-bucket']
-    if 'target-key' not in body:
-        target_key = img_key
+        # 按最大的输出尺寸解码
+        base, _ = decode_image(img, Plan(target='image', operations=(cascade[0].first_resize,)), metrics, large)
+
+    results = {}
+    for output in others:
+        results[id(output)] = apply_operations(img.copy(), output.plan, 0, metrics)
+    for output in cascade:
+        size = sizes[id(output)]
+        if base.size != size:
+            with metrics.timer('ResizeTime'):
+                base = base.resize(size, resample=Image.BILINEAR,
+                                   reducing_gap=RESIZE_STRATEGIES[settings.RESIZE_MODE][1])
+        # 水印直接修改图片, 级联的基础图片保持不带水印
+        results[id(output)] = apply_operations(base.copy(), output.plan, 1, metrics)
+    return [results[id(output)] for output in outputs]
+
+
+def render_outputs(img, outputs, metrics, large=False):
+    """
+    对打开的原图执行各输出的处理计划
+    @param img: 已打开的原图
+    @param outputs: Output列表
+    @param metrics: Metrics
+    @param large: 是否使用大图模式
+    @return: 与outputs对应的(帧列表, 编码参数)
+    """
+    for output in outputs:
+        output.img_format = output.img_format or get_source_format(img.format)[0]
+    animated = [output for output in outputs if output.img_format in ANIMATED_FORMATS]
+    if not getattr(img, 'is_animated', False) or not animated:
+        results = [([result], get_save_options(output.img_format, output.plan.quality))
+                   for output, result in zip(outputs, render_static(img, outputs, metrics, large))]
     else:
-        target_key = body['target-key']
+        # 动图逐帧并行处理, 水印在缓存中只渲染一次
+        with metrics.timer('DecodeTime'):
+            frames, frame_options = read_frames(img)
+        # 多个输出共用解码后的帧, 水印直接修改图片, 需要先复制
+        copy = len(outputs) > 1
+        rendered = {}
+        for output in animated:
+            save_options = dict(frame_options, **get_save_options(output.img_format, output.plan.quality))
+            if output.img_format not in DISPOSAL_FORMATS:
+                save_options.pop('disposal', None)
+            rendered[output] = (process_frames(frames,
+                                               lambda frame, plan=output.plan: apply_operations(
+                                                   frame.copy() if copy else frame, plan, metrics=metrics),
+                                               settings.ANIMATION_WORKERS),
+                                save_options)
+        # 不支持动图的输出格式只使用第一帧
+        static = [output for output in outputs if output not in rendered]
+        if static:
+            for output, result in zip(static, render_static(frames[0].copy(), static, metrics, large)):
+                rendered[output] = ([result], get_save_options(output.img_format, output.plan.quality))
+        results = [rendered[output] for output in outputs]
+    results = [([prepare_frame(frame, output.img_format) for frame in img_list], save_options)
+               for output, (img_list, save_options) in zip(outputs, results)]
+    metrics.put('FrameCount', max(len(img_list) for img_list, _ in results))
+    return results
 
-    if 'x-s3-process' not in event['queryStringParameters']:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({
-                "message": 'invalid parameters',
-            }),
-        }
-    parameters = event['queryStringParameters']['x-s3-process'].split('/')
-    # print("parameters: %s" % parameters)
 
-    img_file = os.path.join(img_path, img_key)
-    process_target = parameters[0]
-    if process_target != 'image':
-        return {
-            "statusCode": 500,
-            "body": json.dumps({
-                "message": 'invalid parameters',
-            }),
-        }
+def process_file(src_file, dst_file, plan, metrics=None):
+    """
+    处理本地文件, 不经过S3, 用于批量重新处理本地目录
+    @param src_file: 原图路径
+    @param dst_file: 结果路径
+    @param plan: 已编译的处理计划
+    @param metrics: Metrics
+    @return: 结果的ContentType
+    """
+    metrics = metrics or Metrics()
+    output = Output(None, dst_file, plan)
+    large = prepare_outputs(identify(src_file), [output], None, metrics)
+    try:
+        img = Image.open(src_file)
+    except Image.DecompressionBombError:
+        raise ProcessError('image too large', 413)
+    with img:
+        [(img_list, save_options)] = render_outputs(img, [output], metrics, large)
+    if len(img_list) > 1:
+        save_options = {**save_options, 'append_images': img_list[1:]}
+    with metrics.timer('EncodeTime'):
+        img_list[0].save(dst_file, format=output.img_format, **save_options)
+    return output.content_type
 
-    # 从S3下载原图在本地进行处理
+
+def process_object(img_bucket, img_key, target_bucket, target_key, plan, accept=None, outputs=None):
+    """
+    处理一个S3对象: 下载原图, 执行处理计划并上传结果
+    @param img_bucket: 原图所在的bucket
+    @param img_key: 原图的key
+    @param target_bucket: 目标bucket
+    @param target_key: 目标key
+    @param plan: 已编译的处理计划
+    @param accept: 请求的Accept头, 用于format,auto
+    @param outputs: 多个输出时的Output列表, 此时忽略target_bucket, target_key和plan
+    @return: 包含message和各阶段耗时的字典
+    """
+    if outputs is None:
+        outputs = [Output(target_bucket, target_key, plan)]
+    metrics = Metrics(bucket=img_bucket, key=img_key, process=[output.plan.canonical() for output in outputs]
+                      if len(outputs) > 1 else outputs[0].plan.canonical())
+    # 容器的第一个请求带上冷启动的耗时和内存
+    cold_start = startup.values.pop('ColdStart', 0)
+    metrics.put('ColdStart', cold_start)
+    if cold_start:
+        for name, value in startup.values.items():
+            metrics.put(name, value, startup.units[name])
+    try:
+        with spool.session() as session:
+            result = _process_object(img_bucket, img_key, outputs, accept, metrics, session)
+        if len(outputs) > 1:
+            result['variants'] = [{'target-key': output.target_key, 'cached': output.status == 'cached'}
+                                  for output in outputs]
+        return result
+    except SpoolFull:
+        metrics.properties['error'] = 'insufficient storage'
+        raise ProcessError('insufficient storage', 507)
+    except Exception as e:
+        metrics.properties['error'] = getattr(e, 'message', str(e))
+        raise
+    finally:
+        metrics.emit()
+
+
+def _process_object(img_bucket, img_key, outputs, accept, metrics, session):
+    timings = {}
+    metrics.put('VariantCount', len(outputs))
+
+    # 从S3下载原图在本地进行处理, 图片已经处理过或者所有输出都有缓存的结果时不下载
+    # 输出格式根据图片头在下载前确定, 处理结果按输出的ContentType缓存
     t1 = time.time()
-    s3.download_file(img_bucket, img_key, img_file)
-    print('下载原图耗时%.3fs' % (time.time() - t1))
-    file_mine = guess_type(img_file)
-    (file_type, file_ext) = file_mine[0].split('/')
-    if file_type != 'image':
+    with metrics.timer('DownloadTime'):
+        img_source, large, status = asyncio.run(fetch_inputs(img_bucket, img_key, session, outputs,
+                                                             accept, metrics))
+    timings['download'] = round(time.time() - t1, 3)
+    metrics.put('SkippedCount', int(status == 'skipped'))
+    metrics.put('DerivativeCacheHit', sum(output.status == 'cached' for output in outputs))
+    if status is not None:
+        return {'message': 'OK', status: True, 'timings': timings}
+    metrics.put('DownloadBytes', get_source_size(img_source), 'Bytes')
+    pending = [output for output in outputs if output.status is None]
+    # 图像处理
+    t1 = time.time()
+    try:
+        result_img = Image.open(img_source)  # 打开图片, 只读取图片头
+    except Image.DecompressionBombError:
+        raise ProcessError('image too large', 413)
+    with result_img:
+        results = render_outputs(result_img, pending, metrics, large)
+        timings['process'] = round(time.time() - t1, 3)
+
+        # 图片上传
+        t1 = time.time()
+        asyncio.run(upload_outputs(pending, results, session, metrics))
+        timings['upload'] = round(time.time() - t1, 3)
+
+    metrics.properties['cache'] = {
+        'tile': tile_cache.stats(),
+        'asset': asset_cache.stats(),
+        'tag': tag_cache.stats(),
+        'derivative': derivative_store.stats() if derivative_store is not None else None,
+        'spool': spool.stats(),
+    }
+    return {'message': 'OK', 'timings': timings}
+
+
+def get_outputs(item, default_process=None):
+    """
+    解析多输出请求中的variants
+    @param item: 包含variants的请求项, 每个variant包含target-key, 可选target-bucket和x-s3-process
+    @param default_process: variant没有指定x-s3-process时使用的参数
+    @return: Output列表
+    """
+    variants = item['variants']
+    if not isinstance(variants, list) or not variants or len(variants) > settings.MAX_VARIANTS:
+        raise ProcessError('invalid parameters')
+    outputs = []
+    for variant in variants:
+        if not isinstance(variant, dict) or 'target-key' not in variant:
+            raise ProcessError('invalid parameters')
+        outputs.append(Output(variant.get('target-bucket', item.get('target-bucket', item['origin-bucket'])),
+                              variant['target-key'],
+                              get_plan(variant.get('x-s3-process', item.get('x-s3-process', default_process)))))
+    return outputs
+
+
+def process_item(item, default_process=None, accept=None):
+    """
+    处理请求体中的一项
+    @param item: 包含origin-bucket, origin-key, 可选target-bucket, target-key和x-s3-process,
+                 或者用variants列出多个输出
+    @param default_process: 该项没有指定x-s3-process时使用的参数
+    @param accept: 请求的Accept头
+    @return: process_object的结果
+    """
+    try:
+        img_bucket = item['origin-bucket']
+        img_key = item['origin-key']
+    except (KeyError, TypeError):
+        raise ProcessError('invalid parameters')
+    if 'variants' in item:
+        return process_object(img_bucket, img_key, None, None, None, accept,
+                              outputs=get_outputs(item, default_process))
+    plan = get_plan(item.get('x-s3-process', default_process))
+    return process_object(img_bucket,
+                          img_key,
+                          item.get('target-bucket', img_bucket),
+                          item.get('target-key', img_key),
+                          plan,
+                          accept)
+
+
+def get_header(event, name):
+    """
+    读取请求头, API Gateway转发的请求头大小写不固定
+    """
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def lambda_handler(event, context):
+    # PeakMemory只统计本次调用
+    reset_peak_memory()
+    body = json.loads(event['body'])
+    query = event.get('queryStringParameters') or {}
+    default_process = query.get('x-s3-process', body.get('x-s3-process'))
+    accept = get_header(event, 'accept')
+
+    if 'items' in body:
+        # 批量请求: {"items": [{"origin-bucket": ..., "origin-key": ..., "target-key": ..., "x-s3-process": ...}]}
+        items = body['items']
+        if not isinstance(items, list) or len(items) > settings.BATCH_MAX_ITEMS:
+            return {
+                "statusCode": 500,
+                "body": json.dumps({
+                    "message": 'invalid parameters',
+                }),
+            }
+        results = process_batch(items,
+                                lambda item: process_item(item, default_process, accept),
+                                settings.BATCH_CONCURRENCY)
+        all_ok = all(result['statusCode'] == 200 for result in results)
         return {
-            "statusCode": 500,
+            "statusCode": 200 if all_ok else 207,
             "body": json.dumps({
-                "message": 'invalid file format',
+                "message": "OK" if all_ok else "partial failure",
+                "items": results,
             }),
         }
-    # 图片已经处理过，则不操作
-    response = s3.get_object_tagging(
-        Bucket=img_bucket,
-        Key=img_key)
-    is_updated = False
-    for tag in response['TagSet']:
-        if tag['Key'] == 'updated' and tag['Value'] == '1':
-            is_updated = True
-            break
-    if is_updated:
+
+    try:
+        result = process_item(body, default_process, accept)
+    except ProcessError as e:
         return {
-            "statusCode": 200,
+            "statusCode": e.status_code,
             "body": json.dumps({
-                "message": 'OK',
+                "message": e.message,
             }),
         }
-    # 图像处理
-    with Image.open(img_file) as result_img:  # 打开图片
-        quality = 100
-        img_list = []
-        if file_ext == 'gif':
-            for f in ImageSequence.Iterator(result_img):
-                img_list.append(f.copy())
-        else:
-            img_list.append(result_img)
-
-
-        for i in range(len(img_list)):
-            cur_img = img_list[i]
-            for parameter in parameters[1:]:
-                op_list = parameter.split(',')
-                op = op_list[0]
-                op_parameter_dict = {}
-                for op_parameter in op_list[1:]:
-                    kp = op_parameter.split('_')
-                    op_parameter_dict[kp[0]] = kp[1]
-
-                if op == 'watermark':
-                    t1 = time.time()
-                    cur_img = watermark_handler(cur_img, options=op_parameter_dict)
-
-                    print('水印处理耗时%.3fs' % (time.time() - t1))
-                elif op == 'resize':
-                    t1 = time.time()
-                    cur_img = image_resize_handler(cur_img, options=op_parameter_dict)
-                    print('图片缩放处理耗时%.3fs' % (time.time() - t1))
-                elif op == 'quality':
-                    if 'q' in op_parameter_dict:
-                        quality = 100 * op_parameter_dict['q']
-                else:
-                    return {
-                        "statusCode": 500,
-                        "body": json.dumps({
-                            "message": 'invalid parameters',
-                        }),
-                    }
-                img_list[i] = cur_img
-        # 图片上传
-        if len(img_list) > 0:
-            new_file_name = os.path.join(save_path, img_file.split('/')[-1])
-            if len(img_list) == 1:
-                img_list[0].save(new_file_name, quality=quality)
-            else:
-                img_list[0].save(new_file_name,
-                                 append_images=img_list[1:],
-                                 save_all=True,
-                                 loop=0
-                                 )
-            tags = {"updated": "1", 'watermark': '1'}
-            s3.upload_file(new_file_name,
-                           target_bucket,
-                           target_key,
-                           ExtraArgs={
-                               "Tagging": parse.urlencode(tags),
-                               'ContentType': file_mine[0]
-                           })
 
+    response = {"message": "OK"}
+    if 'variants' in result:
+        response['variants'] = result['variants']
     return {
         "statusCode": 200,
-        "body": json.dumps({
-            "message": "OK"
-        }),
+        "body": json.dumps(response),
     }
+
+
+def prewarm():
+    """
+    在初始化阶段预加载第一个请求会用到的状态: Pillow的常用格式插件、numpy、字体和图片水印素材,
+    Lambda初始化阶段的耗时不计入请求的延迟, 预加载失败时只打印日志, 由请求时再次加载
+    """
+    Image.preinit()
+    if settings.BLEND_BACKEND == 'numpy':
+        get_numpy()
+    for font in settings.PREWARM_FONTS:
+        font_name, _, font_size = font.partition(':')
+        try:
+            get_font(font_name, int(font_size or WatermarkOp.size))
+        except Exception as e:
+            print('预加载字体失败: %s %s' % (font, e))
+    for asset in settings.PREWARM_ASSETS:
+        bucket, _, key = asset.partition('/')
+        try:
+            asset_cache.get(bucket, key)
+        except Exception as e:
+            print('预加载水印素材失败: %s %s' % (asset, e))
+
+
+# 执行初始化, 冷启动的耗时和内存记录在startup中, 随第一个请求的指标输出
+startup = Metrics()
+startup.put('ColdStart', 1)
+startup.put('ImportCpuTime', round(cpu_time_ms(), 3), 'Milliseconds')
+if settings.STARTUP_MODE == 'prewarm':
+    with startup.timer('PrewarmTime'):
+        prewarm()
+startup.put('InitMemory', round(peak_memory_mb(), 1), 'Megabytes')
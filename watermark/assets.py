@@ -0,0 +1,128 @@
+"""
+图片水印素材缓存
+
+从S3读取的水印图片解码为RGBA后保存在内存中, 按字节数限制容量并做LRU淘汰,
+每隔一段时间通过HEAD请求比对ETag, 素材被替换后自动重新下载;
+配置了磁盘缓存时原始文件同时保存在/tmp中, 内存中被淘汰后用HEAD确认ETag没有变化即可从磁盘读取
+"""
+import io
+import threading
+import time
+
+from PIL import Image
+
+try:
+    from .cache import LRUCache
+except ImportError:  # Lambda中作为顶层模块加载
+    from cache import LRUCache
+
+
+class WatermarkAsset(object):
+    """
+    缓存中的一个水印素材
+    """
+
+    def __init__(self, image, etag, checked_at):
+        self.image = image
+        self.etag = etag
+        self.checked_at = checked_at
+
+
+class WatermarkAssetCache(object):
+    """
+    按bucket/key缓存解码后的水印图片
+    """
+
+    def __init__(self, get_client, max_bytes, revalidate_seconds, spool=None):
+        """
+        @param get_client: 返回S3客户端的函数
+        @param max_bytes: 缓存容量(字节)
+        @param revalidate_seconds: 两次ETag校验之间的最短间隔
+        @param spool: 作为磁盘缓存的Spool, None时不使用磁盘缓存
+        """
+        self.get_client = get_client
+        self.revalidate_seconds = revalidate_seconds
+        self.spool = spool
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.disk_hits = 0
+        self._cache = LRUCache(max_bytes, sizeof=lambda asset: asset.image.size[0] * asset.image.size[1] * 4)
+        self._lock = threading.Lock()
+        self._download_lock = threading.Lock()
+
+    def get(self, bucket, key):
+        """
+        获取水印图片
+        @param bucket: 水印图所在的S3 bucket
+        @param key: 水印图的key
+        @return: (RGBA水印图片, ETag)
+        """
+        asset = self._cache.get((bucket, key))
+        now = time.monotonic()
+        if asset is not None:
+            if now - asset.checked_at < self.revalidate_seconds:
+                self._count('hits')
+                return asset.image, asset.etag
+            # 超过校验间隔, 用HEAD确认素材没有被替换
+            self._count('revalidations')
+            response = self.get_client().head_object(Bucket=bucket, Key=key)
+            if response['ETag'] == asset.etag:
+                asset.checked_at = now
+                self._count('hits')
+                return asset.image, asset.etag
+
+        with self._download_lock:
+            # 动图的多个帧同时未命中时只下载一次
+            cached = self._cache.get((bucket, key))
+            if cached is not None and cached is not asset:
+                self._count('hits')
+                return cached.image, cached.etag
+            self._count('misses')
+            data, etag = self._read_disk(bucket, key)
+            if data is None:
+                response = self.get_client().get_object(Bucket=bucket, Key=key)
+                data, etag = response['Body'].read(), response['ETag']
+                if self.spool is not None:
+                    self.spool.put(data, 'asset', bucket, key, info=etag)
+            with Image.open(io.BytesIO(data)) as watermark:
+                image = watermark.convert('RGBA')
+            self._cache.put((bucket, key), WatermarkAsset(image, etag, now))
+        return image, etag
+
+    def _read_disk(self, bucket, key):
+        """
+        @return: 磁盘缓存中ETag没有变化的原始文件和ETag, 没有时为(None, None)
+        """
+        if self.spool is None:
+            return None, None
+        cached = self.spool.get('asset', bucket, key)
+        if cached is None:
+            return None, None
+        data, etag = cached
+        if self.get_client().head_object(Bucket=bucket, Key=key)['ETag'] != etag:
+            return None, None
+        self._count('disk_hits')
+        return data, etag
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """
+        @return: 命中统计
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'disk_hits': self.disk_hits,
+            'hit_rate': self.hits / total if total else 0.0,
+            'items': len(self._cache),
+            'bytes': self._cache.current_bytes,
+        }
@@ -0,0 +1,47 @@
+"""
+批量处理
+
+一次调用处理多个对象, 在有限的线程数内让不同对象的下载、图片处理和上传相互重叠,
+编译好的处理计划和水印素材在各个对象之间共享
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_item(process_item, item):
+    """
+    处理单个对象并记录结果
+    @param process_item: 处理函数, 返回包含message和timings的字典, 失败时抛出异常
+    @param item: 请求中的一项
+    @return: 该项的处理结果
+    """
+    t1 = time.time()
+    # 不是对象的项由process_item报告参数错误, 不影响其它项
+    fields = item if isinstance(item, dict) else {}
+    result = {
+        'origin-key': fields.get('origin-key'),
+        'target-key': fields.get('target-key', fields.get('origin-key')),
+    }
+    try:
+        result.update(process_item(item))
+        result['statusCode'] = 200
+    except Exception as e:
+        print('批量处理失败 %s: %s' % (fields.get('origin-key'), e))
+        result['statusCode'] = getattr(e, 'status_code', 500)
+        result['message'] = getattr(e, 'message', str(e))
+    result.setdefault('timings', {})['total'] = round(time.time() - t1, 3)
+    return result
+
+
+def process_batch(items, process_item, concurrency):
+    """
+    并发处理所有对象, 单个对象失败不影响其它对象
+    @param items: 请求列表
+    @param process_item: 处理单个对象的函数
+    @param concurrency: 同时处理的对象数
+    @return: 与items顺序一致的结果列表
+    """
+    if concurrency <= 1 or len(items) <= 1:
+        return [run_item(process_item, item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+        return list(executor.map(lambda item: run_item(process_item, item), items))
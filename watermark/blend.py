@@ -0,0 +1,171 @@
+"""
+水印混合
+
+把RGBA水印按透明度和混合模式合成到图片上, 只处理水印与图片重叠的区域
+numpy后端按预乘alpha计算, 带透明通道的原图合成后仍保持正确的alpha;
+没有安装numpy或WATERMARK_BLEND_BACKEND=pillow时使用Pillow的paste和ImageChops
+numpy在第一次用到时才导入, 只有normal模式的不透明原图不需要导入numpy
+"""
+from functools import lru_cache
+
+from PIL import Image, ImageChops
+
+try:
+    from . import settings
+except ImportError:  # Lambda中作为顶层模块加载
+    import settings
+
+BLEND_MODES = ('normal', 'multiply', 'screen')
+# numpy后端支持的原图模式, 其它模式使用Pillow
+NUMPY_MODES = ('RGB', 'RGBA', 'L')
+# ImageChops不支持的高位深模式(16位PNG、TIFF), 转为8位会截断像素值, 只能按normal模式合成
+WIDE_MODES = ('I', 'F')
+# 定点数计算的小数位数, 与Pillow的AlphaComposite.c一致
+PRECISION_BITS = 7
+
+
+@lru_cache(maxsize=None)
+def get_numpy():
+    """
+    导入numpy, numpy是可选依赖
+    @return: numpy模块, 没有安装时为None
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def get_overlap(img_size, overlay_size, position):
+    """
+    @return: 水印与图片重叠的区域(left, top, right, bottom), 没有重叠时为None
+    """
+    box = (max(position[0], 0), max(position[1], 0),
+           min(position[0] + overlay_size[0], img_size[0]), min(position[1] + overlay_size[1], img_size[1]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
+
+def blend(img, overlay, position, opacity=100, mode='normal', backend=None):
+    """
+    合成水印
+    @param img: 原图, 直接在上面修改
+    @param overlay: RGBA水印
+    @param position: 水印左上角的位置
+    @param opacity: 整体不透明度 0-100
+    @param mode: 混合模式 normal, multiply, screen
+    @param backend: numpy或pillow, 默认使用WATERMARK_BLEND_BACKEND
+    @return: img
+    """
+    backend = backend or settings.BLEND_BACKEND
+    if backend != 'numpy' or img.mode not in NUMPY_MODES:
+        return pillow_blend(img, overlay, position, opacity, mode)
+    if mode == 'normal' and img.mode != 'RGBA':
+        # 不透明原图的normal模式两种实现逐像素一致, paste更快
+        return pillow_blend(img, overlay, position, opacity, mode)
+    if get_numpy() is None:
+        return pillow_blend(img, overlay, position, opacity, mode)
+    return numpy_blend(img, overlay, position, opacity, mode)
+
+
+def scale_alpha(overlay, opacity):
+    """
+    @return: alpha乘以不透明度后的水印
+    """
+    if opacity >= 100:
+        return overlay
+    overlay = overlay.copy()
+    overlay.putalpha(overlay.getchannel('A').point(lambda a: a * opacity // 100))
+    return overlay
+
+
+def pillow_blend(img, overlay, position, opacity=100, mode='normal'):
+    """
+    Pillow实现, normal模式与原来的paste结果一致, 高位深的原图不支持其它混合模式, 按normal模式合成
+    """
+    overlay = scale_alpha(overlay, opacity)
+    if mode == 'normal' or img.mode in WIDE_MODES or img.mode.startswith('I;'):
+        img.paste(overlay, position, overlay)
+        return img
+
+    box = get_overlap(img.size, overlay.size, position)
+    if box is None:
+        return img
+    overlay = overlay.crop((box[0] - position[0], box[1] - position[1], box[2] - position[0], box[3] - position[1]))
+    region = img.crop(box)
+    source = overlay.convert(region.mode)
+    mixed = ImageChops.multiply(region, source) if mode == 'multiply' else ImageChops.screen(region, source)
+    img.paste(mixed, box[:2], overlay)
+    return img
+
+
+def _shift_div255(value):
+    return ((value >> 8) + value) >> 8
+
+
+def _div255(value):
+    """
+    整数除以255并四舍五入, 与Pillow内部的DIV255一致
+    """
+    return _shift_div255(value + 128)
+
+
+def _mix(backdrop, source, mode):
+    if mode == 'multiply':
+        return _div255(backdrop * source)
+    if mode == 'screen':
+        return backdrop + source - _div255(backdrop * source)
+    return source
+
+
+def numpy_blend(img, overlay, position, opacity=100, mode='normal'):
+    """
+    numpy实现, 按W3C Compositing的source-over和可分离混合模式计算
+    重叠区域按STRIP_HEIGHT行分段计算, 中间数组占用的内存与水印高度无关
+    """
+    box = get_overlap(img.size, overlay.size, position)
+    if box is None:
+        return img
+    for top in range(box[1], box[3], settings.STRIP_HEIGHT):
+        _numpy_blend_box(img, overlay, position, (box[0], top, box[2], min(top + settings.STRIP_HEIGHT, box[3])),
+                         opacity, mode)
+    return img
+
+
+def _numpy_blend_box(img, overlay, position, box, opacity, mode):
+    np = get_numpy()
+    overlay = overlay.crop((box[0] - position[0], box[1] - position[1], box[2] - position[0], box[3] - position[1]))
+    overlay = overlay.convert('LA' if img.mode == 'L' else 'RGBA')
+    source = np.asarray(overlay, dtype=np.int32)
+    region = np.asarray(img.crop(box), dtype=np.int32)
+    if img.mode == 'L':
+        region = region[..., np.newaxis]
+
+    cs = source[..., :-1]
+    alpha_s = source[..., -1:]
+    if opacity < 100:
+        alpha_s = alpha_s * opacity // 100
+
+    if img.mode != 'RGBA':
+        # 不透明的原图: Co = Cb * (1 - as) + B(Cb, Cs) * as
+        cb = region
+        result = _div255(cb * (255 - alpha_s) + _mix(cb, cs, mode) * alpha_s)
+    else:
+        cb = region[..., :3]
+        alpha_b = region[..., 3:]
+        # 原图透明的部分按源颜色计算: Cs' = (1 - ab) * Cs + ab * B(Cb, Cs)
+        mixed = _div255(cs * (255 - alpha_b) + _mix(cb, cs, mode) * alpha_b)
+        # 预乘alpha的source-over, 定点数的计算方式与Image.alpha_composite一致
+        alpha_o255 = alpha_s * 255 + alpha_b * (255 - alpha_s)
+        coef1 = alpha_s.astype(np.int64) * (255 * 255 << PRECISION_BITS) // np.maximum(alpha_o255, 1)
+        coef2 = (255 << PRECISION_BITS) - coef1
+        color = _shift_div255(mixed * coef1 + cb * coef2 + (0x80 << PRECISION_BITS)) >> PRECISION_BITS
+        color = np.where(alpha_o255 > 0, color, 0)
+        result = np.concatenate([color, _shift_div255(alpha_o255 + 0x80)], axis=-1)
+
+    result = result.astype(np.uint8)
+    if img.mode == 'L':
+        result = result[..., 0]
+    img.paste(Image.fromarray(result, img.mode), box[:2])
@@ -0,0 +1,265 @@
+"""
+批量重新处理
+
+列出S3前缀或本地目录下的图片, 用进程池按同一个x-s3-process重新处理并写出结果,
+每处理完一个对象就追加到manifest, 中断后用同一个manifest重新运行时跳过已经完成的对象,
+结束时输出吞吐量(张/秒, MB/秒)
+
+    python -m watermark.bulk s3://images/origin/ s3://images/watermarked/ \\
+        --process image/watermark,text_xxx,g_se --workers 8 --manifest reprocess.jsonl
+    python -m watermark.bulk ./photos ./out --process image/resize,w_1080
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+try:
+    from . import settings
+    from .plan import compile_plan
+    from .s3io import create_client
+    from .server import create_pool
+except ImportError:  # 作为顶层模块加载
+    import settings
+    from plan import compile_plan
+    from s3io import create_client
+    from server import create_pool
+
+
+def get_app():
+    try:
+        from . import app
+    except ImportError:
+        import app
+    return app
+
+
+def parse_location(location):
+    """
+    @param location: s3://bucket/prefix 或本地目录
+    @return: ('s3', bucket, prefix) 或 ('local', 目录, '')
+    """
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return 's3', bucket, prefix
+    return 'local', location, ''
+
+
+def list_sources(source, suffixes, client=None):
+    """
+    列出需要处理的图片
+    @param source: parse_location的结果
+    @param suffixes: 只处理这些扩展名
+    @param client: S3客户端
+    @return: 按名称排序的(相对名称, 字节数)
+    """
+    kind, root, prefix = source
+    if kind == 's3':
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=root, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].lower().endswith(suffixes):
+                    yield obj['Key'][len(prefix):], obj['Size']
+        return
+    names = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(suffixes):
+                path = os.path.join(dirpath, filename)
+                names.append((os.path.relpath(path, root).replace(os.sep, '/'), os.path.getsize(path)))
+    yield from sorted(names)
+
+
+def parse_line(line):
+    """
+    @return: manifest中的一行, 进程被强制结束时最后一行可能不完整, 此时为None
+    """
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+class Manifest(object):
+    """
+    JSON行格式的进度文件, 第一行记录源、目标和处理参数, 之后每行是一个对象的处理结果
+    """
+
+    def __init__(self, path, header):
+        """
+        @param path: 文件路径
+        @param header: 本次运行的源、目标和处理参数, 与已有的manifest不一致时拒绝继续
+        """
+        self.path = path
+        self.done = set()
+        content = ''
+        if os.path.exists(path):
+            with open(path) as f:
+                content = f.read()
+        lines = [entry for entry in map(parse_line, content.splitlines()) if entry is not None]
+        if not lines:
+            # 新的manifest, 或者写第一行时进程被结束, 重新写入第一行
+            self._file = open(path, 'w')
+            self.record(header)
+            return
+        if lines[0] != header:
+            raise ValueError('manifest %s was written for %s' % (path, lines[0]))
+        # 失败的对象在重新运行时再次处理
+        self.done = {entry['name'] for entry in lines[1:] if entry['status'] != 'error'}
+        self._file = open(path, 'a')
+        if not content.endswith('\n'):
+            # 结束不完整的最后一行, 之后的记录从新的一行开始
+            self._file.write('\n')
+
+    def record(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def process_job(job):
+    """
+    在工作进程中处理一个对象
+    @param job: (源, 目标, 相对名称, 字节数, x-s3-process)
+    @return: 写入manifest的结果
+    """
+    (kind, root, prefix), (_, target_root, target_prefix), name, size, process = job
+    app = get_app()
+    entry = {'name': name, 'bytes': size}
+    try:
+        if kind == 's3':
+            result = app.process_item({'origin-bucket': root, 'origin-key': prefix + name,
+                                       'target-bucket': target_root, 'target-key': target_prefix + name}, process)
+            entry['status'] = 'skipped' if result.get('skipped') else 'ok'
+        else:
+            dst_file = os.path.join(target_root, name)
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+            app.process_file(os.path.join(root, name), dst_file, app.get_plan(process))
+            entry['status'] = 'ok'
+    except Exception as e:
+        entry['status'] = 'error'
+        entry['message'] = getattr(e, 'message', str(e))
+    return entry
+
+
+def run(jobs, executor, manifest, max_pending, progress_interval=None):
+    """
+    提交任务并记录结果, 同时进行的任务不超过max_pending, 列表很长时不会一次提交所有任务
+    @param jobs: process_job的参数
+    @param executor: 进程池
+    @param manifest: Manifest
+    @param max_pending: 最多同时提交的任务数
+    @param progress_interval: 输出进度的间隔(秒), None表示不输出
+    @return: 统计结果
+    """
+    counts = {'ok': 0, 'skipped': 0, 'error': 0}
+    processed_bytes = 0
+    t1 = last_progress = time.monotonic()
+    pending = set()
+
+    def collect(done):
+        nonlocal processed_bytes
+        for future in done:
+            entry = future.result()
+            manifest.record(entry)
+            counts[entry['status']] += 1
+            processed_bytes += entry['bytes']
+            if entry['status'] == 'error':
+                print('处理失败 %s: %s' % (entry['name'], entry['message']), file=sys.stderr)
+
+    try:
+        for job in jobs:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(process_job, job))
+            if progress_interval is not None and time.monotonic() - last_progress >= progress_interval:
+                last_progress = time.monotonic()
+                print('已处理 %d' % sum(counts.values()), file=sys.stderr)
+    finally:
+        # 中断时等待已提交的任务完成, 结果都写入manifest
+        collect(wait(pending)[0])
+
+    elapsed = time.monotonic() - t1
+    processed = sum(counts.values())
+    return {
+        'processed': processed,
+        'ok': counts['ok'],
+        'skipped': counts['skipped'],
+        'failed': counts['error'],
+        'elapsed_s': round(elapsed, 3),
+        'images_per_s': round(processed / elapsed, 3) if elapsed else 0.0,
+        'mb_per_s': round(processed_bytes / 1024.0 / 1024.0 / elapsed, 3) if elapsed else 0.0,
+    }
+
+
+def reprocess(source, target, process, executor, manifest_path, suffixes=settings.EVENT_SUFFIXES,
+              max_pending=64, client=None, progress_interval=None):
+    """
+    重新处理source下的所有图片, 跳过manifest中已经完成的对象
+    @param source: s3://bucket/prefix 或本地目录
+    @param target: 与source同类的目标位置
+    @param process: x-s3-process
+    @param executor: 进程池
+    @param manifest_path: manifest路径
+    @param suffixes: 只处理这些扩展名
+    @param max_pending: 最多同时提交的任务数
+    @param client: 列出S3对象用的客户端
+    @param progress_interval: 输出进度的间隔(秒)
+    @return: 统计结果
+    """
+    header = {'source': source, 'target': target, 'process': process}
+    source, target = parse_location(source), parse_location(target)
+    if source[0] != target[0]:
+        raise ValueError('source and target must both be S3 locations or both be local directories')
+    compile_plan(process)  # 参数错误时在提交任务之前报错
+    if source[0] == 's3' and client is None:
+        client = create_client()
+    manifest = Manifest(manifest_path, header)
+    resumed = len(manifest.done)
+    jobs = ((source, target, name, size, process) for name, size in list_sources(source, suffixes, client)
+            if name not in manifest.done)
+    try:
+        report = run(jobs, executor, manifest, max_pending, progress_interval)
+    finally:
+        manifest.close()
+    report['resumed'] = resumed
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='s3://bucket/prefix 或本地目录')
+    parser.add_argument('target', help='s3://bucket/prefix 或本地目录')
+    parser.add_argument('--process', required=True, help='x-s3-process, 例如 image/watermark,text_xxx')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='工作进程数')
+    parser.add_argument('--manifest', default='bulk-manifest.jsonl', help='进度文件, 中断后用同一个文件继续')
+    parser.add_argument('--suffixes', default=','.join(settings.EVENT_SUFFIXES), help='只处理这些扩展名')
+    parser.add_argument('--progress', type=float, default=10, help='输出进度的间隔(秒)')
+    args = parser.parse_args(argv)
+
+    # 每个对象的指标日志在批量处理时没有意义, 工作进程启动时继承环境变量
+    os.environ.setdefault('WATERMARK_METRICS_ENABLED', '0')
+    pool = create_pool(args.workers)
+    try:
+        report = reprocess(args.source, args.target, args.process, pool, args.manifest,
+                           tuple(args.suffixes.lower().split(',')), 4 * args.workers,
+                           progress_interval=args.progress)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print('已中断, 重新运行同样的命令继续处理', file=sys.stderr)
+        return 130
+    finally:
+        pool.shutdown()
+    print(json.dumps(report, indent=2))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
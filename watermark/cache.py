@@ -0,0 +1,100 @@
+"""
+进程内缓存
+"""
+import threading
+from collections import OrderedDict
+
+
+def image_nbytes(img):
+    """
+    估算解码后图片占用的内存
+    @param img: 图片
+    @return: 字节数
+    """
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+class LRUCache(object):
+    """
+    按总字节数限制容量的LRU缓存, 线程安全, 并记录命中统计
+    """
+
+    def __init__(self, max_bytes, sizeof=image_nbytes):
+        """
+        @param max_bytes: 缓存容量(字节), 超出后淘汰最久未使用的条目
+        @param sizeof: 计算单个值大小的函数
+        """
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value, size=None):
+        """
+        写入缓存, 单个值超过容量时不缓存
+        @param key: 键
+        @param value: 值
+        @param size: 值的大小, 默认由sizeof计算
+        @return: value
+        """
+        if size is None:
+            size = self.sizeof(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            self.current_bytes -= item[1]
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.current_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """
+        @return: 命中统计
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'items': len(self._items),
+            'bytes': self.current_bytes,
+        }
@@ -0,0 +1,209 @@
+"""
+处理结果缓存
+
+同一个原图(按ETag区分)用同一个处理计划和同样的水印素材得到的结果是确定的,
+以 hash(ETag + 规范化的处理计划 + 输出格式 + 水印素材的ETag) 为key缓存编码后的结果,
+命中时直接把缓存写到目标位置, 不再下载、解码和编码
+"""
+import hashlib
+import threading
+
+try:
+    from .cache import LRUCache
+except ImportError:  # Lambda中作为顶层模块加载
+    from cache import LRUCache
+
+
+def derivative_key(etag, plan, *extra):
+    """
+    计算处理结果的缓存key
+    @param etag: 原图的ETag
+    @param plan: 已编译的处理计划
+    @param extra: 其它影响输出的参数, 例如输出格式
+    @return: 十六进制的sha256
+    """
+    digest = hashlib.sha256()
+    for part in (etag, plan.canonical()) + tuple(str(value) for value in extra):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DerivativeStore(object):
+    """
+    处理结果缓存的基类
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def fetch_to(self, client, key, target_bucket, target_key, extra_args):
+        """
+        缓存命中时把结果写到目标位置
+        @param client: S3客户端
+        @param key: 缓存key
+        @param target_bucket: 目标bucket
+        @param target_key: 目标key
+        @param extra_args: 上传参数, 包含Tagging和ContentType
+        @return: 是否命中
+        """
+        hit = self._fetch_to(client, key, target_bucket, target_key, extra_args)
+        self._count('hits' if hit else 'misses')
+        return hit
+
+    def store(self, client, key, data):
+        """
+        保存处理结果
+        @param client: S3客户端
+        @param key: 缓存key
+        @param data: 编码后的结果
+        """
+        if self._store(client, key, data):
+            self._count('stores')
+
+    def _fetch_to(self, client, key, target_bucket, target_key, extra_args):
+        raise NotImplementedError
+
+    def _store(self, client, key, data):
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        @return: 命中统计
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class MemoryDerivativeStore(DerivativeStore):
+    """
+    进程内缓存, 按总字节数做LRU淘汰
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self._cache = LRUCache(max_bytes, sizeof=len)
+
+    def _fetch_to(self, client, key, target_bucket, target_key, extra_args):
+        data = self._cache.get(key)
+        if data is None:
+            return False
+        client.put_object(Bucket=target_bucket, Key=target_key, Body=data, **extra_args)
+        return True
+
+    def _store(self, client, key, data):
+        if len(data) > self._cache.max_bytes:
+            return False
+        self._cache.put(key, data)
+        return True
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(items=len(self._cache), bytes=self._cache.current_bytes, evictions=self._cache.evictions)
+        return stats
+
+
+class DiskDerivativeStore(DerivativeStore):
+    """
+    保存在/tmp中转目录中的缓存, 与中转文件共用Spool的容量, 按LRU淘汰
+    """
+
+    def __init__(self, spool):
+        super().__init__()
+        self.spool = spool
+
+    def _fetch_to(self, client, key, target_bucket, target_key, extra_args):
+        cached = self.spool.get('derivative', key)
+        if cached is None:
+            return False
+        client.put_object(Bucket=target_bucket, Key=target_key, Body=cached[0], **extra_args)
+        return True
+
+    def _store(self, client, key, data):
+        return self.spool.put(data, 'derivative', key)
+
+    def clear(self):
+        self.spool.clear()
+
+    def stats(self):
+        stats = super().stats()
+        spool_stats = self.spool.stats()
+        stats.update(items=spool_stats['items'], bytes=spool_stats['bytes'], evictions=spool_stats['evictions'])
+        return stats
+
+
+class S3DerivativeStore(DerivativeStore):
+    """
+    保存在S3指定前缀下的缓存, 命中时用服务端复制写到目标位置
+    过期清理交给该前缀的生命周期规则
+    """
+
+    def __init__(self, bucket, prefix, max_object_bytes):
+        """
+        @param bucket: 缓存所在的bucket
+        @param prefix: 缓存的key前缀
+        @param max_object_bytes: 超过该大小的结果不缓存
+        """
+        super().__init__()
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/') + '/' if prefix else ''
+        self.max_object_bytes = max_object_bytes
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def _fetch_to(self, client, key, target_bucket, target_key, extra_args):
+        try:
+            client.copy_object(Bucket=target_bucket,
+                               Key=target_key,
+                               CopySource={'Bucket': self.bucket, 'Key': self._object_key(key)},
+                               MetadataDirective='REPLACE',
+                               TaggingDirective='REPLACE',
+                               **extra_args)
+        except client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+        return True
+
+    def _store(self, client, key, data):
+        if len(data) > self.max_object_bytes:
+            return False
+        client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=data)
+        return True
+
+
+def create_store(backend, max_bytes, s3_bucket=None, s3_prefix='', spool=None):
+    """
+    按配置创建处理结果缓存
+    @param backend: none, memory, disk 或 s3
+    @param max_bytes: memory时为总容量, s3时为单个结果的大小上限
+    @param s3_bucket: s3时缓存所在的bucket
+    @param s3_prefix: s3时缓存的key前缀
+    @param spool: disk时保存缓存文件的Spool
+    @return: DerivativeStore, 不启用时为None
+    """
+    if backend == 'memory':
+        return MemoryDerivativeStore(max_bytes)
+    if backend == 'disk':
+        return DiskDerivativeStore(spool)
+    if backend == 's3':
+        if not s3_bucket:
+            raise ValueError('s3 derivative cache requires a bucket')
+        return S3DerivativeStore(s3_bucket, s3_prefix, max_bytes)
+    return None
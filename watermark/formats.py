@@ -0,0 +1,125 @@
+"""
+输出格式
+
+根据format参数和请求的Accept头确定输出格式, 并给出各格式的编码参数:
+JPEG使用渐进式和优化的哈夫曼表, WebP和AVIF在相同画质下体积更小
+"""
+from PIL import Image, features
+
+# Pillow识别出的格式名 -> 输出使用的格式名, 带MPF段的相机照片被识别为MPO, 实际上是JPEG
+SOURCE_FORMATS = {
+    'MPO': 'JPEG',
+    'DIB': 'BMP',
+}
+# format参数的取值 -> (Pillow的格式名, ContentType)
+FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+    'gif': ('GIF', 'image/gif'),
+}
+# format,auto时按顺序选择浏览器支持的格式
+AUTO_FORMATS = ('avif', 'webp')
+# 不支持透明通道的格式
+OPAQUE_FORMATS = ('JPEG',)
+
+
+def get_source_format(img_format):
+    """
+    原图格式对应的输出格式
+    @param img_format: Pillow识别出的格式名
+    @return: (Pillow的格式名, ContentType)
+    """
+    img_format = SOURCE_FORMATS.get(img_format, img_format)
+    return img_format, Image.MIME.get(img_format)
+
+
+def is_available(fmt):
+    """
+    当前环境是否能编码该格式, AVIF需要Pillow 11.2以上或pillow-avif-plugin
+    @param fmt: format参数的取值
+    """
+    if fmt == 'webp':
+        return features.check('webp')
+    if fmt == 'avif':
+        if features.check('avif'):
+            return True
+        try:
+            import pillow_avif  # noqa: F401 注册AVIF插件
+        except ImportError:
+            return False
+        return True
+    return fmt in FORMATS
+
+
+def accepts(accept, content_type):
+    """
+    Accept头中是否明确包含该类型
+    @param accept: Accept头, 例如 image/avif,image/webp,*/*
+    @param content_type: 例如 image/webp
+    """
+    for item in (accept or '').split(','):
+        media_type, *params = item.split(';')
+        if media_type.strip().lower() == content_type and get_quality(params) > 0:
+            return True
+    return False
+
+
+def get_quality(params):
+    """
+    @param params: 媒体类型后面的参数, 例如 [' q=0.8']
+    @return: q值, 没有q参数时为1, 无法解析时为0
+    """
+    for param in params:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                return float(value.strip())
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def negotiate(fmt, accept, source):
+    """
+    确定输出格式
+    @param fmt: format参数, None表示保持原图格式, auto表示按Accept头选择
+    @param accept: 请求的Accept头
+    @param source: 原图的(Pillow的格式名, ContentType)
+    @return: (Pillow的格式名, ContentType)
+    """
+    if fmt is None:
+        return source
+    if fmt == 'auto':
+        for candidate in AUTO_FORMATS:
+            if accepts(accept, FORMATS[candidate][1]) and is_available(candidate):
+                return FORMATS[candidate]
+        return source
+    return FORMATS[fmt]
+
+
+def get_save_options(img_format, quality):
+    """
+    各格式的编码参数
+    @param img_format: Pillow的格式名
+    @param quality: 1-100
+    @return: save的参数
+    """
+    if img_format == 'JPEG':
+        return {'quality': quality, 'optimize': True, 'progressive': True}
+    if img_format == 'WEBP':
+        return {'quality': quality, 'method': 4}
+    if img_format == 'AVIF':
+        return {'quality': quality, 'speed': 6}
+    return {}
+
+
+def prepare_frame(img, img_format):
+    """
+    转换为目标格式能保存的模式, 例如带透明通道的PNG转为JPEG
+    """
+    if img_format in OPAQUE_FORMATS and img.mode not in ('RGB', 'L', 'CMYK'):
+        return img.convert('RGB')
+    return img
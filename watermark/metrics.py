@@ -0,0 +1,144 @@
+"""
+处理指标
+
+每个请求记录一组指标, 以CloudWatch Embedded Metric Format(EMF)的JSON行输出到日志,
+CloudWatch会自动从日志中提取指标; 同时保存在进程内的collector中, 方便测试和本地排查
+"""
+import json
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    from . import settings
+except ImportError:  # Lambda中作为顶层模块加载
+    import settings
+
+
+def reset_peak_memory():
+    """
+    重置进程的峰值RSS, Lambda的容器在多次调用之间复用, 不重置时每次调用都报告之前最大的峰值;
+    只有Linux支持, 写入/proc/self/clear_refs重置VmHWM
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb():
+    """
+    @return: 上次reset_peak_memory以来的峰值RSS(MB), 不支持重置时为进程启动以来的峰值
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS返回字节, Linux返回KB
+    return rss / 1024.0 / 1024.0 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def cpu_time_ms():
+    """
+    @return: 进程启动以来占用的CPU时间(毫秒), 包括解释器启动和模块导入
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (usage.ru_utime + usage.ru_stime) * 1000
+
+
+class Metrics(object):
+    """
+    一次请求的指标, 线程安全, 动图的多个帧可以同时累加
+    """
+
+    def __init__(self, **properties):
+        """
+        @param properties: 随指标一起输出但不作为指标的属性, 例如bucket和key
+        """
+        self.values = {}
+        self.units = {}
+        self.properties = dict(properties)
+        self._lock = threading.Lock()
+
+    def put(self, name, value, unit='Count'):
+        """
+        设置指标
+        """
+        with self._lock:
+            self.values[name] = value
+            self.units[name] = unit
+
+    def add(self, name, value, unit='Count'):
+        """
+        累加指标, 例如同一请求中多个水印操作的耗时
+        """
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    @contextmanager
+    def timer(self, name):
+        """
+        记录代码块的耗时(毫秒), 多次进入时累加
+        """
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, round((time.perf_counter() - t1) * 1000, 3), 'Milliseconds')
+
+    def to_emf(self):
+        """
+        @return: EMF格式的日志内容
+        """
+        with self._lock:
+            record = dict(self.properties)
+            record.update(self.values)
+            record[settings.METRICS_DIMENSION] = settings.METRICS_FUNCTION_NAME
+            record['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': settings.METRICS_NAMESPACE,
+                    'Dimensions': [[settings.METRICS_DIMENSION]],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in sorted(self.units.items())],
+                }],
+            }
+        return record
+
+    def emit(self):
+        """
+        输出到日志并保存到collector
+        """
+        self.put('PeakMemory', round(peak_memory_mb(), 1), 'Megabytes')
+        collector.append(self)
+        if settings.METRICS_ENABLED:
+            print(json.dumps(self.to_emf(), ensure_ascii=False, default=str))
+
+
+class MetricsCollector(object):
+    """
+    保存最近的若干条请求指标
+    """
+
+    def __init__(self, max_records):
+        self.records = deque(maxlen=max_records)
+
+    def append(self, metrics):
+        self.records.append(metrics)
+
+    def last(self):
+        return self.records[-1] if self.records else None
+
+    def clear(self):
+        self.records.clear()
+
+
+collector = MetricsCollector(settings.METRICS_COLLECTOR_SIZE)
@@ -0,0 +1,283 @@
+"""
+x-s3-process 参数解析
+
+把形如 image/resize,w_1080,h_900/watermark,text_xxx,g_se 的处理参数编译成不可变的操作计划,
+编译结果按原始字符串缓存, 热容器中同一参数只解析一次
+"""
+import json
+from base64 import b64decode
+from binascii import Error as Base64Error
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from PIL import ImageColor
+
+try:
+    from . import settings
+    from .blend import BLEND_MODES
+    from .formats import FORMATS, is_available
+except ImportError:  # Lambda中作为顶层模块加载
+    import settings
+    from blend import BLEND_MODES
+    from formats import FORMATS, is_available
+
+POSITIONS = ('nw', 'north', 'ne', 'west', 'center', 'east', 'sw', 'south', 'se')
+
+
+class PlanError(ValueError):
+    """
+    处理参数不合法
+    """
+
+
+@dataclass(frozen=True)
+class ResizeOp:
+    w: int = 0  # 目标宽度
+    h: int = 0  # 目标高度
+
+
+@dataclass(frozen=True)
+class WatermarkOp:
+    type: str = 'wqy-zenhei'  # 字体 TODO:暂时不支持字体选择
+    size: int = 40  # 文字水印的文字大小
+    text: str = ''  # 已解码的文本内容
+    color: Tuple[int, int, int, int] = (255, 255, 255, 0)  # 文字颜色(R,G,B,A), A由t换算
+    shadow: int = 0  # 文字水印的阴影透明度
+    shadow_radius: int = 5  # 模糊半径
+    shadow_x: int = 10  # 阴影偏移量x
+    shadow_y: int = 10  # 阴影偏移量y
+    t: Optional[int] = None  # 水印的不透明度 0-100, 文字水印未指定时按0处理, 图片水印未指定时不透明
+    g: str = 'se'  # 水印在图片中的位置
+    x: int = 0  # x相对偏移量
+    y: int = 0  # y相对偏移量
+    rotate: int = 0  # 文字顺时针旋转角度
+    image: Optional[Tuple[str, str]] = None  # 图片水印的(bucket, object_key)
+    blend: str = 'normal'  # 混合模式 normal, multiply, screen
+    fill: int = 0  # 1表示把水印平铺到整张图片
+    padx: int = 100  # 平铺时水印之间的水平间距
+    pady: int = 100  # 平铺时水印之间的垂直间距
+
+    @property
+    def opacity(self):
+        """
+        合成时的整体不透明度, 文字水印的透明度已经包含在color中
+        """
+        if self.image is None or self.t is None:
+            return 100
+        return self.t
+
+
+@dataclass(frozen=True)
+class QualityOp:
+    q: int = 100  # 输出质量 1-100
+
+
+@dataclass(frozen=True)
+class FormatOp:
+    f: str = 'auto'  # 输出格式, auto表示按Accept头选择
+
+
+@dataclass(frozen=True)
+class Plan:
+    target: str
+    operations: tuple
+
+    @property
+    def quality(self):
+        """
+        计划中最后一个quality操作指定的质量, 默认100
+        """
+        quality = 100
+        for op in self.operations:
+            if isinstance(op, QualityOp):
+                quality = op.q
+        return quality
+
+    @property
+    def format(self):
+        """
+        计划中最后一个format操作指定的格式, 没有时为None(保持原图格式)
+        """
+        fmt = None
+        for op in self.operations:
+            if isinstance(op, FormatOp):
+                fmt = op.f
+        return fmt
+
+    def canonical(self):
+        """
+        规范化的计划文本, 与参数顺序和省略的默认值无关
+        """
+        return json.dumps([self.target] + [[type(op).__name__, asdict(op)] for op in self.operations],
+                          sort_keys=True, ensure_ascii=False)
+
+
+def decode_base64(value):
+    """
+    解码base64参数, 兼容url安全字符和省略的padding
+    @param value: base64文本
+    @return: 解码后的字符串
+    """
+    try:
+        return b64decode(value + '=' * (-len(value) % 4), altchars=b'-_').decode('utf-8')
+    except (Base64Error, UnicodeDecodeError):
+        raise PlanError('invalid base64 value: %s' % value)
+
+
+def _int(options, key, default, minimum=None, maximum=None):
+    value = options.get(key, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise PlanError('%s must be an integer' % key)
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise PlanError('%s out of range: %d' % (key, value))
+    return value
+
+
+def parse_resize(options):
+    """
+    解析缩放参数
+    @param options: 参数字典
+    @return: ResizeOp
+    """
+    op = ResizeOp(w=_int(options, 'w', 0, minimum=0, maximum=settings.MAX_DIMENSION),
+                  h=_int(options, 'h', 0, minimum=0, maximum=settings.MAX_DIMENSION))
+    if op.w == 0 and op.h == 0:
+        raise PlanError('resize requires w or h')
+    return op
+
+
+def parse_watermark(options):
+    """
+    解析水印参数, 合并默认值并解码文本和图片地址
+    @param options: 参数字典
+    @return: WatermarkOp
+    """
+    default = WatermarkOp()
+    t = _int(options, 't', 0, minimum=0, maximum=100) if 't' in options else default.t
+    image = None
+    if options.get('image'):
+        # bucket/object_key 的base64编码, 例如 linyesh-mihoyo-origin-image/do-not-copy-g08c635b44_640.png
+        bucket, _, key = decode_base64(options['image']).partition('/')
+        if not bucket or not key:
+            raise PlanError('image must be bucket/object_key')
+        image = (bucket, key)
+    text = decode_base64(options['text']) if options.get('text') else default.text
+    try:
+        rgb = ImageColor.getcolor('#' + options.get('color', 'FFFFFF'), 'RGB')
+    except ValueError:
+        raise PlanError('invalid color: %s' % options.get('color'))
+    position = options.get('g', default.g)
+    if position not in POSITIONS:
+        raise PlanError('invalid position: %s' % position)
+
+    blend = options.get('blend', default.blend)
+    if blend not in BLEND_MODES:
+        raise PlanError('invalid blend mode: %s' % blend)
+
+    font_type = decode_base64(options['type']) if options.get('type') else default.type
+    return WatermarkOp(type=font_type,
+                       size=_int(options, 'size', default.size, minimum=1, maximum=1000),
+                       text=text,
+                       color=rgb + (int((t or 0) / 100.0 * 255),),
+                       shadow=_int(options, 'shadow', default.shadow, minimum=0, maximum=100),
+                       shadow_radius=_int(options, 'shadow_radius', default.shadow_radius, minimum=0, maximum=100),
+                       shadow_x=_int(options, 'shadow_x', default.shadow_x),
+                       shadow_y=_int(options, 'shadow_y', default.shadow_y),
+                       t=t,
+                       g=position,
+                       x=_int(options, 'x', default.x),
+                       y=_int(options, 'y', default.y),
+                       rotate=_int(options, 'rotate', default.rotate, minimum=0, maximum=360),
+                       image=image,
+                       blend=blend,
+                       fill=_int(options, 'fill', default.fill, minimum=0, maximum=1),
+                       padx=_int(options, 'padx', default.padx, minimum=0, maximum=settings.MAX_DIMENSION),
+                       pady=_int(options, 'pady', default.pady, minimum=0, maximum=settings.MAX_DIMENSION))
+
+
+def parse_quality(options):
+    """
+    解析质量参数
+    @param options: 参数字典
+    @return: QualityOp
+    """
+    return QualityOp(q=_int(options, 'q', 100, minimum=1, maximum=100))
+
+
+def parse_format(options):
+    """
+    解析输出格式参数, 例如 format,webp 或 format,auto
+    @param options: 参数字典
+    @return: FormatOp
+    """
+    fmt = options.get('f', 'auto').lower()
+    if fmt != 'auto' and fmt not in FORMATS:
+        raise PlanError('unsupported format: %s' % fmt)
+    if fmt != 'auto' and not is_available(fmt):
+        raise PlanError('format not available: %s' % fmt)
+    return FormatOp(f=fmt)
+
+
+OPERATION_PARSERS = {
+    'resize': parse_resize,
+    'watermark': parse_watermark,
+    'quality': parse_quality,
+    'format': parse_format,
+}
+# 可以直接写值的操作, 例如 format,webp 等同于 format,f_webp
+BARE_OPTIONS = {
+    'format': 'f',
+}
+
+
+# 本身带下划线的参数名
+COMPOUND_KEYS = ('shadow_radius', 'shadow_x', 'shadow_y')
+
+
+def split_option(op_parameter, bare_key=None):
+    """
+    拆分k_v形式的参数, 值中可以包含下划线(例如url安全的base64)
+    @param op_parameter: 例如 w_300, shadow_radius_5
+    @param bare_key: 参数只有值时使用的key
+    @return: (key, value)
+    """
+    for key in COMPOUND_KEYS:
+        if op_parameter.startswith(key + '_'):
+            return key, op_parameter[len(key) + 1:]
+    key, sep, value = op_parameter.partition('_')
+    if not sep:
+        if bare_key is not None:
+            return bare_key, op_parameter
+        raise PlanError('invalid option: %s' % op_parameter)
+    return key, value
+
+
+@lru_cache(maxsize=settings.PLAN_CACHE_SIZE)
+def compile_plan(process):
+    """
+    编译x-s3-process参数
+    @param process: 原始参数, 例如 image/resize,w_300/watermark,text_xxx
+    @return: Plan
+    """
+    if not process:
+        raise PlanError('empty process')
+    segments = process.split('/')
+    if segments[0] != 'image':
+        raise PlanError('unsupported process target: %s' % segments[0])
+
+    operations = []
+    for segment in segments[1:]:
+        op_list = segment.split(',')
+        parser = OPERATION_PARSERS.get(op_list[0])
+        if parser is None:
+            raise PlanError('unsupported operation: %s' % op_list[0])
+        options = {}
+        for op_parameter in op_list[1:]:
+            key, value = split_option(op_parameter, BARE_OPTIONS.get(op_list[0]))
+            options[key] = value
+        operations.append(parser(options))
+
+    return Plan(target=segments[0], operations=tuple(operations))
@@ -0,0 +1,78 @@
+"""
+图片头探测
+
+用Range GET读取对象开头的几KB, 从图片头中识别格式、尺寸、帧数和颜色模式,
+不是图片的对象在完整下载之前就拒绝; 对象不超过探测长度时探测到的内容就是完整的原图
+"""
+import io
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+from PIL import Image, UnidentifiedImageError
+
+try:
+    from .formats import get_source_format
+except ImportError:  # Lambda中作为顶层模块加载
+    from formats import get_source_format
+
+# 图片头中的信息, format和content_type是输出时使用的格式, n_frames为None表示探测的内容不完整, 无法统计帧数
+ImageInfo = namedtuple('ImageInfo', ['format', 'content_type', 'size', 'mode', 'n_frames'])
+# etag: 对象的ETag, size: 对象的总长度, data: 探测到的内容, info: ImageInfo, 无法识别时为None
+ProbeResult = namedtuple('ProbeResult', ['etag', 'size', 'data', 'info'])
+
+
+def identify(source, complete=True):
+    """
+    识别图片头, 不解码像素
+    @param source: 文件对象或文件路径
+    @param complete: 内容是否完整, 不完整时不统计动图的帧数
+    @return: ImageInfo, 不是图片时为None
+    """
+    try:
+        with Image.open(source) as img:
+            n_frames = None
+            if complete:
+                n_frames = getattr(img, 'n_frames', 1)
+            elif not hasattr(img, 'n_frames'):
+                n_frames = 1
+            return ImageInfo(*get_source_format(img.format), img.size, img.mode, n_frames)
+    except (UnidentifiedImageError, OSError, SyntaxError, EOFError, ValueError):
+        return None
+
+
+def has_image_signature(data):
+    """
+    Pillow的格式插件是否认得内容开头的签名, 认得签名但无法识别说明图片头超出了探测长度
+    @param data: 探测到的内容
+    """
+    Image.init()
+    prefix = data[:16]  # 与Image.open传给插件的长度一致
+    for _, accept in Image.OPEN.values():
+        try:
+            if accept is not None and accept(prefix):
+                return True
+        except Exception:
+            continue
+    return False
+
+
+def probe_object(client, bucket, key, probe_bytes):
+    """
+    读取对象开头的probe_bytes字节并识别图片头
+    @param client: S3客户端
+    @param bucket: bucket
+    @param key: key
+    @param probe_bytes: 探测长度
+    @return: ProbeResult
+    """
+    try:
+        response = client.get_object(Bucket=bucket, Key=key, Range='bytes=0-%d' % (probe_bytes - 1))
+    except ClientError as e:
+        # 空对象不支持Range
+        if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+            return ProbeResult(None, 0, b'', None)
+        raise
+    data = response['Body'].read()
+    content_range = response.get('ContentRange')  # bytes 0-65535/1234567
+    size = int(content_range.rsplit('/', 1)[1]) if content_range else len(data)
+    return ProbeResult(response['ETag'], size, data, identify(io.BytesIO(data), complete=len(data) >= size))
@@ -0,0 +1,100 @@
+"""
+S3上传事件
+
+直接在进程内调用水印处理, 支持S3直接触发和经过SQS批量投递的S3通知
+下载前先按扩展名、大小和updated标签过滤, SQS消息按batchItemFailures报告部分失败
+"""
+import json
+from urllib.parse import unquote_plus
+
+try:
+    from . import app, settings
+    from .batch import process_batch
+    from .metrics import reset_peak_memory
+except ImportError:  # Lambda中作为顶层模块加载
+    import app
+    import settings
+    from batch import process_batch
+    from metrics import reset_peak_memory
+
+
+def get_s3_records(event):
+    """
+    展开事件中的S3记录
+    @param event: S3事件或SQS事件
+    @return: ([(SQS messageId或None, S3记录)], 无法解析的SQS消息的messageId)
+    """
+    records = []
+    invalid = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                body = json.loads(record['body'])
+                # 配置通知时S3发送的测试消息没有Records
+                s3_records = body.get('Records', [])
+                for s3_record in s3_records:
+                    # 缺少bucket或key的记录同样按格式错误处理
+                    s3_record['s3']['bucket']['name'], s3_record['s3']['object']['key']
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                # 单条消息格式错误时只让这条消息重试, 不影响同一批中的其它消息
+                print('无法解析的SQS消息 %s: %s' % (record['messageId'], e))
+                invalid.append(record['messageId'])
+                continue
+            records.extend((record['messageId'], s3_record) for s3_record in s3_records)
+        elif record.get('eventSource') == 'aws:s3':
+            records.append((None, record))
+    return records, invalid
+
+
+def should_process(s3_record):
+    """
+    下载前过滤: 只处理新建的、扩展名和大小符合要求并且没有处理过的图片
+    @param s3_record: S3事件记录
+    @return: 是否需要处理
+    """
+    if not s3_record.get('eventName', '').startswith('ObjectCreated:'):
+        return False
+    key = unquote_plus(s3_record['s3']['object']['key'])
+    if not key.lower().endswith(settings.EVENT_SUFFIXES):
+        return False
+    size = s3_record['s3']['object'].get('size', 0)
+    if size <= 0 or size > settings.EVENT_MAX_BYTES:
+        return False
+    etag = s3_record['s3']['object'].get('eTag')
+    if etag is None:
+        return True
+    # 事件中的eTag不带引号, 与get_object返回的ETag统一后共用标签缓存
+    return not app.is_processed(s3_record['s3']['bucket']['name'], key, '"%s"' % etag)
+
+
+def process_record(item):
+    """
+    过滤并原地处理一个上传的对象, 处理结果带有updated标签, 再次触发的事件会被过滤掉
+    @param item: 包含origin-bucket, origin-key和S3记录
+    @return: process_item的结果
+    """
+    if not should_process(item['record']):
+        return {'message': 'OK', 'filtered': True}
+    return app.process_item({'origin-bucket': item['origin-bucket'], 'origin-key': item['origin-key']},
+                            settings.EVENT_PROCESS)
+
+
+def lambda_handler(event, context):
+    if not settings.EVENT_PROCESS:
+        raise ValueError('WATERMARK_PROCESS is not configured')
+
+    reset_peak_memory()
+    records, invalid = get_s3_records(event)
+    items = [{'origin-bucket': s3_record['s3']['bucket']['name'],
+              'origin-key': unquote_plus(s3_record['s3']['object']['key']),
+              'record': s3_record} for _, s3_record in records]
+    results = process_batch(items, process_record, settings.BATCH_CONCURRENCY)
+    failed = [(message_id, result) for (message_id, _), result in zip(records, results)
+              if result['statusCode'] != 200]
+    if any(message_id is None for message_id, _ in failed):
+        # S3直接触发时整批重试, 已经处理过的图片会被标签过滤
+        raise RuntimeError('failed to process %s' % ', '.join(result['origin-key'] for _, result in failed))
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id}
+                              for message_id in sorted({message_id for message_id, _ in failed}.union(invalid))],
+    }
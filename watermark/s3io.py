@@ -0,0 +1,133 @@
+"""
+S3读写
+
+统一创建带连接池、长连接和重试配置的S3客户端,
+并把阻塞的boto3调用放到线程池中执行, 提供async接口, 让互不依赖的请求可以同时进行;
+大对象用并发的Range GET下载到预先分配的mmap中, 上传时按大小调整分片和并发数
+"""
+import asyncio
+import math
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+try:
+    from . import settings
+except ImportError:  # Lambda中作为顶层模块加载
+    import settings
+
+
+def create_client():
+    """
+    创建S3客户端
+    @return: boto3的S3客户端
+    """
+    config = Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                    connect_timeout=settings.S3_CONNECT_TIMEOUT,
+                    read_timeout=settings.S3_READ_TIMEOUT,
+                    retries={'total_max_attempts': settings.S3_MAX_ATTEMPTS, 'mode': 'standard'})
+    return boto3.client('s3', config=config, endpoint_url=settings.S3_ENDPOINT_URL)
+
+
+# S3分片上传的分片数上限和最小分片大小
+MAX_PARTS = 10000
+MIN_PART_BYTES = 5 * 1024 * 1024
+# 并发下载分片的线程
+part_executor = ThreadPoolExecutor(max_workers=settings.TRANSFER_MAX_CONCURRENCY, thread_name_prefix='transfer')
+
+
+def get_part_plan(size):
+    """
+    按对象大小确定分片大小和并发数: 不小于TRANSFER_PART_BYTES, 对象较大时增大分片,
+    让分片数接近并发数, 同时不超过S3的分片数上限
+    @param size: 对象大小
+    @return: (分片大小, 并发数)
+    """
+    part_size = max(settings.TRANSFER_PART_BYTES, MIN_PART_BYTES,
+                    math.ceil(size / settings.TRANSFER_MAX_CONCURRENCY), math.ceil(size / MAX_PARTS))
+    return part_size, max(1, min(settings.TRANSFER_MAX_CONCURRENCY, math.ceil(size / part_size)))
+
+
+def get_transfer_config(size):
+    """
+    @param size: 上传或下载的字节数
+    @return: 按大小调整分片和并发数的TransferConfig, 小于TRANSFER_THRESHOLD时不分片
+    """
+    part_size, concurrency = get_part_plan(size)
+    return TransferConfig(multipart_threshold=max(settings.TRANSFER_THRESHOLD, MIN_PART_BYTES),
+                          multipart_chunksize=part_size, max_concurrency=concurrency)
+
+
+def download_ranges(client, bucket, key, size, etag=None, path=None):
+    """
+    用并发的Range GET下载对象, 每个分片直接写入预先分配的mmap, 不需要再拼接
+    @param client: S3客户端
+    @param bucket: bucket
+    @param key: key
+    @param size: 对象大小
+    @param etag: 对象的ETag, 下载过程中对象被替换时分片请求失败, 不会拼出混合的内容
+    @param path: 本地文件路径, None时下载到内存
+    @return: 可以像文件一样读取的mmap, 或者path
+    """
+    part_size, _ = get_part_plan(size)
+    if path is None:
+        buffer = mmap.mmap(-1, size)
+    else:
+        f = open(path, 'w+b')
+        f.truncate(size)
+        buffer = mmap.mmap(f.fileno(), size)
+        f.close()
+
+    def fetch(start):
+        end = min(start + part_size, size) - 1
+        kwargs = {'IfMatch': etag} if etag else {}
+        response = client.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d' % (start, end), **kwargs)
+        buffer[start:end + 1] = response['Body'].read()
+
+    futures = [part_executor.submit(fetch, start) for start in range(0, size, part_size)]
+    wait(futures)
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        buffer.close()
+        if path is not None:
+            os.remove(path)
+        raise
+    if path is not None:
+        buffer.close()
+        return path
+    return buffer
+
+
+class AsyncS3(object):
+    """
+    在线程池中执行boto3调用的async包装
+    """
+
+    def __init__(self, get_client, max_workers):
+        """
+        @param get_client: 返回S3客户端的函数
+        @param max_workers: 执行阻塞调用的线程数
+        """
+        self.get_client = get_client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3io')
+
+    async def run(self, func, *args, **kwargs):
+        """
+        在线程池中执行任意阻塞函数
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def call(self, method, **kwargs):
+        """
+        执行S3客户端的方法, 例如 await aio.call('head_object', Bucket=..., Key=...)
+        """
+        return await self.run(getattr(self.get_client(), method), **kwargs)
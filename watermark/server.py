@@ -0,0 +1,224 @@
+"""
+独立运行的HTTP服务
+
+接收与API Gateway相同的POST请求(JSON body和x-s3-process查询参数), 交给预先启动的进程池处理,
+图片处理是CPU密集的, 多个进程可以用满所有核; 每个工作进程启动时预加载字体和水印素材,
+进程内的计划、字体、水印和处理结果缓存在请求之间保持
+
+    python -m watermark.server --port 8080 --workers 4
+
+配合MinIO等兼容S3的存储时设置WATERMARK_S3_ENDPOINT_URL
+正在处理和排队的请求超过 进程数 + WATERMARK_SERVER_QUEUE_SIZE 时直接返回503,
+收到SIGTERM或SIGINT后停止接收新请求, 等正在处理的请求完成后退出
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+try:
+    from . import settings
+except ImportError:  # 作为顶层模块加载
+    import settings
+
+
+def init_worker():
+    """
+    工作进程的初始化: 导入app时执行初始化和预加载
+    终端中按Ctrl-C时整个进程组都会收到SIGINT, 工作进程忽略它, 由主进程等待正在处理的任务完成后再关闭进程池
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        from . import app  # noqa: F401
+    except ImportError:
+        import app  # noqa: F401
+
+
+def handle_event(event):
+    """
+    在工作进程中处理一个请求
+    @param event: API Gateway格式的请求事件
+    @return: lambda_handler的返回值
+    """
+    try:
+        from . import app
+    except ImportError:
+        import app
+    return app.lambda_handler(event, None)
+
+
+def create_pool(workers):
+    """
+    创建进程池并启动所有工作进程, 第一个请求不需要等待进程启动和预加载
+    工作进程用spawn启动, 不继承服务进程中的线程和已打开的连接
+    @param workers: 进程数
+    @return: ProcessPoolExecutor
+    """
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker)
+    for future in [pool.submit(os.getpid) for _ in range(workers)]:
+        future.result()
+    return pool
+
+
+class WatermarkServer(ThreadingHTTPServer):
+    """
+    每个连接一个线程, 线程只负责收发, 处理在执行器中进行
+    """
+    daemon_threads = False  # 关闭时等待正在处理的请求
+
+    def __init__(self, address, executor, workers, queue_size=None, handler=handle_event, create_executor=None):
+        """
+        @param address: (host, port)
+        @param executor: 执行处理的进程池或线程池
+        @param workers: 执行器的并发数
+        @param queue_size: 除了正在处理的请求以外最多排队的请求数
+        @param handler: 在执行器中调用的处理函数, 参数为请求事件
+        @param create_executor: 进程池损坏(例如工作进程被OOM杀掉)后重新创建执行器的函数
+        """
+        super().__init__(address, RequestHandler)
+        self.executor = executor
+        self.handler = handler
+        self.create_executor = create_executor
+        queue_size = settings.SERVER_QUEUE_SIZE if queue_size is None else queue_size
+        self.capacity = threading.BoundedSemaphore(workers + queue_size)
+        self.draining = False
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def dispatch(self, event):
+        """
+        把请求交给执行器并等待结果
+        @param event: 请求事件
+        @return: (状态码, 响应body), 队列已满或正在关闭时为None
+        """
+        if self.draining or not self.capacity.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        with self._lock:
+            self.in_flight += 1
+        try:
+            executor = self.executor
+            try:
+                result = executor.submit(self.handler, event).result()
+            except BrokenProcessPool:
+                self.replace_executor(executor)
+                return 500, json.dumps({'message': 'worker crashed'})
+            except Exception as e:
+                print('请求处理失败: %s' % e)
+                return 500, json.dumps({'message': 'internal error'})
+            return result['statusCode'], result['body']
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.capacity.release()
+
+    def replace_executor(self, broken):
+        with self._lock:
+            if self.executor is not broken or self.create_executor is None:
+                return
+            self.executor = self.create_executor()
+        broken.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self.in_flight, 'rejected': self.rejected, 'draining': self.draining}
+
+    def drain(self):
+        """
+        停止接收新请求, 等待正在处理的请求完成后关闭执行器
+        """
+        self.draining = True
+        self.shutdown()  # 停止serve_forever
+        self.server_close()  # 等待请求线程
+        self.executor.shutdown(wait=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = settings.SERVER_KEEPALIVE_TIMEOUT
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/health':
+            return self.send_json(404, json.dumps({'message': 'not found'}))
+        stats = self.server.stats()
+        self.send_json(503 if stats['draining'] else 200, json.dumps(stats))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # 无法确定body的长度, 连接中剩余的内容也无法解析
+            self.close_connection = True
+            return self.send_json(400, json.dumps({'message': 'invalid content length'}))
+        if length > settings.SERVER_MAX_BODY_BYTES:
+            self.close_connection = True
+            return self.send_json(413, json.dumps({'message': 'request too large'}))
+        body = self.rfile.read(length).decode('utf-8')
+        url = urlsplit(self.path)
+        event = {
+            'body': body,
+            'queryStringParameters': dict(parse_qsl(url.query)) or None,
+            'headers': dict(self.headers.items()),
+            'httpMethod': 'POST',
+            'path': url.path,
+        }
+        result = self.server.dispatch(event)
+        if result is None:
+            return self.send_json(503, json.dumps({'message': 'server busy'}), {'Retry-After': '1'})
+        self.send_json(*result)
+
+    def send_json(self, status, body, headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.server.draining:
+            # 关闭时不再保持长连接
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if settings.SERVER_ACCESS_LOG:
+            super().log_message(format, *args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='水印处理HTTP服务')
+    parser.add_argument('--host', default=settings.SERVER_HOST)
+    parser.add_argument('--port', type=int, default=settings.SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=settings.SERVER_WORKERS, help='工作进程数')
+    parser.add_argument('--queue-size', type=int, default=settings.SERVER_QUEUE_SIZE, help='最多排队的请求数')
+    args = parser.parse_args(argv)
+
+    server = WatermarkServer((args.host, args.port), create_pool(args.workers), args.workers, args.queue_size,
+                             create_executor=lambda: create_pool(args.workers))
+
+    def stop(signum, frame):
+        print('收到信号%d, 等待正在处理的请求完成' % signum)
+        threading.Thread(target=server.drain).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print('监听 %s:%d, %d个工作进程' % (args.host, args.port, args.workers))
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+运行参数, 均可以通过环境变量覆盖
+"""
+import os
+
+# 图片读写模式: memory 在内存中完成下载、解码、编码和上传; file 使用/tmp目录中转
+IO_MODE = os.environ.get('WATERMARK_IO_MODE', 'memory')
+# memory模式下直接读入内存的最大对象大小(字节), 超过后退回file模式
+MEMORY_MAX_BYTES = int(os.environ.get('WATERMARK_MEMORY_MAX_BYTES', 64 * 1024 * 1024))
+# 编译后的x-s3-process计划缓存条数
+PLAN_CACHE_SIZE = int(os.environ.get('WATERMARK_PLAN_CACHE_SIZE', 256))
+# resize允许的最大边长
+MAX_DIMENSION = int(os.environ.get('WATERMARK_MAX_DIMENSION', 16384))
+# 已加载字体对象的缓存条数, 按(字体, 字号)缓存
+FONT_CACHE_SIZE = int(os.environ.get('WATERMARK_FONT_CACHE_SIZE', 16))
+# 渲染好的文字水印(含旋转和阴影)缓存容量(字节)
+TILE_CACHE_BYTES = int(os.environ.get('WATERMARK_TILE_CACHE_BYTES', 32 * 1024 * 1024))
+# 图片水印素材缓存容量(字节)
+ASSET_CACHE_BYTES = int(os.environ.get('WATERMARK_ASSET_CACHE_BYTES', 64 * 1024 * 1024))
+# 图片水印素材通过ETag重新校验的间隔(秒)
+ASSET_REVALIDATE_SECONDS = float(os.environ.get('WATERMARK_ASSET_REVALIDATE_SECONDS', 60))
+# 并行处理动图帧的线程数
+ANIMATION_WORKERS = int(os.environ.get('WATERMARK_ANIMATION_WORKERS', min(4, os.cpu_count() or 1)))
+# 缩放策略: exact 与原来的结果一致; quality, speed 在解码阶段缩小, 更快但结果与exact略有差别, 见app.RESIZE_STRATEGIES
+RESIZE_MODE = os.environ.get('WATERMARK_RESIZE_MODE', 'exact')
+# 批量请求同时处理的对象数
+BATCH_CONCURRENCY = int(os.environ.get('WATERMARK_BATCH_CONCURRENCY', 8))
+# 单个批量请求最多包含的对象数
+BATCH_MAX_ITEMS = int(os.environ.get('WATERMARK_BATCH_MAX_ITEMS', 100))
+# S3客户端连接池大小, 需要大于同时进行的S3请求数
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('WATERMARK_S3_MAX_POOL_CONNECTIONS', 32))
+# 执行S3请求的线程数
+S3_IO_THREADS = int(os.environ.get('WATERMARK_S3_IO_THREADS', 16))
+# S3请求的最大尝试次数(含第一次)
+S3_MAX_ATTEMPTS = int(os.environ.get('WATERMARK_S3_MAX_ATTEMPTS', 3))
+S3_CONNECT_TIMEOUT = float(os.environ.get('WATERMARK_S3_CONNECT_TIMEOUT', 2))
+S3_READ_TIMEOUT = float(os.environ.get('WATERMARK_S3_READ_TIMEOUT', 10))
+# 自定义S3地址, 例如本地的MinIO
+S3_ENDPOINT_URL = os.environ.get('WATERMARK_S3_ENDPOINT_URL') or None
+# 原图是否已处理过的检查结果缓存条数
+TAG_CACHE_SIZE = int(os.environ.get('WATERMARK_TAG_CACHE_SIZE', 4096))
+# 处理结果缓存: none 不缓存, memory 进程内缓存, disk 保存在/tmp中转目录, s3 保存在S3指定前缀下
+DERIVATIVE_CACHE = os.environ.get('WATERMARK_DERIVATIVE_CACHE', 'memory')
+# memory时为缓存总容量, s3时为单个结果的大小上限(字节)
+DERIVATIVE_CACHE_BYTES = int(os.environ.get('WATERMARK_DERIVATIVE_CACHE_BYTES', 64 * 1024 * 1024))
+DERIVATIVE_S3_BUCKET = os.environ.get('WATERMARK_DERIVATIVE_S3_BUCKET')
+DERIVATIVE_S3_PREFIX = os.environ.get('WATERMARK_DERIVATIVE_S3_PREFIX', 'derivatives/')
+# 是否以CloudWatch EMF格式把指标输出到日志
+METRICS_ENABLED = os.environ.get('WATERMARK_METRICS_ENABLED', '1') == '1'
+METRICS_NAMESPACE = os.environ.get('WATERMARK_METRICS_NAMESPACE', 'Watermark')
+METRICS_DIMENSION = 'FunctionName'
+METRICS_FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'watermark')
+# 进程内保留的最近指标条数
+METRICS_COLLECTOR_SIZE = int(os.environ.get('WATERMARK_METRICS_COLLECTOR_SIZE', 100))
+# 水印混合的实现: numpy(预乘alpha, 支持带透明通道的原图)或pillow, 没有安装numpy时总是使用pillow
+BLEND_BACKEND = os.environ.get('WATERMARK_BLEND_BACKEND', 'numpy')
+# 原图和处理过程中图片的最大像素数, 超过时返回413
+MAX_PIXELS = int(os.environ.get('WATERMARK_MAX_PIXELS', 100 * 1000 * 1000))
+# 按图片头估算的峰值内存超过该值时进入大图模式, 按条带缩放并尽早释放原图
+LARGE_IMAGE_BYTES = int(os.environ.get('WATERMARK_LARGE_IMAGE_BYTES', 128 * 1024 * 1024))
+# 大图模式下条带的行数, numpy混合时也按该行数分段计算
+STRIP_HEIGHT = int(os.environ.get('WATERMARK_STRIP_HEIGHT', 256))
+# 一次请求最多的输出个数
+MAX_VARIANTS = int(os.environ.get('WATERMARK_MAX_VARIANTS', 8))
+# S3上传事件使用的处理参数, 例如 image/watermark,text_xxx,g_se
+EVENT_PROCESS = os.environ.get('WATERMARK_PROCESS')
+# S3上传事件只处理这些扩展名的对象
+EVENT_SUFFIXES = tuple(os.environ.get('WATERMARK_EVENT_SUFFIXES', '.jpg,.jpeg,.png,.gif,.webp').lower().split(','))
+# S3上传事件中超过该大小的对象不处理
+EVENT_MAX_BYTES = int(os.environ.get('WATERMARK_EVENT_MAX_BYTES', 50 * 1024 * 1024))
+# 探测图片头时读取的字节数, 不超过该大小的对象探测一次就完整下载
+PROBE_BYTES = int(os.environ.get('WATERMARK_PROBE_BYTES', 64 * 1024))
+# 启动模式: prewarm 在初始化阶段预加载字体、水印素材和numpy; lazy 全部推迟到第一次用到时
+STARTUP_MODE = os.environ.get('WATERMARK_STARTUP_MODE', 'prewarm')
+# 预加载的字体, 逗号分隔的 字体:字号
+PREWARM_FONTS = tuple(f for f in os.environ.get('WATERMARK_PREWARM_FONTS', 'wqy-zenhei:40').split(',') if f)
+# 预加载的图片水印素材, 逗号分隔的 bucket/key
+PREWARM_ASSETS = tuple(a for a in os.environ.get('WATERMARK_PREWARM_ASSETS', '').split(',') if a)
+# 独立HTTP服务的监听地址和端口
+SERVER_HOST = os.environ.get('WATERMARK_SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('WATERMARK_SERVER_PORT', 8080))
+# 独立HTTP服务的工作进程数
+SERVER_WORKERS = int(os.environ.get('WATERMARK_SERVER_WORKERS', os.cpu_count() or 1))
+# 除了正在处理的请求以外最多排队的请求数, 超过后返回503
+SERVER_QUEUE_SIZE = int(os.environ.get('WATERMARK_SERVER_QUEUE_SIZE', 16))
+# 请求body的最大字节数
+SERVER_MAX_BODY_BYTES = int(os.environ.get('WATERMARK_SERVER_MAX_BODY_BYTES', 1024 * 1024))
+# 空闲的长连接保持的秒数, 关闭服务时最多等待这么久
+SERVER_KEEPALIVE_TIMEOUT = float(os.environ.get('WATERMARK_SERVER_KEEPALIVE_TIMEOUT', 5))
+# 是否输出访问日志
+SERVER_ACCESS_LOG = os.environ.get('WATERMARK_SERVER_ACCESS_LOG', '0') == '1'
+# 超过该大小的原图用并发的Range GET下载, 结果用并发的分片上传
+TRANSFER_THRESHOLD = int(os.environ.get('WATERMARK_TRANSFER_THRESHOLD', 16 * 1024 * 1024))
+# 最小的分片大小, 对象较大时自动增大
+TRANSFER_PART_BYTES = int(os.environ.get('WATERMARK_TRANSFER_PART_BYTES', 8 * 1024 * 1024))
+# 单个对象同时传输的分片数
+TRANSFER_MAX_CONCURRENCY = int(os.environ.get('WATERMARK_TRANSFER_MAX_CONCURRENCY', 8))
+# /tmp中转目录, 每个进程使用其中以pid命名的子目录
+SPOOL_DIR = os.environ.get('WATERMARK_SPOOL_DIR', '/tmp/watermark')
+# 中转文件和磁盘缓存的总字节数上限, Lambda的/tmp默认为512MB
+SPOOL_MAX_BYTES = int(os.environ.get('WATERMARK_SPOOL_MAX_BYTES', 384 * 1024 * 1024))
+# 是否把图片水印素材同时缓存在/tmp中
+ASSET_DISK_CACHE = os.environ.get('WATERMARK_ASSET_DISK_CACHE', '0') == '1'
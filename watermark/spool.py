@@ -0,0 +1,212 @@
+"""
+/tmp中转文件管理
+
+Lambda的/tmp在同一个容器的多次调用之间保留, 中转文件不删除会逐渐占满临时存储;
+所有文件都放在同一个目录下, 文件名是key的sha256, 不受key中的/和..影响,
+请求中的中转文件在请求结束时删除, 磁盘缓存(水印素材、处理结果)和中转文件共用一个总字节数上限,
+空间不足时按LRU淘汰缓存文件
+"""
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class SpoolFull(Exception):
+    """
+    淘汰所有缓存文件之后仍然放不下
+    """
+
+
+def hashed_name(parts, prefix):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return '%s-%s' % (prefix, digest.hexdigest())
+
+
+class Spool(object):
+    """
+    按总字节数限制的中转目录, 线程安全
+    """
+
+    def __init__(self, root, max_bytes):
+        """
+        @param root: 目录, 第一次使用时清空, 上一个进程留下的文件无法确认是否完整, 多个进程不能共用
+        @param max_bytes: 中转文件和缓存文件的总字节数上限
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.reserved_bytes = 0
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 缓存文件名 -> (字节数, 附加信息)
+        self._cached = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _ensure_root(self):
+        if not self._ready:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+            self._ready = True
+
+    def prepare(self):
+        """
+        第一次使用时创建目录
+        """
+        with self._lock:
+            self._ensure_root()
+
+    def _evict(self, nbytes):
+        """
+        淘汰缓存文件直到能再放下nbytes, 调用时持有锁
+        @return: 是否放得下
+        """
+        while self._cached and self.reserved_bytes + self.cached_bytes + nbytes > self.max_bytes:
+            name, (size, _) = self._cached.popitem(last=False)
+            self.cached_bytes -= size
+            self.evictions += 1
+            self._remove(name)
+        return self.reserved_bytes + self.cached_bytes + nbytes <= self.max_bytes
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+    def reserve(self, nbytes):
+        """
+        为中转文件预留空间, 必要时淘汰缓存文件
+        @param nbytes: 字节数
+        """
+        with self._lock:
+            self._ensure_root()
+            if not self._evict(nbytes):
+                raise SpoolFull('spool is full: %d bytes requested, %d reserved' % (nbytes, self.reserved_bytes))
+            self.reserved_bytes += nbytes
+
+    def release(self, nbytes):
+        with self._lock:
+            self.reserved_bytes -= nbytes
+
+    def session(self):
+        """
+        @return: 一次请求的中转文件, 用with在请求结束时删除
+        """
+        return SpoolSession(self)
+
+    def get(self, *key):
+        """
+        读取缓存文件
+        @param key: 缓存key
+        @return: (文件内容, 附加信息), 没有缓存时为None
+        """
+        name = hashed_name(key, 'cache')
+        with self._lock:
+            entry = self._cached.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cached.move_to_end(name)
+            # 在锁内读取, 避免同时被淘汰
+            with open(os.path.join(self.root, name), 'rb') as f:
+                return f.read(), entry[1]
+
+    def put(self, data, *key, info=None):
+        """
+        写入缓存文件, 超过上限的一半时不缓存, 给中转文件留出空间
+        @param data: 文件内容
+        @param key: 缓存key
+        @param info: 随文件保存在内存中的附加信息, 例如ETag
+        @return: 是否写入
+        """
+        if len(data) > self.max_bytes // 2:
+            return False
+        name = hashed_name(key, 'cache')
+        with self._lock:
+            self._ensure_root()
+            if name in self._cached:
+                self.cached_bytes -= self._cached.pop(name)[0]
+            if not self._evict(len(data)):
+                return False
+            # 先写临时文件再改名, 读取时不会看到写了一半的文件
+            tmp_path = os.path.join(self.root, name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.root, name))
+            self._cached[name] = (len(data), info)
+            self.cached_bytes += len(data)
+        return True
+
+    def clear(self):
+        with self._lock:
+            for name in self._cached:
+                self._remove(name)
+            self._cached.clear()
+            self.cached_bytes = 0
+
+    def stats(self):
+        """
+        @return: 占用和命中统计
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'items': len(self._cached),
+            'bytes': self.cached_bytes,
+            'reserved': self.reserved_bytes,
+        }
+
+
+class SpoolSession(object):
+    """
+    一次请求的中转文件和预留空间
+    """
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.paths = []
+        self.reserved_bytes = 0
+
+    def path(self, *key):
+        """
+        @param key: 文件的来源, 例如(bucket, key)
+        @return: 中转文件路径, 请求结束时删除
+        """
+        self.spool.prepare()
+        path = os.path.join(self.spool.root, hashed_name(key + (id(self), len(self.paths)), 'tmp'))
+        self.paths.append(path)
+        return path
+
+    def reserve(self, nbytes):
+        """
+        为即将写入的中转文件预留空间, 请求结束时释放
+        """
+        self.spool.reserve(nbytes)
+        self.reserved_bytes += nbytes
+
+    def close(self):
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.paths = []
+        self.spool.release(self.reserved_bytes)
+        self.reserved_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()